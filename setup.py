@@ -6,7 +6,7 @@ from setuptools import setup
 from setuptools import find_namespace_packages
 
 
-version = '4.4.1.dev0'
+version = '4.5.0.dev0'
 
 entry_points = {
 }
@@ -86,6 +86,11 @@ setup(
             'testgres >= 1.11',
             'psycopg2-binary; python_implementation != "PyPy"',
         ],
+        'relstorage': [
+            'ZODB >= 5.6.0',
+            'RelStorage[postgresql] >= 3.0',
+            'testgres >= 1.11',
+        ],
     },
     python_requires=">=3.10",
 )
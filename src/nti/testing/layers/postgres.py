@@ -13,12 +13,18 @@ The APIs are preliminary and may change.
 This is only supported on platforms that can install ``psycopg2``.
 
 """
+from collections import OrderedDict
 from contextlib import contextmanager
 import functools
+import itertools
+import json
 import os
+import re
+import shutil
 import sys
 import unittest
 from unittest.mock import patch
+import weakref
 
 #import psycopg2
 #import psycopg2.extras
@@ -31,15 +37,20 @@ except ImportError:
     DictCursor = None
     class IntegrityError(Exception):
         """Never thrown"""
-    ProgrammingError = InternalError = IntegrityError
+    ProgrammingError = InternalError = InvalidSqlStatementName = IntegrityError
+    TRANSACTION_STATUS_IDLE = 0
 else:
     from psycopg2.pool import ThreadedConnectionPool
     from psycopg2.extras import DictCursor
     from psycopg2 import IntegrityError
     from psycopg2 import InternalError
+    from psycopg2.errors import InvalidSqlStatementName # pylint:disable=no-name-in-module
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 
 import testgres
 
+from .postgres_profile import NodeResourceProfiler
+
 
 if 'PG_CONFIG' not in os.environ:
     # Set up for macports and fedora, using files that exist.
@@ -77,6 +88,24 @@ if 'NTI_SAVE_DB' in os.environ:
 if 'NTI_LOAD_DB_FILE' in os.environ:
     LOAD_DATABASE_ON_SETUP = os.environ['NTI_LOAD_DB_FILE']
 
+# If True, sample the resource usage of the Postgres server
+# while the layer is set up, and print a summary on teardown.
+PROFILE_RESOURCES = False
+# If the name of a file, each summary is also appended to it
+# as one line of JSON.
+PROFILE_RESOURCES_FILENAME = None
+
+if 'NTI_PROFILE_DB' in os.environ:
+    # NTI_PROFILE_DB is either 1/on/true (case-insensitive)
+    # or a file name.
+    val = os.environ['NTI_PROFILE_DB']
+    if val.lower() in {'0', 'off', 'false', 'no'}:
+        PROFILE_RESOURCES = False
+    else:
+        PROFILE_RESOURCES = True
+        if val.lower() not in {'1', 'on', 'true', 'yes'}:
+            PROFILE_RESOURCES_FILENAME = val
+
 
 def patched_get_pg_version(*args, **kwargs):
     # We patch  this in testgres.node, so its ok to import
@@ -107,17 +136,67 @@ def patched_get_pg_version(*args, **kwargs):
 
     return version
 
+_PLACEHOLDER = re.compile(r'%%|%s|%\(')
+
+def _numbered_placeholders(query):
+    """
+    Convert the ``%s`` placeholders used by ``psycopg2`` to the
+    ``$1``, ``$2``, ... placeholders used by ``PREPARE``.
+    """
+    counter = itertools.count(1)
+    def repl(match):
+        text = match.group(0)
+        if text == '%%':
+            return '%'
+        if text == '%s':
+            return f'${next(counter)}'
+        raise ValueError('Only positional parameters are supported', query)
+    return _PLACEHOLDER.sub(repl, query)
+
+
+def _execute_prepared(cur, name, params):
+    if params:
+        cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})',
+                    params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+
 class DatabaseLayer(object):
     """
     A test layer that creates the database, and sets each
     test up in its own connection, aborting the transaction when
     done.
+
+    There is only one Postgres node, shared by every layer that
+    extends this one, no matter how unrelated they are. It is created
+    when the first such layer is set up, and destroyed when the last
+    one is torn down.
+
+    .. versionchanged:: 4.5.0
+       Share the node between all layers, and allow sub-layers to use
+       their own databases within it.
     """
 
-    #: The name of the database within the node. We only create
-    #: the default databases, so this should be 'postgres'
+    #: The name of the database within the node. By default, this is
+    #: the 'postgres' database created along with the node. Sub-layers
+    #: that inherit this class's ``setUp`` and ``tearDown`` may set this
+    #: to another name; that database will be created from
+    #: :attr:`DATABASE_TEMPLATE` the first time a layer uses it,
+    #: and all layers using it share a connection pool.
+    #:
+    #: Note that the database helpers (`DatabaseBackupLayerHelper` and
+    #: `~nti.testing.layers.postgres_restore.DatabaseRestorePointLayerHelper`)
+    #: switch the connection pool of the layer they are given, and of
+    #: every other layer that was using a pool they replaced, whatever
+    #: its database.
     DATABASE_NAME = 'postgres'
 
+    #: The template for new databases.
+    #:
+    #: .. versionadded:: 4.5.0
+    DATABASE_TEMPLATE = 'template1'
+
     #: A `testgres.node.PostgresNode`, created for the layer.
     #: A psycopg2 connection to it is located in the :attr:`connection`
     #: attribute (similarly for :attr:`connection_pool`), while
@@ -138,17 +217,60 @@ class DatabaseLayer(object):
 
     connection_pool = None
 
+    #: A `NodeResourceProfiler`, if resource profiling was
+    #: started for this layer.
+    #:
+    #: .. versionadded:: 4.5.0
+    resource_profiler = None
 
     connection_pool_klass = ThreadedConnectionPool
     connection_pool_minconn = 1
     connection_pool_maxconn = 51
 
+    #: The exception raised when a constraint is violated;
+    #: :meth:`DatabaseTestCase.assertRaisesIntegrityError` expects it.
+    #:
+    #: .. versionadded:: 4.5.0
+    IntegrityError = IntegrityError
+
+    #: The maximum number of server-side prepared statements
+    #: :meth:`execute_cached` keeps for each connection.
+    #:
+    #: .. versionadded:: 4.5.0
+    prepared_statement_cache_size = 100
+
+    # {connection: OrderedDict({(sql, has_params): statement name})}
+    # The connections are weak, so those that are closed and thrown
+    # away don't keep their statements, and a new connection never
+    # sees them.
+    _prepared_statements = weakref.WeakKeyDictionary()
+    _prepared_statement_names = itertools.count()
+
+    # These are only set on this class, never on sub-layers.
+    # {database name: pool} for the current node.
+    _connection_pools = {}
+    # The number of layers set up using the current node.
+    _node_users = 0
+    # (node, postmaster pid) for the profiler.
+    _postmaster = (None, 0)
+
     @classmethod
     def setUp(cls):
+        if DatabaseLayer.postgres_node is None:
+            DatabaseLayer.postgres_node = cls._start_node()
+        DatabaseLayer._node_users += 1
+
+        cls._use_database()
+
+        if PROFILE_RESOURCES:
+            cls.start_resource_profile()
+
+    @classmethod
+    def _start_node(cls):
         testgres.configure_testgres()
 
         with patch('testgres.node.get_pg_version2', new=patched_get_pg_version):
-            node = cls.postgres_node = testgres.get_new_node()
+            node = testgres.get_new_node()
 
         # init takes about about 2 -- 3 seconds
         node.init(
@@ -211,23 +333,18 @@ class DatabaseLayer(object):
 
 
         node.start()
-        cls.connection_pool = cls.connection_pool_klass(
-            cls.connection_pool_minconn,
-            cls.connection_pool_maxconn,
-            dbname=cls.DATABASE_NAME,
-            host='localhost',
-            port=cls.postgres_node.port,
-            cursor_factory=DictCursor,
-        )
+        return node
 
-        cls.postgres_dsn = "host=%s dbname=%s port=%s" %  (
-            node.host, cls.DATABASE_NAME, node.port
-        )
-        cls.postgres_uri = "postgresql://%s:%s/%s" % (
-            cls.postgres_node.host,
-            cls.postgres_node.port,
-            cls.DATABASE_NAME
-        )
+    @classmethod
+    def _use_database(cls):
+        node = DatabaseLayer.postgres_node
+        name = cls.DATABASE_NAME
+        pool = DatabaseLayer._connection_pools.get(name)
+        if pool is None:
+            cls._create_database_if_needed()
+            pool = DatabaseLayer._connection_pools[name] = _new_connection_pool(cls, node)
+
+        cls._use_connection_pool(node, pool)
 
         with cls.borrowed_connection() as conn:
             with conn.cursor() as cur:
@@ -235,13 +352,74 @@ class DatabaseLayer(object):
                 print(f"({i['version']} {i['current_database']}/{i['current_schema']} "
                       f"{i['Encoding']}-{i['Collate']}) ", end="")
 
+    @classmethod
+    def _use_connection_pool(cls, node, pool):
+        """
+        Make the layer use *pool*, for its database in *node*, and
+        set the connection strings to match.
+        """
+        name = cls.DATABASE_NAME
+        # Layers using the default database share the attributes
+        # of this class, so that the helpers can replace them.
+        target = DatabaseLayer if name == DatabaseLayer.DATABASE_NAME else cls
+        target.connection_pool = pool
+        target.postgres_dsn = "host=%s dbname=%s port=%s" %  (
+            node.host, name, node.port
+        )
+        target.postgres_uri = "postgresql://%s:%s/%s" % (
+            node.host,
+            node.port,
+            name
+        )
+
+    @classmethod
+    def _create_database_if_needed(cls):
+        node = DatabaseLayer.postgres_node
+        name = cls.DATABASE_NAME
+        literal = "'" + name.replace("'", "''") + "'"
+        if node.execute(f'SELECT 1 FROM pg_database WHERE datname = {literal}'):
+            return
+
+        def ident(s):
+            return '"' + s.replace('"', '""') + '"'
+        # CREATE DATABASE can't run in a transaction; testgres uses autocommit.
+        node.execute(
+            f'CREATE DATABASE {ident(name)} TEMPLATE {ident(cls.DATABASE_TEMPLATE)}'
+        )
+
     @classmethod
     def tearDown(cls):
-        cls.connection_pool.closeall()
-        cls.connection_pool = None
+        cls.stop_resource_profile()
+        DatabaseLayer._node_users -= 1
+        if DatabaseLayer._node_users <= 0:
+            DatabaseLayer._node_users = 0
+            DatabaseLayer._stop_node()
 
-        cls.postgres_node.__exit__(None, None, None)
-        cls.postgres_node = None
+    @classmethod
+    def _forget_closed_connections(cls):
+        # Drop the prepared statements of connections that were just
+        # closed. Open connections (such as those of a node that
+        # DatabaseBackupLayerHelper goes back to) still have theirs on
+        # the server.
+        cache = cls._prepared_statements
+        for conn in [conn for conn in cache.keys() if conn.closed]:
+            del cache[conn]
+
+    @classmethod
+    def _stop_node(cls):
+        """
+        Close all the connection pools for the current node, and then
+        the node itself.
+        """
+        for pool in DatabaseLayer._connection_pools.values():
+            pool.closeall()
+        DatabaseLayer._connection_pools = {}
+        DatabaseLayer.connection_pool = None
+        DatabaseLayer._forget_closed_connections()
+
+        DatabaseLayer.postgres_node.__exit__(None, None, None)
+        DatabaseLayer.postgres_node = None
+        DatabaseLayer._postmaster = (None, 0)
 
     @classmethod
     def testSetUp(cls):
@@ -277,6 +455,73 @@ class DatabaseLayer(object):
         row = cur.fetchone()
         return dict(row)
 
+    @classmethod
+    def start_resource_profile(cls):
+        """
+        Begin sampling the resource usage of the Postgres server for
+        this layer; see `NodeResourceProfiler`.
+
+        This layer does this automatically when
+        ``PROFILE_RESOURCES`` is true (e.g., the ``NTI_PROFILE_DB``
+        environment variable is set). Sub-layers that want their own
+        summary should call this from their ``setUp`` and
+        :meth:`stop_resource_profile` from their ``tearDown``.
+
+        .. versionadded:: 4.5.0
+        """
+        cls.resource_profiler = NodeResourceProfiler(
+            # The layer helpers replace the node.
+            DatabaseLayer._postmaster_pid,
+            cls.__get_db_stats,
+            cls.__name__,
+        ).start()
+
+    @classmethod
+    def _postmaster_pid(cls):
+        node = DatabaseLayer.postgres_node
+        if node is None:
+            return 0
+        # Asking the node runs pg_ctl, so only do that once for each node.
+        if DatabaseLayer._postmaster[0] is not node:
+            DatabaseLayer._postmaster = (node, node.pid)
+        return DatabaseLayer._postmaster[1]
+
+    @classmethod
+    def stop_resource_profile(cls):
+        """
+        If :meth:`start_resource_profile` was called for this layer,
+        stop it, print its summary, and (if ``PROFILE_RESOURCES_FILENAME``
+        is set) append it as JSON to that file.
+
+        Returns the result, or None.
+
+        .. versionadded:: 4.5.0
+        """
+        profiler = cls.__dict__.get('resource_profiler')
+        if profiler is None:
+            return None
+        cls.resource_profiler = None
+        result = profiler.stop()
+        print(NodeResourceProfiler.format_summary(result), end=' ')
+        if PROFILE_RESOURCES_FILENAME:
+            with open(PROFILE_RESOURCES_FILENAME, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result))
+                f.write('\n')
+        return result
+
+    @classmethod
+    def __get_db_stats(cls):
+        columns = ', '.join(NodeResourceProfiler.STAT_COLUMNS)
+        with cls.borrowed_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f'SELECT {columns} FROM pg_stat_database WHERE datname = %s',
+                    (cls.DATABASE_NAME,)
+                )
+                row = dict(cur.fetchone())
+            conn.rollback()
+        return row
+
     @classmethod
     @contextmanager
     def borrowed_connection(cls):
@@ -291,6 +536,73 @@ class DatabaseLayer(object):
             cls.connection_pool.putconn(conn)
 
 
+    @classmethod
+    def execute_cached(cls, sql, params=None, cursor=None):
+        """
+        Like ``cursor.execute(sql, params)``, but using a server-side
+        prepared statement (``PREPARE``/``EXECUTE``).
+
+        The first time a connection sees a particular *sql* string, it is
+        prepared; after that, executing it skips parsing and planning.
+        Each connection keeps the :attr:`prepared_statement_cache_size`
+        most recently used statements, deallocating the rest. If the
+        server has forgotten a statement (after ``DISCARD ALL``, for
+        example), it is prepared again, as long as the connection
+        wasn't in a transaction that would be lost.
+
+        Parameters must be positional (``%s``).
+
+        :param cursor: The cursor to use; if not given, then
+            :attr:`cursor` (the cursor for the current test) is used.
+        :return: The cursor, ready to fetch results.
+
+        .. versionadded:: 4.5.0
+        """
+        cur = cursor if cursor is not None else cls.cursor
+        conn = cur.connection
+        cache = cls._prepared_statements.get(conn)
+        if cache is None:
+            cache = cls._prepared_statements[conn] = OrderedDict()
+        status = conn.get_transaction_status()
+        name = cls._prepare_cached(cur, cache, sql, params)
+        try:
+            _execute_prepared(cur, name, params)
+        except InvalidSqlStatementName:
+            # The server forgot our statements, probably because of a
+            # ``DEALLOCATE ALL`` or ``DISCARD ALL``. Prepare it again,
+            # once, but only if rolling back the failed statement doesn't
+            # lose anything the caller did.
+            if status != TRANSACTION_STATUS_IDLE:
+                raise
+            conn.rollback()
+            cache.clear()
+            name = cls._prepare_cached(cur, cache, sql, params)
+            _execute_prepared(cur, name, params)
+        return cur
+
+    @classmethod
+    def _prepare_cached(cls, cur, cache, sql, params):
+        # Return the name of the statement for *sql* in the *cache*
+        # of the connection of *cur*, preparing it if needed.
+
+        # Like psycopg2, only interpret placeholders if there are
+        # parameters.
+        key = (sql, params is not None)
+        name = cache.get(key)
+        if name is not None:
+            cache.move_to_end(key)
+            return name
+        name = f'nti_testing_{next(cls._prepared_statement_names)}'
+        stmt = _numbered_placeholders(sql) if params is not None else sql
+        # Prepared statements are not transactional; if the
+        # transaction is rolled back, this is still available.
+        cur.execute(f'PREPARE {name} AS {stmt}')
+        cache[key] = name
+        while len(cache) > cls.prepared_statement_cache_size:
+            _, old_name = cache.popitem(last=False)
+            cur.execute(f'DEALLOCATE {old_name}')
+        return name
+
     @classmethod
     def truncate_table(cls, conn, table_name):
         """Transactionally truncate the given *table_name* using *conn*"""
@@ -526,6 +838,7 @@ class DatabaseBackupLayerHelper:
     Note that this consists of modifying values in the `DatabaseLayer`,
     so the *layer* parameter must extend that.
     """
+    # pylint:disable=protected-access
 
     _nodes = []
     _pools = []
@@ -534,7 +847,8 @@ class DatabaseBackupLayerHelper:
     def push(cls, layer):
         current_node = DatabaseLayer.postgres_node
         cls._nodes.append(current_node)
-        cls._pools.append(DatabaseLayer.connection_pool)
+        cls._pools.append((DatabaseLayer.connection_pool,
+                           DatabaseLayer._connection_pools))
 
         with layer.borrowed_connection() as conn:
             with conn.cursor() as cur:
@@ -549,20 +863,67 @@ class DatabaseBackupLayerHelper:
         backup = current_node.backup(xlog_method='stream')
         DatabaseLayer.postgres_node = new_node = backup.spawn_primary()
         new_node.start()
-        DatabaseLayer.connection_pool = layer.connection_pool_klass(
-            layer.connection_pool_minconn,
-            layer.connection_pool_maxconn,
-            dbname=layer.DATABASE_NAME,
-            host='localhost',
-            port=new_node.port,
-            cursor_factory=DictCursor
-        )
+        _replace_connection_pools(layer, new_node)
 
     @classmethod
-    def pop(cls, layer): # pylint:disable=unused-argument
-        DatabaseLayer.tearDown() # Closes the current node, and the connection pool
-        DatabaseLayer.postgres_node = cls._nodes.pop()
-        DatabaseLayer.connection_pool = cls._pools.pop()
+    def pop(cls, layer):
+        replaced = DatabaseLayer._connection_pools
+        DatabaseLayer._stop_node() # Closes the current node, and the connection pools
+        node = DatabaseLayer.postgres_node = cls._nodes.pop()
+        DatabaseLayer.connection_pool, DatabaseLayer._connection_pools = cls._pools.pop()
+        # The connection strings name the port of the node.
+        _use_connection_pools(layer, node, replaced)
+
+
+def _replace_connection_pools(layer, node, replaced=None):
+    # Begin a new set of pools for *node*: one for each database that
+    # had a pool in *replaced* (by default, the pools now in use), and
+    # one for the database of *layer*. Then switch the layers over.
+    # pylint:disable=protected-access
+    if replaced is None:
+        replaced = DatabaseLayer._connection_pools
+    names = set(replaced)
+    names.add(layer.DATABASE_NAME)
+    DatabaseLayer._connection_pools = {
+        name: _new_connection_pool(layer, node, name)
+        for name in names
+    }
+    _use_connection_pools(layer, node, replaced)
+
+
+def _use_connection_pools(layer, node, replaced):
+    # Make the *layer*, the default database, and every layer that was
+    # using one of the *replaced* pools ({name: pool}) use their pools
+    # in ``_connection_pools``, which are for *node*. Layers that
+    # aren't being set up or torn down (such as the one between
+    # DatabaseLayer and *layer*) still run their testSetUp.
+    # pylint:disable=protected-access
+    pools = DatabaseLayer._connection_pools
+    replaced = list(replaced.values())
+    if DatabaseLayer.DATABASE_NAME in pools:
+        DatabaseLayer._use_connection_pool(node, pools[DatabaseLayer.DATABASE_NAME])
+    layer._use_connection_pool(node, pools[layer.DATABASE_NAME])
+    for klass in _database_layers():
+        pool = klass.__dict__.get('connection_pool')
+        if klass.DATABASE_NAME in pools and any(pool is old for old in replaced):
+            klass._use_connection_pool(node, pools[klass.DATABASE_NAME])
+
+
+def _database_layers(base=DatabaseLayer):
+    for klass in base.__subclasses__():
+        yield klass
+        yield from _database_layers(klass)
+
+
+def _new_connection_pool(layer, node, name=None):
+    return layer.connection_pool_klass(
+        layer.connection_pool_minconn,
+        layer.connection_pool_maxconn,
+        dbname=name or layer.DATABASE_NAME,
+        host='localhost',
+        port=node.port,
+        cursor_factory=DictCursor
+    )
 
 
 _persistent_base = (
@@ -632,7 +993,6 @@ class PersistentDatabaseLayer(_persistent_base):
             tmp_fname = cls.postgres_node.dump(format='custom')
             result_fname = tmp_fname
             if SAVE_DATABASE_FILENAME:
-                import shutil
                 result_fname = SAVE_DATABASE_FILENAME
                 while os.path.exists(result_fname):
                     result_fname += '.1'
@@ -660,16 +1020,21 @@ class DatabaseTestCase(unittest.TestCase):
     """
     A helper test base containing some functions useful for both
     benchmarking and unit testing.
+
+    The ``layer`` may also be a
+    :class:`~nti.testing.layers.sqlite.SQLiteDatabaseLayer`.
     """
     # pylint:disable=no-member
 
     @contextmanager
     def assertRaisesIntegrityError(self, match=None):
+        # Each kind of layer raises its driver's exception.
+        error = getattr(self.layer, 'IntegrityError', IntegrityError)
         if match:
-            with self.assertRaisesRegex(IntegrityError, match) as exc:
+            with self.assertRaisesRegex(error, match) as exc:
                 yield exc
         else:
-            with self.assertRaises(IntegrityError) as exc:
+            with self.assertRaises(error) as exc:
                 yield exc
 
         # We can't do any queries after an error is raised
@@ -678,9 +1043,9 @@ class DatabaseTestCase(unittest.TestCase):
         return exc
 
     def assert_row_count_in_query(self, expected_count, query):
-        cur = self.layer.cursor
-
-        cur.execute('SELECT COUNT(*) FROM ' + query)
+        # These are frequently called repeatedly in loops, so
+        # use a prepared statement.
+        cur = self.layer.execute_cached('SELECT COUNT(*) FROM ' + query)
         row = cur.fetchone()
         count = row[0]
 
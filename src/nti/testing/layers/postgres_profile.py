@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling the resource usage of a Postgres server.
+
+:class:`nti.testing.layers.postgres.DatabaseLayer` uses this when
+resource profiling is enabled.
+
+.. versionadded:: 4.5.0
+"""
+import threading
+import time
+
+__all__ = [
+    'NodeResourceProfiler',
+]
+
+
+class NodeResourceProfiler(object): # pylint:disable=too-many-instance-attributes
+    """
+    Samples the resource usage of a running Postgres server: the CPU
+    time, resident memory and I/O of the postmaster (given by *pid*)
+    and all of its backends, plus the counters from
+    ``pg_stat_database``, as returned by the *stats_query* callable.
+
+    *pid* may also be a callable returning the pid of the current
+    postmaster (or 0 if there isn't one). It is called for each
+    sample, so that when the node is replaced (as the layer helpers
+    do) the new postmaster is followed. The usage of each postmaster
+    is added up; one first seen after :meth:`start` counts from zero.
+    The ``pg_stat_database`` counters can only be queried from the
+    node that is current when profiling stops; if that isn't the node
+    it started with, they are the counters of that node since it
+    started.
+
+    Samples are taken in a background thread every :attr:`interval`
+    seconds between :meth:`start` and :meth:`stop`. CPU time of
+    backends that exit is still counted (the kernel charges it to the
+    postmaster), but I/O of a backend that exits is only counted up
+    to its last sample.
+
+    .. versionadded:: 4.5.0
+    """
+
+    #: Seconds between samples.
+    interval = 0.5
+
+    #: The ``pg_stat_database`` columns that are reported.
+    STAT_COLUMNS = (
+        'xact_commit',
+        'xact_rollback',
+        'blks_read',
+        'blks_hit',
+        'tup_returned',
+        'tup_fetched',
+        'tup_inserted',
+        'tup_updated',
+        'tup_deleted',
+        'temp_files',
+        'temp_bytes',
+    )
+
+    def __init__(self, pid, stats_query=None, label=''):
+        import psutil # A dependency of testgres
+        self._psutil = psutil
+        self._get_pid = pid if callable(pid) else lambda: pid
+        #: The pid of the postmaster last sampled.
+        self.pid = None
+        self.stats_query = stats_query
+        self.label = label
+        self._postmaster = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+        self._start_pid = None
+        # {postmaster pid: CPU time}
+        self._start_cpu = {}
+        self._last_cpu = {}
+        self._start_stats = {}
+        self._start_io = {}
+        self._last_io = {}
+        self._peak_rss = 0
+
+    def _find_postmaster(self):
+        pid = self._get_pid()
+        if not pid:
+            # Between nodes.
+            return None
+        if pid != self.pid:
+            self._postmaster = self._psutil.Process(pid)
+            self.pid = pid
+        return self._postmaster
+
+    def _processes(self):
+        return [self._postmaster] + self._postmaster.children()
+
+    def _cpu(self):
+        times = self._postmaster.cpu_times()
+        # Exited (and reaped) backends are in the children times.
+        total = times.user + times.system + times.children_user + times.children_system
+        for proc in self._postmaster.children():
+            try:
+                times = proc.cpu_times()
+            except self._psutil.Error:
+                continue
+            total += times.user + times.system
+        return total
+
+    def _sample(self):
+        if self._find_postmaster() is None:
+            return
+        self._last_cpu[self.pid] = self._cpu()
+        rss = 0
+        for proc in self._processes():
+            try:
+                with proc.oneshot():
+                    rss += proc.memory_info().rss
+                    io = proc.io_counters()
+            except (self._psutil.Error, AttributeError):
+                # Gone, or no I/O counters on this platform.
+                continue
+            self._last_io[proc.pid] = (io.read_bytes, io.write_bytes)
+        self._peak_rss = max(self._peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except self._psutil.NoSuchProcess:
+                # The postmaster went away; keep what we have. If the
+                # node is being replaced, a later sample finds the new one.
+                continue
+
+    def start(self):
+        """
+        Record the starting values and begin sampling.
+        """
+        self._start_time = time.perf_counter()
+        self._sample()
+        self._start_pid = self.pid
+        self._start_cpu = dict(self._last_cpu)
+        self._start_io = dict(self._last_io)
+        self._start_stats = self.stats_query() if self.stats_query else {}
+        self._thread = threading.Thread(target=self._run,
+                                        name='nti.testing.postgres-profiler',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling and return a dictionary describing the usage
+        since :meth:`start`.
+        """
+        self._stop.set()
+        self._thread.join()
+        try:
+            self._sample()
+        except self._psutil.NoSuchProcess:
+            pass
+        cpu = sum(
+            end - self._start_cpu.get(pid, 0.0)
+            for pid, end in self._last_cpu.items()
+        ) if self._last_cpu else None
+        read_bytes = written_bytes = 0
+        for pid, (read, written) in self._last_io.items():
+            start_read, start_written = self._start_io.get(pid, (0, 0))
+            read_bytes += read - start_read
+            written_bytes += written - start_written
+
+        result = {
+            'label': self.label,
+            'elapsed': time.perf_counter() - self._start_time,
+            'cpu': cpu,
+            'peak_rss': self._peak_rss,
+            'read_bytes': read_bytes,
+            'written_bytes': written_bytes,
+        }
+        if self.stats_query:
+            end_stats = self.stats_query()
+            start_stats = self._start_stats if self.pid == self._start_pid else {}
+            for k, v in end_stats.items():
+                result[k] = v - start_stats.get(k, 0)
+        return result
+
+    @staticmethod
+    def format_summary(result):
+        """
+        Return a compact, one-line description of a result from :meth:`stop`.
+        """
+        def mb(nbytes):
+            return f'{nbytes / 1024 / 1024:.1f}MB'
+
+        cpu = result['cpu']
+        parts = [
+            f"cpu {cpu:.2f}s" if cpu is not None else 'cpu ?',
+            f"rss {mb(result['peak_rss'])}",
+            f"read {mb(result['read_bytes'])}",
+            f"written {mb(result['written_bytes'])}",
+        ]
+        if 'blks_hit' in result:
+            parts.append(f"blks hit/read {result['blks_hit']}/{result['blks_read']}")
+            parts.append(f"xact {result['xact_commit']}/{result['xact_rollback']}")
+            parts.append(f"temp {mb(result['temp_bytes'])}")
+        label = result['label'] + ' ' if result['label'] else ''
+        return f"({label}pg: {', '.join(parts)})"
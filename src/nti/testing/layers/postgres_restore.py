@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Rewinding the Postgres node of
+:class:`~nti.testing.layers.postgres.DatabaseLayer` to restore points
+in its write-ahead log, as nested layers are torn down.
+
+.. versionadded:: 4.5.0
+"""
+import os
+import shutil
+import tempfile
+
+from .postgres import DatabaseLayer
+from .postgres import _replace_connection_pools
+
+__all__ = [
+    'DatabaseRestorePointLayerHelper',
+]
+
+
+class DatabaseRestorePointLayerHelper:
+    # pylint:disable=protected-access
+    """
+    A layer helper with the same interface as
+    :class:`~nti.testing.layers.postgres.DatabaseBackupLayerHelper`,
+    but that avoids taking a full backup for each nested layer.
+
+    * The first `push` turns on WAL archiving for the current node
+      (this requires restarting it) and takes a single base backup.
+    * Every `push` records a restore point (an LSN) in the WAL.
+    * On `pop`, the current node is discarded and replaced by a new
+      node spawned from the base backup, replaying archived WAL up to
+      the LSN recorded by the matching `push`, and then promoted.
+
+    A deep layer hierarchy thus pays for one backup, not one per
+    level. (``pg_rewind`` is not used because it needs a running source
+    server that is already at the target state, which is exactly what
+    we don't have.)
+
+    Note that this consists of modifying values in the
+    :class:`~nti.testing.layers.postgres.DatabaseLayer`, so the *layer*
+    parameter must extend that. It must not be mixed with
+    ``DatabaseBackupLayerHelper`` in the same hierarchy.
+
+    This requires PostgreSQL 12 or later, which starts recovery from a
+    ``recovery.signal`` file.
+
+    .. versionadded:: 4.5.0
+    """
+
+    _base_backup = None
+    _archive_dir = None
+    _restore_points = []
+
+    #: How often, in seconds, to poll the server while waiting for
+    #: WAL to be archived or recovery to finish.
+    poll_interval = 0.1
+
+    @classmethod
+    def push(cls, layer):
+        if cls._base_backup is None:
+            with layer.borrowed_connection() as conn:
+                if conn.server_version < 120000:
+                    raise RuntimeError(
+                        'Restore points require PostgreSQL 12 or later',
+                        conn.server_version
+                    )
+            cls._enable_archiving(layer)
+            with layer.borrowed_connection() as conn:
+                with conn.cursor() as cur:
+                    # As for DatabaseBackupLayerHelper, don't wait for
+                    # the next checkpoint.
+                    cur.execute('CHECKPOINT')
+            cls._base_backup = DatabaseLayer.postgres_node.backup(xlog_method='stream')
+
+        name = f'nti.testing.{len(cls._restore_points)}'
+        with layer.borrowed_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_create_restore_point(%s)', (name,))
+                lsn = cur.fetchone()[0]
+            conn.commit()
+        cls._restore_points.append(lsn)
+
+    @classmethod
+    def pop(cls, layer):
+        lsn = cls._restore_points.pop()
+        old_node = DatabaseLayer.postgres_node
+        with layer.borrowed_connection() as conn:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                # Close the current WAL segment so that it (and thus the
+                # restore point) gets archived, and wait for that.
+                cur.execute('SELECT pg_switch_wal()')
+            conn.autocommit = False
+        old_node.poll_query_until(
+            "SELECT count(*) = 0 FROM pg_ls_archive_statusdir() "
+            "WHERE name LIKE '%.ready'",
+            sleep_time=cls.poll_interval
+        )
+        replaced = DatabaseLayer._connection_pools
+        DatabaseLayer._stop_node() # Closes the current node, and the connection pools
+
+        # Keep the backup available for the next pop.
+        new_node = cls._base_backup.spawn_primary(destroy=False)
+        new_node.append_conf(f"restore_command = 'cp {cls._archive_dir}/%f %p'")
+        new_node.append_conf(f"recovery_target_lsn = '{lsn}'")
+        new_node.append_conf("recovery_target_action = 'promote'")
+        with open(os.path.join(new_node.data_dir, 'recovery.signal'), 'w', encoding='ascii'):
+            pass
+        new_node.start()
+        new_node.poll_query_until(
+            'SELECT NOT pg_is_in_recovery()',
+            sleep_time=cls.poll_interval
+        )
+        DatabaseLayer.postgres_node = new_node
+        # This also updates the connection strings, which name the
+        # port of the new node.
+        _replace_connection_pools(layer, new_node, replaced)
+
+        if not cls._restore_points:
+            cls._base_backup.cleanup()
+            cls._base_backup = None
+            shutil.rmtree(cls._archive_dir, ignore_errors=True)
+            cls._archive_dir = None
+
+    @classmethod
+    def _enable_archiving(cls, layer):
+        node = DatabaseLayer.postgres_node
+        archive_dir = cls._archive_dir = tempfile.mkdtemp(prefix='nti-testing-wal-')
+        node.append_conf('archive_mode = on')
+        # Once the archive directory is removed, archiving silently
+        # becomes a no-op instead of failing (and retrying) forever.
+        node.append_conf(
+            f"archive_command = 'test ! -d {archive_dir} || cp %p {archive_dir}/%f'"
+        )
+        # Changing archive_mode requires a restart, which invalidates all
+        # the pooled connections, so they are all replaced.
+        for pool in DatabaseLayer._connection_pools.values():
+            pool.closeall()
+        DatabaseLayer._forget_closed_connections()
+        node.restart()
+        _replace_connection_pools(layer, node)
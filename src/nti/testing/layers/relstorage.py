@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Support for running ZODB tests against RelStorage, using the Postgres
+node of :class:`nti.testing.layers.postgres.DatabaseLayer`.
+
+:class:`~nti.testing.zodb.ZODBLayer` uses an in-memory
+:class:`~ZODB.DemoStorage.DemoStorage`, which hides storage-level
+costs such as round trips to the server, conflict resolution and
+cache misses. The layers here replace its database with one using a
+``RelStorage`` in a database of the shared Postgres node, so those
+costs show up in tests, and record the loads and stores made by each
+test.
+
+This requires the ``relstorage`` extra.
+
+.. versionadded:: 4.5.0
+"""
+
+import ZODB
+from ZODB.interfaces import IDatabase
+from zope import component
+
+from ..zodb import ZODBLayer
+from ..zodb_stats import _transfer_counts
+from . import find_test
+from .postgres import DatabaseLayer
+
+__all__ = [
+    'RelStorageLayerMixin',
+    'RelStorageLayer',
+]
+
+
+class RelStorageLayerMixin(object):
+    """
+    Mix this in to a layer extending both
+    :class:`~nti.testing.zodb.ZODBLayer` and
+    :class:`~nti.testing.layers.postgres.DatabaseLayer`, and call
+    :meth:`setUpRelStorage`, :meth:`tearDownRelStorage`,
+    :meth:`testSetUpRelStorage` and :meth:`testTearDownRelStorage`
+    from the corresponding layer methods. :class:`RelStorageLayer`
+    does that.
+
+    While the layer is set up, a database using RelStorage in the
+    Postgres database named by :attr:`DATABASE_NAME` replaces
+    :attr:`ZODBLayer.db` (and the registered utility). Everything in
+    that Postgres database is removed when the layer is set up, so
+    each layer using this should have its own :attr:`DATABASE_NAME`.
+
+    Tests are isolated in one of two ways:
+
+    - By default, as with any :class:`~nti.testing.zodb.ZODBLayer`,
+      each test gets a :class:`~ZODB.DemoStorage.DemoStorage` on top of
+      the RelStorage. Objects are loaded from Postgres, but changes are
+      only kept in memory.
+    - If the test's layer sets ``isolate_tests`` to false and
+      :attr:`truncate_tests` to true, the test writes to Postgres, and
+      all the tables are truncated when it finishes (using
+      ``zap_all``). This also removes anything committed when the
+      layer was set up.
+
+    The number of objects loaded and stored by each test is kept in
+    :attr:`test_statistics`, along with the hits and misses of the
+    RelStorage cache, and the busiest tests are printed when the layer
+    is torn down.
+    """
+
+    DATABASE_NAME = 'relstorage'
+
+    #: Keyword arguments for :class:`relstorage.options.Options`.
+    #: The sizes of the RelStorage caches are set here.
+    relstorage_options = {
+        'keep_history': False,
+        'cache_local_mb': 10,
+    }
+
+    #: Keyword arguments for :class:`ZODB.DB`, such as
+    #: ``cache_size`` and ``cache_size_bytes``.
+    db_options = {}
+
+    #: Whether to truncate the tables after each test. This is read
+    #: from the layer of the running test.
+    truncate_tests = False
+
+    #: ``{test id: {statistic: value}}`` for each test that has run
+    #: in this layer.
+    test_statistics = None
+
+    #: How many tests to print when the layer is torn down.
+    report_limit = 10
+
+    _previous_db = None
+    _storage = None
+    _truncate = False
+    _cache_stats = None
+
+    @classmethod
+    def setUp(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def tearDown(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def testSetUp(cls):
+        pass
+
+    @classmethod
+    def testTearDown(cls):
+        pass
+
+    @classmethod
+    def create_storage(cls):
+        """
+        Create and return a new RelStorage for :attr:`postgres_dsn`.
+        """
+        # relstorage is an optional dependency.
+        # pylint:disable=import-outside-toplevel,import-error
+        from relstorage.adapters.postgresql import PostgreSQLAdapter
+        from relstorage.options import Options
+        from relstorage.storage import RelStorage
+        options = Options(**cls.relstorage_options)
+        adapter = PostgreSQLAdapter(dsn=cls.postgres_dsn, options=options)
+        return RelStorage(adapter, options=options)
+
+    @classmethod
+    def setUpRelStorage(cls):
+        """
+        Create the database, and install it as :attr:`ZODBLayer.db`.
+        """
+        cls._use_database()
+        cls.test_statistics = {}
+        cls._previous_db = ZODBLayer.db
+        cls._install_db(cls._open_db())
+
+    @classmethod
+    def tearDownRelStorage(cls):
+        """
+        Close the database, restore the previous :attr:`ZODBLayer.db`,
+        and print the report.
+        """
+        db = ZODBLayer.db
+        previous = ZODBLayer.db = cls._previous_db
+        cls._previous_db = None
+        cls._storage = None
+        gsm = component.getGlobalSiteManager()
+        if gsm.queryUtility(IDatabase) is db:
+            if previous is not None:
+                gsm.registerUtility(previous, IDatabase)
+            else:
+                gsm.unregisterUtility(db, IDatabase)
+        db.close()
+        cls.print_statistics()
+
+    @classmethod
+    def testSetUpRelStorage(cls, test=None):
+        # pylint:disable=protected-access
+        test = test or find_test()
+        layer = getattr(test, 'layer', cls)
+        # Only when the test is writing to the RelStorage.
+        cls._truncate = (
+            ZODBLayer._base_db is None
+            and getattr(layer, 'truncate_tests', cls.truncate_tests)
+        )
+        _transfer_counts(ZODBLayer.db, True)
+        cls._cache_stats = cls._get_cache_stats()
+
+    @classmethod
+    def testTearDownRelStorage(cls, test=None):
+        test = test or find_test()
+        # While the test's DB is still in place.
+        loads, stores = _transfer_counts(ZODBLayer.db, True)
+        stats = {'loads': loads, 'stores': stores}
+        before = cls._cache_stats or {}
+        for k, v in cls._get_cache_stats().items():
+            stats['cache_' + k] = v - before.get(k, 0)
+        cls.test_statistics[test.id() if test is not None else None] = stats
+
+        if cls._truncate:
+            cls._truncate = False
+            ZODBLayer.db.close()
+            cls._install_db(cls._open_db())
+
+    @classmethod
+    def print_statistics(cls):
+        """
+        Print the tests that loaded the most objects.
+        """
+        stats = cls.test_statistics or {}
+        busiest = sorted(stats.items(),
+                         key=lambda i: (i[1]['loads'], i[1]['stores']),
+                         reverse=True)[:cls.report_limit]
+        if not busiest:
+            return
+        print()
+        print(f'{"Loads":>8} {"Stores":>8} Test ({cls.__name__})')
+        for test_id, stat in busiest:
+            print(f'{stat["loads"]:8d} {stat["stores"]:8d} {test_id}')
+
+    @classmethod
+    def _open_db(cls):
+        storage = cls._storage = cls.create_storage()
+        storage.zap_all()
+        return ZODB.DB(storage, **cls.db_options)
+
+    @classmethod
+    def _install_db(cls, db):
+        ZODBLayer.db = db
+        component.getGlobalSiteManager().registerUtility(db, IDatabase)
+
+    @classmethod
+    def _get_cache_stats(cls):
+        # The RelStorage cache statistics that count up.
+        cache = getattr(cls._storage, '_cache', None)
+        try:
+            stats = cache.stats()
+        except AttributeError:
+            return {}
+        return {
+            k: v for k, v in stats.items()
+            if k in {'hits', 'misses', 'sets'}
+        }
+
+
+class RelStorageLayer(RelStorageLayerMixin, ZODBLayer, DatabaseLayer):
+    """
+    A layer whose :attr:`ZODBLayer.db` uses RelStorage; see
+    :class:`RelStorageLayerMixin`.
+    """
+
+    @classmethod
+    def setUp(cls):
+        cls.setUpRelStorage()
+
+    @classmethod
+    def tearDown(cls):
+        cls.tearDownRelStorage()
+
+    @classmethod
+    def testSetUp(cls):
+        cls.testSetUpRelStorage()
+
+    @classmethod
+    def testTearDown(cls):
+        cls.testTearDownRelStorage()
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+A lightweight stand-in for
+:class:`nti.testing.layers.postgres.DatabaseLayer`, backed by an
+in-memory :mod:`sqlite3` database.
+
+Booting a Postgres cluster takes seconds; this layer is ready in
+milliseconds. It exposes the same basic API (:attr:`~.connection`,
+:attr:`~.cursor`, :meth:`~.borrowed_connection`,
+:meth:`~.truncate_table` and :attr:`~.postgres_dsn`), so layers whose
+tests only use simple, portable SQL can choose it instead. The helpers
+of :class:`nti.testing.layers.postgres.DatabaseTestCase` work with it
+too.
+
+Statements are passed to SQLite as-is, except that the ``psycopg2``
+placeholders (``%s`` and ``%(name)s``) are translated when parameters
+are given. Nothing else about Postgres is emulated.
+
+.. versionadded:: 4.5.0
+"""
+from contextlib import contextmanager
+import itertools
+import re
+import sqlite3
+import threading
+
+
+_PLACEHOLDER = re.compile(r'%%|%s|%\((\w+)\)s')
+
+def _translate_placeholders(query):
+    """
+    Convert the ``pyformat`` placeholders used by ``psycopg2`` to
+    the ``qmark``/``named`` placeholders used by :mod:`sqlite3`.
+    """
+    def repl(match):
+        text = match.group(0)
+        if text == '%%':
+            return '%'
+        if text == '%s':
+            return '?'
+        return ':' + match.group(1)
+    return _PLACEHOLDER.sub(repl, query)
+
+
+class _Cursor(object):
+    """
+    Wraps a :class:`sqlite3.Cursor` to accept ``psycopg2`` style
+    placeholders and to be usable as a context manager.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.close()
+
+    def execute(self, query, params=None):
+        # Like psycopg2, only interpret placeholders if there
+        # are parameters.
+        if params is None:
+            self._cursor.execute(query)
+        else:
+            self._cursor.execute(_translate_placeholders(query), params)
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self._cursor.executemany(_translate_placeholders(query), seq_of_params)
+        return self
+
+
+class _Connection(object):
+    """
+    Wraps a :class:`sqlite3.Connection` to look enough like a
+    ``psycopg2`` connection.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.notices = []
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return _Cursor(self._connection.cursor())
+
+    @property
+    def autocommit(self):
+        return self._connection.isolation_level is None
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._connection.isolation_level = None if value else ''
+
+
+class _ConnectionPool(object):
+    """
+    A minimal version of the ``psycopg2`` connection pool API.
+    """
+
+    def __init__(self, minconn, maxconn, dsn):
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.closed = False
+        self._lock = threading.Lock()
+        self._available = []
+        self._used = []
+        for _ in range(minconn):
+            self._available.append(self._connect())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.dsn, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return _Connection(conn)
+
+    def getconn(self):
+        with self._lock:
+            if self.closed:
+                raise sqlite3.InterfaceError('connection pool is closed')
+            if self._available:
+                conn = self._available.pop()
+            elif len(self._used) < self.maxconn:
+                conn = self._connect()
+            else:
+                raise sqlite3.OperationalError('connection pool exhausted')
+            self._used.append(conn)
+            return conn
+
+    def putconn(self, conn):
+        with self._lock:
+            if self.closed:
+                raise sqlite3.InterfaceError('connection pool is closed')
+            self._used.remove(conn)
+            self._available.append(conn)
+
+    def closeall(self):
+        with self._lock:
+            self.closed = True
+            for conn in self._available + self._used:
+                conn.close()
+            del self._available[:]
+            del self._used[:]
+
+
+class SQLiteDatabaseLayer(object):
+    """
+    A test layer that creates an in-memory SQLite database, and sets
+    each test up in its own connection, aborting the transaction when
+    done.
+
+    The database lives as long as the layer does; tables created in
+    a sub-layer's ``setUp`` are visible to all of its tests.
+    """
+
+    #: The name of the database. Each layer gets its own
+    #: in-memory database, so this is only informational.
+    DATABASE_NAME = 'postgres'
+
+    #: A URI you can pass to :func:`sqlite3.connect` (with ``uri=True``)
+    #: to connect to the same in-memory database.
+    postgres_dsn = None
+
+    #: A string you can pass to SQLAlchemy
+    postgres_uri = None
+
+    #: Set for each test.
+    connection = None
+
+    #: Set for each test.
+    cursor = None
+
+    connection_pool = None
+
+    connection_pool_klass = _ConnectionPool
+    connection_pool_minconn = 1
+    connection_pool_maxconn = 51
+
+    #: The exception raised when a constraint is violated, for
+    #: :meth:`nti.testing.layers.postgres.DatabaseTestCase.assertRaisesIntegrityError`.
+    IntegrityError = sqlite3.IntegrityError
+
+    # Keeps the shared-cache, in-memory database alive.
+    _keeper = None
+    _counter = itertools.count()
+
+    @classmethod
+    def setUp(cls):
+        name = f'nti_testing_{cls.DATABASE_NAME}_{next(cls._counter)}'
+        cls.postgres_dsn = f'file:{name}?mode=memory&cache=shared'
+        cls.postgres_uri = f'sqlite:///{cls.postgres_dsn}&uri=true'
+        cls._keeper = sqlite3.connect(cls.postgres_dsn, uri=True)
+        cls.connection_pool = cls.connection_pool_klass(
+            cls.connection_pool_minconn,
+            cls.connection_pool_maxconn,
+            cls.postgres_dsn,
+        )
+
+    @classmethod
+    def tearDown(cls):
+        cls.connection_pool.closeall()
+        cls.connection_pool = None
+        cls._keeper.close()
+        cls._keeper = None
+
+    @classmethod
+    def testSetUp(cls):
+        cls.connection = cls.connection_pool.getconn()
+        cls.cursor = cls.connection.cursor()
+
+    @classmethod
+    def testTearDown(cls):
+        cls.connection.rollback()
+        cls.cursor.close()
+        cls.cursor = None
+        cls.connection_pool.putconn(cls.connection)
+        cls.connection = None
+
+    @classmethod
+    @contextmanager
+    def borrowed_connection(cls):
+        """
+        Context manager that returns a connection from the connection
+        pool.
+        """
+        conn = cls.connection_pool.getconn()
+        try:
+            yield conn
+        finally:
+            cls.connection_pool.putconn(conn)
+
+    @classmethod
+    def execute_cached(cls, sql, params=None, cursor=None):
+        """
+        Execute *sql* with *params* using *cursor* (by default, :attr:`cursor`),
+        returning the cursor.
+
+        This is for API compatibility with the Postgres layer;
+        :mod:`sqlite3` already caches prepared statements for
+        each connection.
+        """
+        cur = cursor if cursor is not None else cls.cursor
+        return cur.execute(sql, params)
+
+    @classmethod
+    def truncate_table(cls, conn, table_name):
+        """Transactionally empty the given *table_name* using *conn*"""
+        try:
+            with conn.cursor() as cur:
+                # SQLite has no TRUNCATE; this is the same thing.
+                cur.execute('DELETE FROM ' + table_name)
+        except sqlite3.OperationalError:
+            # Table doesn't exist, not a full schema,
+            # ignore.
+            import traceback
+            traceback.print_exc()
+            conn.rollback()
+        else:
+            conn.commit()
+
+    @classmethod
+    def drop_relation(cls, relation, kind='TABLE', idempotent=False):
+        """Drops the *relation* of type *kind* (default table), in new transaction."""
+        with cls.borrowed_connection() as conn:
+            with conn.cursor() as cur:
+                if idempotent:
+                    cur.execute(f"DROP {kind} IF EXISTS {relation}")
+                else:
+                    cur.execute(f"DROP {kind} {relation}")
+            conn.commit()
@@ -4,8 +4,17 @@ Tests for postgres.py
 
 """
 
+import os
 import unittest
 
+from testgres.utils import get_bin_path
+
+# pylint:disable=protected-access,unbalanced-tuple-unpacking
+
+
+def _have_postgres():
+    return os.path.isfile(get_bin_path('postgres'))
+
 
 class TestBasic(unittest.TestCase):
 
@@ -13,5 +22,268 @@ class TestBasic(unittest.TestCase):
         from .. import postgres
         self.assertIsNotNone(postgres)
 
+
+class TestSharedNode(unittest.TestCase):
+
+    class Node(object):
+        host = 'localhost'
+        port = 5432
+        exited = False
+
+        def __init__(self):
+            self.databases = {'postgres'}
+            self.executed = []
+
+        def execute(self, query):
+            self.executed.append(query)
+            if query.startswith('SELECT'):
+                name = query.split("'")[1]
+                return [(1,)] if name in self.databases else []
+            self.databases.add(query.split('"')[1])
+            return None
+
+        def __exit__(self, *args):
+            self.exited = True
+
+    class Pool(object):
+        closed = False
+
+        def __init__(self, _minconn, _maxconn, dbname, **_kwargs):
+            self.dbname = dbname
+
+        def getconn(self):
+            from unittest import mock
+            conn = mock.MagicMock()
+            cursor = conn.cursor.return_value.__enter__.return_value
+            cursor.fetchone.return_value = {
+                'version': 'PostgreSQL', 'current_database': self.dbname,
+                'current_schema': 'public', 'Encoding': 'UTF8', 'Collate': 'C',
+            }
+            return conn
+
+        def putconn(self, conn):
+            pass
+
+        def closeall(self):
+            self.closed = True
+
+    def test_layers_share_node_and_pools(self):
+        import contextlib
+        import io
+        from unittest import mock
+        from .. import postgres
+
+        DatabaseLayer = postgres.DatabaseLayer
+        node = self.Node()
+
+        class AppLayer(DatabaseLayer):
+            DATABASE_NAME = 'app'
+            connection_pool_klass = self.Pool
+
+        class OtherAppLayer(DatabaseLayer):
+            DATABASE_NAME = 'app'
+            connection_pool_klass = self.Pool
+
+        with mock.patch.object(DatabaseLayer, '_start_node', return_value=node) as start, \
+             mock.patch.object(DatabaseLayer, 'connection_pool_klass', self.Pool), \
+             contextlib.redirect_stdout(io.StringIO()):
+            DatabaseLayer.setUp()
+            AppLayer.setUp()
+            OtherAppLayer.setUp()
+            start.assert_called_once_with()
+            self.assertIs(DatabaseLayer.postgres_node, node)
+            self.assertIs(AppLayer.postgres_node, node)
+
+            self.assertEqual(node.databases, {'postgres', 'app'})
+            self.assertEqual(
+                node.executed[-1],
+                'CREATE DATABASE "app" TEMPLATE "template1"'
+            )
+            self.assertEqual(DatabaseLayer.connection_pool.dbname, 'postgres')
+            self.assertEqual(AppLayer.connection_pool.dbname, 'app')
+            self.assertIs(AppLayer.connection_pool, OtherAppLayer.connection_pool)
+            self.assertIn('dbname=app', AppLayer.postgres_dsn)
+            self.assertIn('dbname=postgres', DatabaseLayer.postgres_dsn)
+
+            OtherAppLayer.tearDown()
+            AppLayer.tearDown()
+            self.assertFalse(node.exited)
+            app_pool = AppLayer.connection_pool
+            self.assertFalse(app_pool.closed)
+
+            DatabaseLayer.tearDown()
+            self.assertTrue(node.exited)
+            self.assertTrue(app_pool.closed)
+            self.assertIsNone(DatabaseLayer.postgres_node)
+            self.assertIsNone(DatabaseLayer.connection_pool)
+
+
+class TestExecuteCached(unittest.TestCase):
+
+    class Connection(object):
+        status = 0 # TRANSACTION_STATUS_IDLE
+        rolled_back = False
+        closed = 0
+
+        def get_transaction_status(self):
+            return self.status
+
+        def rollback(self):
+            self.rolled_back = True
+
+    class Cursor(object):
+
+        def __init__(self, connection=None):
+            self.connection = connection or TestExecuteCached.Connection()
+            self.executed = []
+            # Statements that fail, once.
+            self.fail = set()
+
+        def execute(self, sql, params=None):
+            self.executed.append((sql, params))
+            if sql in self.fail:
+                from psycopg2.errors import InvalidSqlStatementName
+                self.fail.remove(sql)
+                raise InvalidSqlStatementName
+
+    def setUp(self):
+        import weakref
+        from .. import postgres
+
+        class Layer(postgres.DatabaseLayer):
+            prepared_statement_cache_size = 2
+            _prepared_statements = weakref.WeakKeyDictionary()
+
+        self.layer = Layer
+
+    def test_numbered_placeholders(self):
+        from ..postgres import _numbered_placeholders
+        self.assertEqual(
+            _numbered_placeholders("SELECT * FROM t WHERE a = %s AND b LIKE 'x%%' OR c = %s"),
+            "SELECT * FROM t WHERE a = $1 AND b LIKE 'x%' OR c = $2"
+        )
+        with self.assertRaises(ValueError):
+            _numbered_placeholders('SELECT %(a)s')
+
+    def test_prepares_once(self):
+        cur = self.Cursor()
+        self.assertIs(self.layer.execute_cached('SELECT a FROM t WHERE b = %s', (1,), cur),
+                      cur)
+        self.layer.execute_cached('SELECT a FROM t WHERE b = %s', (2,), cur)
+        self.assertEqual(len(cur.executed), 3)
+        prepare, execute1, execute2 = cur.executed
+        name = prepare[0].split()[1]
+        self.assertEqual(prepare, (f'PREPARE {name} AS SELECT a FROM t WHERE b = $1', None))
+        self.assertEqual(execute1, (f'EXECUTE {name} (%s)', (1,)))
+        self.assertEqual(execute2, (f'EXECUTE {name} (%s)', (2,)))
+
+    def test_without_params(self):
+        cur = self.Cursor()
+        self.layer.execute_cached("SELECT COUNT(*) FROM t WHERE a LIKE '%s'", cursor=cur)
+        prepare, execute = cur.executed
+        name = prepare[0].split()[1]
+        self.assertEqual(prepare[0], f"PREPARE {name} AS SELECT COUNT(*) FROM t WHERE a LIKE '%s'")
+        self.assertEqual(execute, (f'EXECUTE {name}', None))
+
+    def test_lru(self):
+        cur = self.Cursor()
+        for sql in ('SELECT 1', 'SELECT 2', 'SELECT 1', 'SELECT 3'):
+            self.layer.execute_cached(sql, cursor=cur)
+        statements = [sql for sql, _ in cur.executed]
+        name2 = statements[2].split()[1]
+        self.assertEqual(statements[-2], f'DEALLOCATE {name2}')
+        self.assertEqual(len(statements), 8)
+        cache, = self.layer._prepared_statements.values()
+        self.assertEqual([sql for sql, _ in cache], ['SELECT 1', 'SELECT 3'])
+
+    def test_new_connection(self):
+        import gc
+        cur = self.Cursor()
+        self.layer.execute_cached('SELECT 1', cursor=cur)
+        del cur
+        gc.collect()
+        self.assertEqual(len(self.layer._prepared_statements), 0)
+        # A new connection prepares the statement again.
+        cur = self.Cursor()
+        self.layer.execute_cached('SELECT 1', cursor=cur)
+        self.assertEqual(cur.executed[0][0].split()[0], 'PREPARE')
+
+    def test_prepares_again_when_forgotten(self):
+        cur = self.Cursor()
+        self.layer.execute_cached('SELECT 1', cursor=cur)
+        name = cur.executed[0][0].split()[1]
+        cur.fail.add(f'EXECUTE {name}')
+        self.layer.execute_cached('SELECT 1', cursor=cur)
+        self.assertTrue(cur.connection.rolled_back)
+        statements = [sql for sql, _ in cur.executed]
+        self.assertEqual(len(statements), 5)
+        self.assertEqual(statements[3].split()[0], 'PREPARE')
+        new_name = statements[3].split()[1]
+        self.assertNotEqual(new_name, name)
+        self.assertEqual(statements[4], f'EXECUTE {new_name}')
+
+    def test_forgotten_in_transaction(self):
+        from psycopg2.errors import InvalidSqlStatementName
+        cur = self.Cursor()
+        self.layer.execute_cached('SELECT 1', cursor=cur)
+        name = cur.executed[0][0].split()[1]
+        cur.fail.add(f'EXECUTE {name}')
+        cur.connection.status = 2 # TRANSACTION_STATUS_INTRANS
+        with self.assertRaises(InvalidSqlStatementName):
+            self.layer.execute_cached('SELECT 1', cursor=cur)
+        self.assertFalse(cur.connection.rolled_back)
+
+    def test_forget_closed_connections(self):
+        open_cur = self.Cursor()
+        closed_cur = self.Cursor()
+        self.layer.execute_cached('SELECT 1', cursor=open_cur)
+        self.layer.execute_cached('SELECT 1', cursor=closed_cur)
+        closed_cur.connection.closed = 1
+        self.layer._forget_closed_connections()
+        self.assertEqual(list(self.layer._prepared_statements),
+                         [open_cur.connection])
+        # Still prepared.
+        self.layer.execute_cached('SELECT 1', cursor=open_cur)
+        self.assertEqual(len(open_cur.executed), 3)
+
+
+@unittest.skipUnless(_have_postgres(), 'Postgres is not installed')
+class TestExecuteCachedLive(unittest.TestCase):
+
+    def _execute(self, layer):
+        layer.testSetUp()
+        try:
+            cur = layer.execute_cached('SELECT %s::int AS x', (42,))
+            self.assertEqual(cur.fetchone()[0], 42)
+            cur = layer.execute_cached('SELECT %s::int AS x', (43,))
+            self.assertEqual(cur.fetchone()[0], 43)
+            layer.cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+            # Prepared once for the connection, and then reused.
+            self.assertEqual(layer.cursor.fetchone()[0], 1)
+        finally:
+            layer.testTearDown()
+
+    def test_prepare_push_pop(self):
+        import contextlib
+        import io
+        from ..postgres import DatabaseBackupLayerHelper
+        from ..postgres import DatabaseLayer
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            DatabaseLayer.setUp()
+        self.addCleanup(DatabaseLayer.tearDown)
+
+        self._execute(DatabaseLayer)
+        DatabaseBackupLayerHelper.push(DatabaseLayer)
+        try:
+            # New connections to the new node.
+            self._execute(DatabaseLayer)
+        finally:
+            DatabaseBackupLayerHelper.pop(DatabaseLayer)
+        # Back to the connections of the first node, which still
+        # have their statements.
+        self._execute(DatabaseLayer)
+
+
 if __name__ == '__main__':
     unittest.main()
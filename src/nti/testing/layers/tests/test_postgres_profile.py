@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for postgres_profile.py
+
+"""
+
+import unittest
+
+
+class TestNodeResourceProfiler(unittest.TestCase):
+
+    def test_profile_own_process(self):
+        import os
+        from ..postgres_profile import NodeResourceProfiler
+
+        stats = iter([
+            {'xact_commit': 1, 'xact_rollback': 0, 'blks_read': 2,
+             'blks_hit': 3, 'temp_bytes': 0},
+            {'xact_commit': 5, 'xact_rollback': 1, 'blks_read': 2,
+             'blks_hit': 10, 'temp_bytes': 1024},
+        ])
+
+        profiler = NodeResourceProfiler(os.getpid(), lambda: next(stats), 'Layer')
+        profiler.interval = 0.01
+        profiler.start()
+        sum(range(100000))
+        result = profiler.stop()
+
+        self.assertEqual(result['label'], 'Layer')
+        self.assertGreaterEqual(result['cpu'], 0)
+        self.assertGreater(result['peak_rss'], 0)
+        self.assertEqual(result['xact_commit'], 4)
+        self.assertEqual(result['blks_hit'], 7)
+        self.assertEqual(result['temp_bytes'], 1024)
+
+        summary = NodeResourceProfiler.format_summary(result)
+        self.assertTrue(summary.startswith('(Layer pg: cpu '), summary)
+        self.assertIn('blks hit/read 7/0', summary)
+
+    def test_follows_replaced_postmaster(self):
+        import subprocess
+        import sys
+
+        with subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']) as child:
+            try:
+                self._check_follows_replaced_postmaster(child.pid)
+            finally:
+                child.kill()
+
+    def _check_follows_replaced_postmaster(self, child_pid):
+        import os
+        import time
+        from ..postgres_profile import NodeResourceProfiler
+
+        pids = [os.getpid()]
+        stats = iter([{'xact_commit': 10}, {'xact_commit': 3}])
+        profiler = NodeResourceProfiler(lambda: pids[0], lambda: next(stats))
+        profiler.interval = 3600
+        profiler.start()
+        self.assertEqual(profiler.pid, os.getpid())
+        begin = time.process_time()
+        while time.process_time() - begin < 0.05:
+            pass
+        profiler._sample() # pylint:disable=protected-access
+
+        # Between nodes, nothing is sampled.
+        pids[0] = 0
+        profiler._sample() # pylint:disable=protected-access
+        self.assertEqual(profiler.pid, os.getpid())
+
+        pids[0] = child_pid
+        result = profiler.stop()
+        self.assertEqual(profiler.pid, child_pid)
+        # The CPU used by the first postmaster is kept.
+        self.assertGreaterEqual(result['cpu'], 0.04)
+        # The counters are those of the new node.
+        self.assertEqual(result['xact_commit'], 3)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
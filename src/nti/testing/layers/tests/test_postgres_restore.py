@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for postgres_restore.py
+
+"""
+
+import os
+import unittest
+
+from .test_postgres import _have_postgres
+
+# pylint:disable=protected-access
+
+
+class TestPop(unittest.TestCase):
+
+    class Node(object):
+        host = 'localhost'
+
+        def __init__(self, port, data_dir=None):
+            self.port = port
+            self.data_dir = data_dir
+            self.conf = []
+            self.exited = False
+
+        def append_conf(self, line):
+            self.conf.append(line)
+
+        def start(self):
+            pass
+
+        def poll_query_until(self, query, sleep_time):
+            pass
+
+        def __exit__(self, *args):
+            self.exited = True
+
+    class Pool(object):
+        closed = False
+
+        def __init__(self, _minconn, _maxconn, dbname, port, **_kwargs):
+            self.dbname = dbname
+            self.port = port
+
+        def getconn(self):
+            from unittest import mock
+            if self.closed:
+                raise AssertionError('Pool is closed')
+            return mock.MagicMock()
+
+        def putconn(self, conn):
+            pass
+
+        def closeall(self):
+            self.closed = True
+
+    def test_pop_replaces_pools_and_connection_strings(self):
+        import shutil
+        import tempfile
+        from unittest import mock
+        from ..postgres import DatabaseLayer
+        from ..postgres_restore import DatabaseRestorePointLayerHelper as Helper
+
+        class AppLayer(DatabaseLayer):
+            DATABASE_NAME = 'app'
+            connection_pool_klass = self.Pool
+
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        old_node = self.Node(5432)
+        new_node = self.Node(5433, data_dir)
+        backup = mock.Mock()
+        backup.spawn_primary.return_value = new_node
+        old_pools = {
+            'postgres': self.Pool(1, 1, 'postgres', 5432),
+            'app': self.Pool(1, 1, 'app', 5432),
+            'other': self.Pool(1, 1, 'other', 5432),
+        }
+
+        with mock.patch.multiple(DatabaseLayer,
+                                 postgres_node=old_node,
+                                 connection_pool=old_pools['postgres'],
+                                 _connection_pools=old_pools,
+                                 postgres_dsn=None,
+                                 postgres_uri=None,
+                                 connection_pool_klass=self.Pool), \
+             mock.patch.multiple(AppLayer,
+                                 connection_pool=old_pools['app'],
+                                 create=True), \
+             mock.patch.multiple(Helper,
+                                 _base_backup=backup,
+                                 _archive_dir=tempfile.mkdtemp(),
+                                 _restore_points=['0/1']):
+            Helper.pop(AppLayer)
+
+            self.assertTrue(old_node.exited)
+            self.assertIn("recovery_target_lsn = '0/1'", new_node.conf)
+            self.assertTrue(os.path.exists(os.path.join(data_dir, 'recovery.signal')))
+            self.assertIs(DatabaseLayer.postgres_node, new_node)
+
+            pools = DatabaseLayer._connection_pools
+            self.assertEqual(sorted(pools), ['app', 'other', 'postgres'])
+            for name, pool in pools.items():
+                self.assertTrue(old_pools[name].closed)
+                self.assertEqual(pool.dbname, name)
+                self.assertEqual(pool.port, 5433)
+
+            self.assertIs(DatabaseLayer.connection_pool, pools['postgres'])
+            self.assertIs(AppLayer.connection_pool, pools['app'])
+            self.assertIn('port=5433', DatabaseLayer.postgres_dsn)
+            self.assertIn(':5433/', DatabaseLayer.postgres_uri)
+            self.assertIn('dbname=app port=5433', AppLayer.postgres_dsn)
+            self.assertEqual(AppLayer.postgres_uri, 'postgresql://localhost:5433/app')
+
+            # The last pop cleans up.
+            self.assertIsNone(Helper._base_backup)
+            self.assertIsNone(Helper._archive_dir)
+            backup.cleanup.assert_called_once_with()
+
+    def test_pop_replaces_pools_of_intermediate_layers(self):
+        import shutil
+        import tempfile
+        from unittest import mock
+        from ..postgres import DatabaseLayer
+        from ..postgres_restore import DatabaseRestorePointLayerHelper as Helper
+
+        class AppLayer(DatabaseLayer):
+            DATABASE_NAME = 'app'
+            connection_pool_klass = self.Pool
+
+        class SubLayer(AppLayer):
+            # This is the one that uses the helper; the connection pool of
+            # AppLayer is set up, but it isn't given to the helper.
+            pass
+
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        new_node = self.Node(5433, data_dir)
+        backup = mock.Mock()
+        backup.spawn_primary.return_value = new_node
+        old_pools = {
+            'postgres': self.Pool(1, 1, 'postgres', 5432),
+            'app': self.Pool(1, 1, 'app', 5432),
+        }
+
+        with mock.patch.multiple(DatabaseLayer,
+                                 postgres_node=self.Node(5432),
+                                 connection_pool=old_pools['postgres'],
+                                 _connection_pools=old_pools,
+                                 postgres_dsn=None,
+                                 postgres_uri=None,
+                                 connection_pool_klass=self.Pool), \
+             mock.patch.multiple(AppLayer,
+                                 connection_pool=old_pools['app'],
+                                 create=True), \
+             mock.patch.multiple(SubLayer,
+                                 connection_pool=old_pools['app'],
+                                 create=True), \
+             mock.patch.multiple(Helper,
+                                 _base_backup=backup,
+                                 _archive_dir=tempfile.mkdtemp(),
+                                 _restore_points=['0/1']):
+            Helper.pop(SubLayer)
+
+            app_pool = DatabaseLayer._connection_pools['app']
+            self.assertIsNot(app_pool, old_pools['app'])
+            self.assertIs(SubLayer.connection_pool, app_pool)
+            self.assertIs(AppLayer.connection_pool, app_pool)
+            self.assertIn('port=5433', AppLayer.postgres_dsn)
+            # zope.testrunner still runs this for each test of SubLayer.
+            AppLayer.testSetUp()
+            AppLayer.testTearDown()
+
+
+@unittest.skipUnless(_have_postgres(), 'Postgres is not installed')
+class TestRoundTrip(unittest.TestCase):
+
+    def _query(self, sql):
+        from ..postgres import DatabaseLayer
+        with DatabaseLayer.borrowed_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+                rows = cur.fetchall() if cur.description else None
+            conn.commit()
+        return rows
+
+    def test_push_write_pop(self):
+        import contextlib
+        import io
+        from ..postgres import DatabaseLayer
+        from ..postgres_restore import DatabaseRestorePointLayerHelper as Helper
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            DatabaseLayer.setUp()
+        self.addCleanup(DatabaseLayer.tearDown)
+
+        self._query('CREATE TABLE things (id integer)')
+        Helper.push(DatabaseLayer)
+        self._query('INSERT INTO things VALUES (1)')
+        Helper.push(DatabaseLayer)
+        self._query('INSERT INTO things VALUES (2)')
+        self.assertEqual(len(self._query('SELECT * FROM things')), 2)
+
+        Helper.pop(DatabaseLayer)
+        self.assertEqual([tuple(r) for r in self._query('SELECT * FROM things')],
+                         [(1,)])
+        self.assertIn('port=%s' % DatabaseLayer.postgres_node.port,
+                      DatabaseLayer.postgres_dsn)
+
+        Helper.pop(DatabaseLayer)
+        self.assertEqual(self._query('SELECT * FROM things'), [])
+        self.assertIsNone(Helper._base_backup)
+
+
+if __name__ == '__main__':
+    unittest.main()
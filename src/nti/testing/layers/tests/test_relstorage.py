@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for relstorage.py
+
+"""
+
+import unittest
+from unittest import mock
+
+try:
+    from ZODB.MappingStorage import MappingStorage
+    from nti.testing import zodb
+    from .. import relstorage
+except ModuleNotFoundError as ex:
+    assert ex.name == 'ZODB'
+    relstorage = None
+    MappingStorage = object
+
+# pylint:disable=protected-access
+
+
+class Storage(MappingStorage):
+    # Stands in for RelStorage.
+
+    zapped = 0
+
+    def zap_all(self):
+        self.zapped += 1
+        MappingStorage.__init__(self)
+
+
+class Test(object):
+
+    def __init__(self, layer, test_id):
+        self.layer = layer
+        self._id = test_id
+
+    def id(self):
+        return self._id
+
+
+class TestRelStorageLayerMixin(unittest.TestCase):
+
+    def setUp(self):
+        if relstorage is None:
+            self.skipTest("ZODB not installed")
+
+        storages = self.storages = []
+
+        class Layer(relstorage.RelStorageLayerMixin):
+            report_limit = 1
+
+            _use_database = mock.Mock()
+
+            @classmethod
+            def create_storage(cls):
+                storages.append(Storage())
+                return storages[-1]
+
+        self.Layer = Layer
+
+    def _run_test(self, test, body):
+        zodb.ZODBLayer.testSetUp(test)
+        self.Layer.testSetUpRelStorage(test)
+        try:
+            with zodb.mock_db_trans() as conn:
+                body(conn)
+        finally:
+            self.Layer.testTearDownRelStorage(test)
+            zodb.ZODBLayer.testTearDown()
+
+    def test_snapshot(self):
+        from ZODB.interfaces import IDatabase
+        from zope import component
+        Layer = self.Layer
+
+        Layer.setUpRelStorage()
+        try:
+            Layer._use_database.assert_called_once_with()
+            self.assertIs(component.getUtility(IDatabase), zodb.ZODBLayer.db)
+            self.assertIs(zodb.ZODBLayer.db.storage, self.storages[0])
+            self.assertEqual(self.storages[0].zapped, 1)
+
+            def write(conn):
+                conn.root()['key'] = 42
+            self._run_test(Test(Layer, 'write'), write)
+
+            def read(conn):
+                self.assertNotIn('key', conn.root())
+            self._run_test(Test(Layer, 'read'), read)
+
+            self.assertEqual(len(self.storages), 1)
+            self.assertEqual(Layer.test_statistics['write']['stores'], 1)
+            self.assertEqual(Layer.test_statistics['read']['stores'], 0)
+            self.assertGreater(Layer.test_statistics['read']['loads'], 0)
+        finally:
+            with mock.patch('builtins.print') as print_:
+                Layer.tearDownRelStorage()
+        self.assertIsNone(zodb.ZODBLayer.db)
+        # Only the busiest test.
+        self.assertEqual(print_.call_count, 3)
+        self.assertIn('write', print_.call_args[0][0])
+
+    def test_truncate(self):
+        Layer = self.Layer
+
+        class Sub(Layer):
+            isolate_tests = False
+            truncate_tests = True
+
+        Layer.setUpRelStorage()
+        try:
+            def write(conn):
+                conn.root()['key'] = 42
+            self._run_test(Test(Sub, 'write'), write)
+            self.assertEqual(len(self.storages), 2)
+            self.assertIs(zodb.ZODBLayer.db.storage, self.storages[1])
+
+            def read(conn):
+                self.assertNotIn('key', conn.root())
+            self._run_test(Test(Sub, 'read'), read)
+        finally:
+            Layer.report_limit = 0
+            Layer.tearDownRelStorage()
+        self.assertEqual(len(self.storages), 3)
+
+    def test_cache_stats(self):
+        Layer = self.Layer
+        Layer.setUpRelStorage()
+        try:
+            cache = self.storages[0]._cache = mock.Mock()
+            cache.stats.return_value = {'hits': 1, 'misses': 2, 'ratio': 0.5}
+            test = Test(Layer, 'test')
+            Layer.testSetUpRelStorage(test)
+            cache.stats.return_value = {'hits': 4, 'misses': 2, 'ratio': 0.5}
+            Layer.testTearDownRelStorage(test)
+            self.assertEqual(
+                Layer.test_statistics['test'],
+                {'loads': 0, 'stores': 0, 'cache_hits': 3, 'cache_misses': 0}
+            )
+        finally:
+            Layer.report_limit = 0
+            Layer.tearDownRelStorage()
+
+    def test_layer_methods(self):
+        for meth in 'setUp', 'tearDown', 'testSetUp', 'testTearDown':
+            getattr(self.Layer, meth)()
+
+
+class TestSQLiteRelStorage(unittest.TestCase):
+    # A real RelStorage, using SQLite so no server is needed.
+
+    def setUp(self):
+        if relstorage is None:
+            self.skipTest("ZODB not installed")
+        try:
+            # pylint:disable=import-error
+            from relstorage.adapters.sqlite.adapter import Sqlite3Adapter
+            from relstorage.options import Options
+            from relstorage.storage import RelStorage
+        except ImportError:
+            self.skipTest("RelStorage not installed")
+
+        import shutil
+        import tempfile
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+
+        class Layer(relstorage.RelStorageLayerMixin):
+            report_limit = 0
+            _use_database = mock.Mock()
+
+            @classmethod
+            def create_storage(cls):
+                options = Options(**cls.relstorage_options)
+                return RelStorage(Sqlite3Adapter(data_dir, {}, options=options),
+                                  options=options)
+
+        self.Layer = Layer
+
+    _run_test = TestRelStorageLayerMixin._run_test
+
+    def _committed_root(self):
+        # What's in the RelStorage itself, read by a new storage
+        # instance.
+        import ZODB
+        db = ZODB.DB(self.Layer.create_storage())
+        try:
+            with zodb.mock_db_trans(db) as conn:
+                return dict(conn.root())
+        finally:
+            db.close()
+
+    def test_isolated_write(self):
+        Layer = self.Layer
+        Layer.setUpRelStorage()
+        try:
+            with zodb.mock_db_trans() as conn:
+                conn.root()['layer'] = 1
+
+            def write(conn):
+                conn.root()['key'] = 42
+                conn.root()['layer'] = 2
+            self._run_test(Test(Layer, 'write'), write)
+
+            def read(conn):
+                self.assertNotIn('key', conn.root())
+                self.assertEqual(conn.root()['layer'], 1)
+            self._run_test(Test(Layer, 'read'), read)
+
+            self.assertEqual(Layer.test_statistics['write']['stores'], 1) # pylint:disable=unsubscriptable-object
+            self.assertEqual(self._committed_root(), {'layer': 1})
+        finally:
+            Layer.tearDownRelStorage()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for sqlite.py
+
+"""
+
+import sqlite3
+import unittest
+from unittest import mock
+
+from ..sqlite import SQLiteDatabaseLayer
+from ..sqlite import _translate_placeholders
+from ..postgres import DatabaseTestCase
+
+
+class TestTranslatePlaceholders(unittest.TestCase):
+
+    def test_translate(self):
+        self.assertEqual(
+            _translate_placeholders('SELECT * FROM t WHERE a = %s AND b = %s'),
+            'SELECT * FROM t WHERE a = ? AND b = ?'
+        )
+        self.assertEqual(
+            _translate_placeholders("SELECT %(a)s, 'x%%'"),
+            "SELECT :a, 'x%'"
+        )
+
+
+class TestSQLiteDatabaseLayer(unittest.TestCase):
+
+    layer = SQLiteDatabaseLayer
+
+    def setUp(self):
+        with self.layer.borrowed_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('CREATE TABLE things (id INTEGER PRIMARY KEY, name TEXT)')
+                cur.executemany('INSERT INTO things (name) VALUES (%s)',
+                                [('a',), ('b',)])
+            conn.commit()
+
+    def tearDown(self):
+        self.layer.drop_relation('things', idempotent=True)
+
+    def test_cursor(self):
+        cur = self.layer.cursor
+        cur.execute('SELECT id, name FROM things WHERE name = %(name)s',
+                    {'name': 'b'})
+        row = cur.fetchone()
+        self.assertEqual(row[1], 'b')
+        self.assertEqual(dict(row), {'id': 2, 'name': 'b'})
+
+        # Without parameters, percent signs are literal.
+        cur.execute("SELECT COUNT(*) FROM things WHERE name LIKE '%'")
+        self.assertEqual(cur.fetchone()[0], 2)
+
+    def test_execute_cached(self):
+        cur = self.layer.execute_cached('SELECT name FROM things WHERE id = %s', (1,))
+        self.assertEqual(cur.fetchone()[0], 'a')
+
+    def test_dsn(self):
+        conn = sqlite3.connect(self.layer.postgres_dsn, uri=True)
+        try:
+            count = conn.execute('SELECT COUNT(*) FROM things').fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(count, 2)
+        self.assertIn(self.layer.postgres_dsn, self.layer.postgres_uri)
+
+    def test_truncate_table(self):
+        conn = self.layer.connection
+        self.layer.truncate_table(conn, 'things')
+        self.layer.cursor.execute('SELECT COUNT(*) FROM things')
+        self.assertEqual(self.layer.cursor.fetchone()[0], 0)
+
+        with mock.patch('traceback.print_exc') as print_exc:
+            self.layer.truncate_table(conn, 'no_such_table')
+        print_exc.assert_called_once_with()
+
+    def test_autocommit(self):
+        with self.layer.borrowed_connection() as conn:
+            self.assertFalse(conn.autocommit)
+            conn.autocommit = True
+            self.assertTrue(conn.autocommit)
+            conn.autocommit = False
+
+    def test_pool(self):
+        pool = self.layer.connection_pool_klass(0, 1, self.layer.postgres_dsn)
+        conn = pool.getconn()
+        with self.assertRaises(sqlite3.OperationalError):
+            pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        pool.closeall()
+        with self.assertRaises(sqlite3.InterfaceError):
+            pool.getconn()
+        with self.assertRaises(sqlite3.InterfaceError):
+            pool.putconn(conn)
+
+
+class TestDatabaseTestCase(DatabaseTestCase):
+
+    layer = SQLiteDatabaseLayer
+
+    def setUp(self):
+        with self.layer.borrowed_connection() as conn:
+            conn.execute('CREATE TABLE things (id INTEGER PRIMARY KEY)')
+            conn.commit()
+
+    def tearDown(self):
+        self.layer.drop_relation('things')
+
+    def test_helpers(self):
+        cur = self.layer.cursor
+        cur.execute('INSERT INTO things VALUES (1)')
+        self.assert_row_count_in_cursor(1)
+        self.assert_row_count_in_table(1, 'things')
+        with self.assertRaisesIntegrityError('UNIQUE'):
+            cur.execute('INSERT INTO things VALUES (1)')
+        # That rolled back.
+        self.assert_row_count_in_table(0, 'things')
+
+
+if __name__ == '__main__':
+    unittest.main()
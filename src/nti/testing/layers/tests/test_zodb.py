@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for zodb.py
+
+"""
+
+import unittest
+from unittest import mock
+
+try:
+    from nti.testing import zodb
+    from .. import zodb as layers_zodb
+except ModuleNotFoundError as ex:
+    assert ex.name == 'ZODB'
+    zodb = layers_zodb = None
+
+# pylint:disable=protected-access
+
+
+class TestMultiDatabaseLayerMixin(unittest.TestCase):
+
+    if zodb is not None:
+        layer = zodb.ZODBLayer
+
+    def setUp(self):
+        super().setUp()
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+
+    def test_multi_database(self):
+        from ZODB.interfaces import IDatabase
+        from zope import component
+        from persistent.mapping import PersistentMapping
+        layer = self.layer
+
+        class Layer(layers_zodb.MultiDatabaseLayerMixin):
+            DATABASE_NAMES = ('catalog', 'session')
+
+        layer.testTearDown()
+        Layer.setUpDatabases()
+        try:
+            base_catalog = layer.db.databases['catalog']
+            self.assertIs(component.getUtility(IDatabase, 'catalog'), base_catalog)
+            layer.testSetUp(self)
+            catalog = component.getUtility(IDatabase, 'catalog')
+            self.assertIsNot(catalog, base_catalog)
+            self.assertIs(layer.db.databases['catalog'], catalog)
+            self.assertIs(catalog.databases, layer.db.databases)
+
+            with zodb.mock_db_trans(database_name='catalog') as conn:
+                self.assertIs(conn.db(), catalog)
+                conn.root()['index'] = PersistentMapping()
+            with zodb.mock_db_trans() as conn:
+                index = conn.get_connection('catalog').root()['index']
+                conn.root()['index'] = index
+            with zodb.mock_db_trans() as conn:
+                index = conn.root()['index']
+                self.assertEqual(index._p_jar.db().database_name, 'catalog')
+
+            layer.testTearDown()
+            self.assertIs(component.getUtility(IDatabase, 'catalog'), base_catalog)
+            self.assertIs(component.getUtility(IDatabase), layer.db)
+            with zodb.mock_db_trans(database_name='catalog') as conn:
+                self.assertNotIn('index', conn.root())
+        finally:
+            Layer.tearDownDatabases()
+            layer.testSetUp(self)
+        self.assertIsNone(component.queryUtility(IDatabase, 'catalog'))
+        self.assertEqual(list(layer.db.databases), [layer.db.database_name])
+        for meth in 'setUp', 'tearDown', 'testSetUp', 'testTearDown':
+            getattr(Layer, meth)()
+
+
+class TestBlobLayerMixin(unittest.TestCase):
+
+    if zodb is not None:
+        layer = zodb.ZODBLayer
+
+    def setUp(self):
+        super().setUp()
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+
+    def test_blobs(self):
+        import os
+        import tempfile
+        import shutil
+        from ZODB.blob import Blob
+        layer = self.layer
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        class Layer(layers_zodb.BlobLayerMixin):
+            BLOB_DIR_ROOT = root
+
+        def write(key, data):
+            with zodb.mock_db_trans() as conn:
+                blob = conn.root()[key] = Blob()
+                with blob.open('w') as f:
+                    f.write(data)
+
+        def read(key):
+            with zodb.mock_db_trans() as conn:
+                with conn.root()[key].open() as f:
+                    return f.read()
+
+        layer.testTearDown()
+        base_db = layer.db
+        Layer.setUpBlobs()
+        try:
+            self.assertIsNot(layer.db, base_db)
+            blob_dir = layer.blob_dir
+            self.assertEqual(os.path.dirname(blob_dir), root)
+            # Blobs committed by the layer are visible to the tests.
+            write('layer', b'layer')
+
+            layer.testSetUp(self)
+            self.assertEqual(read('layer'), b'layer')
+            write('test', b'data')
+            write('test', b'more data')
+            self.assertEqual(read('test'), b'more data')
+            self.assertEqual(len(os.listdir(blob_dir)), 2)
+            layer.testTearDown()
+            # The test's blobs are gone.
+            self.assertEqual(os.listdir(blob_dir), ['layer'])
+            self.assertEqual(layer.blob_bytes_written, 13)
+        finally:
+            with mock.patch('builtins.print') as print_:
+                Layer.tearDownBlobs()
+            layer.testSetUp(self)
+        self.assertIs(layer._base_db, base_db)
+        print_.assert_called_once_with('(blobs: 13 bytes) ', end='')
+        self.assertFalse(os.path.exists(blob_dir))
+        self.assertIsNone(layer.blob_dir)
+        self.assertEqual(layer.blob_bytes_written, 0)
+        for meth in 'setUp', 'tearDown', 'testSetUp', 'testTearDown':
+            getattr(Layer, meth)()
+
+    def test_blob_dir_root(self):
+        class Layer(layers_zodb.BlobLayerMixin):
+            pass
+        with mock.patch.dict('os.environ', {'NTI_ZODB_BLOB_DIR': '/blobs'}):
+            self.assertEqual(Layer.blob_dir_root(), '/blobs')
+        with mock.patch('os.access', return_value=False):
+            with mock.patch.dict('os.environ', {}, clear=True):
+                import tempfile
+                self.assertEqual(Layer.blob_dir_root(), tempfile.gettempdir())
+
+
+class TestFileStorageFixtureLayerMixin(unittest.TestCase):
+
+    def setUp(self):
+        if layers_zodb is None:
+            self.skipTest("ZODB not installed")
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def test_fixture_cached(self):
+        import os
+        populated = []
+
+        class Layer(layers_zodb.FileStorageFixtureLayerMixin):
+            FIXTURE_VERSION = 1
+            FIXTURE_CACHE_DIR = self.cache_dir
+
+            @classmethod
+            def populate_fixture(cls, db):
+                populated.append(cls.FIXTURE_VERSION)
+                with zodb.mock_db_trans(db) as conn:
+                    conn.root()['key'] = cls.FIXTURE_VERSION
+
+        def check(version):
+            Layer.setUpFixture()
+            try:
+                from ZODB.interfaces import IDatabase
+                from zope import component
+                self.assertIs(component.getUtility(IDatabase), zodb.ZODBLayer.db)
+                with zodb.mock_db_trans() as conn:
+                    self.assertEqual(conn.root()['key'], version)
+                    # Changes don't get written to the file.
+                    conn.root()['key'] = -1
+            finally:
+                Layer.tearDownFixture()
+            self.assertIsNone(zodb.ZODBLayer.db)
+
+        check(1)
+        check(1)
+        self.assertEqual(populated, [1])
+        first_path = Layer.fixture_path()
+        self.assertTrue(os.path.exists(first_path))
+
+        Layer.FIXTURE_VERSION = 2
+        # Another process is building this version.
+        building = Layer.fixture_path() + '.99999'
+        with open(building, 'wb'):
+            pass
+        check(2)
+        self.assertEqual(populated, [1, 2])
+        self.assertFalse(os.path.exists(first_path))
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            sorted([os.path.basename(Layer.fixture_path()),
+                    os.path.basename(Layer.fixture_path()) + '.index',
+                    os.path.basename(building)])
+        )
+
+    def test_populate_required(self):
+        class Layer(layers_zodb.FileStorageFixtureLayerMixin): # pylint:disable=abstract-method
+            FIXTURE_CACHE_DIR = self.cache_dir
+
+        with self.assertRaises(NotImplementedError):
+            Layer.setUpFixture()
+        for meth in 'setUp', 'tearDown', 'testSetUp', 'testTearDown':
+            getattr(Layer, meth)()
+
+    def test_populate_failure(self):
+        import os
+
+        class Layer(layers_zodb.FileStorageFixtureLayerMixin):
+            FIXTURE_CACHE_DIR = self.cache_dir
+
+            @classmethod
+            def populate_fixture(cls, db):
+                with zodb.mock_db_trans(db) as conn:
+                    conn.root()['key'] = 1
+                raise KeyError('populate')
+
+        with self.assertRaises(KeyError):
+            Layer.setUpFixture()
+        # The partial fixture is gone.
+        self.assertEqual(os.listdir(self.cache_dir), [])
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Mixins for layers extending :class:`~nti.testing.zodb.ZODBLayer` that
+change its database: to make it part of a multi-database, to keep its
+blobs in a memory-backed directory, or to open a fixture saved in a
+file.
+
+.. versionadded:: 4.5.0
+"""
+
+import glob
+import hashlib
+import inspect
+import os
+import shutil
+import tempfile
+
+import ZODB
+from ZODB.interfaces import IDatabase
+from ZODB.DemoStorage import DemoStorage
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.blob import BlobStorage
+from zope import component
+
+from ..zodb import ZODBLayer
+
+__all__ = [
+    'MultiDatabaseLayerMixin',
+    'BlobLayerMixin',
+    'FileStorageFixtureLayerMixin',
+]
+
+
+class MultiDatabaseLayerMixin(object):
+    """
+    Mix this in to a layer extending
+    :class:`~nti.testing.zodb.ZODBLayer` to make
+    :attr:`~nti.testing.zodb.ZODBLayer.db` part of a multi-database.
+    Set :attr:`DATABASE_NAMES`, and call :meth:`setUpDatabases` from
+    your ``setUp`` method and :meth:`tearDownDatabases` from your
+    ``tearDown`` method.
+
+    Each of the named databases uses its own
+    :class:`~ZODB.DemoStorage.DemoStorage` and is in the
+    :attr:`~ZODB.DB.databases` mapping of
+    :attr:`~nti.testing.zodb.ZODBLayer.db`, so objects can refer to
+    objects in other databases. Each is
+    registered as the :class:`~ZODB.interfaces.IDatabase` utility of
+    that name.
+
+    Open a specific database with ``mock_db_trans(database_name=name)``,
+    or by using :meth:`ZODB.Connection.Connection.get_connection`.
+    Tests are isolated in all the databases.
+
+    .. versionadded:: 4.5.0
+    """
+
+    #: The names of the databases to add.
+    DATABASE_NAMES = ()
+
+    @classmethod
+    def setUp(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def tearDown(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def testSetUp(cls):
+        pass
+
+    @classmethod
+    def testTearDown(cls):
+        pass
+
+    @classmethod
+    def create_storage(cls, name): # pylint:disable=unused-argument
+        """
+        Return the storage for the database *name*.
+        """
+        return DemoStorage(name=name)
+
+    @classmethod
+    def setUpDatabases(cls):
+        """
+        Create the databases.
+        """
+        databases = ZODBLayer.db.databases
+        gsm = component.getGlobalSiteManager()
+        for name in cls.DATABASE_NAMES:
+            db = ZODB.DB(cls.create_storage(name), database_name=name, databases=databases)
+            gsm.registerUtility(db, IDatabase, name=name)
+
+    @classmethod
+    def tearDownDatabases(cls):
+        """
+        Close and unregister the databases.
+        """
+        databases = ZODBLayer.db.databases
+        gsm = component.getGlobalSiteManager()
+        for name in cls.DATABASE_NAMES:
+            db = databases.pop(name)
+            if gsm.queryUtility(IDatabase, name=name) is db:
+                gsm.unregisterUtility(db, IDatabase, name=name)
+            db.close()
+
+
+class BlobLayerMixin(object):
+    """
+    Mix this in to a layer extending
+    :class:`~nti.testing.zodb.ZODBLayer` whose tests use many or large
+    :class:`ZODB.blob.Blob` objects, and call
+    :meth:`setUpBlobs` from your ``setUp`` method and
+    :meth:`tearDownBlobs` from your ``tearDown`` method.
+
+    A plain :class:`~ZODB.DemoStorage.DemoStorage` already supports
+    blobs, but keeps them in a new directory of the system temporary
+    directory that is only removed when the storage is garbage
+    collected. With this mixin, the blobs of the layer, and of each test,
+    are kept in a directory in :attr:`BLOB_DIR_ROOT`, which is a
+    memory-backed ``tmpfs`` if one is available. The blobs of each test are
+    removed when it finishes, and the whole directory when the layer is
+    torn down, at which point the number of bytes of blobs committed by
+    the tests (:attr:`~nti.testing.zodb.ZODBLayer.blob_bytes_written`)
+    is printed.
+
+    .. versionadded:: 4.5.0
+    """
+
+    #: The directory in which to create the blob directory. If not
+    #: set, the ``NTI_ZODB_BLOB_DIR`` environment variable is used,
+    #: and if that's not set, ``/dev/shm`` if it is writable, and
+    #: finally the system temporary directory.
+    BLOB_DIR_ROOT = None
+
+    _previous_db = None
+    _previous_blob_dir = None
+
+    @classmethod
+    def setUp(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def tearDown(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def testSetUp(cls):
+        pass
+
+    @classmethod
+    def testTearDown(cls):
+        pass
+
+    @classmethod
+    def blob_dir_root(cls):
+        """
+        Return the directory in which to create the blob directory.
+        """
+        root = cls.BLOB_DIR_ROOT or os.environ.get('NTI_ZODB_BLOB_DIR')
+        if not root and os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            root = '/dev/shm'
+        return root or tempfile.gettempdir()
+
+    @classmethod
+    def setUpBlobs(cls):
+        """
+        Create the blob directory, and install a database using it on top
+        of :attr:`~nti.testing.zodb.ZODBLayer.db`.
+        """
+        blob_dir = tempfile.mkdtemp(prefix='nti.testing.blobs-', dir=cls.blob_dir_root())
+        previous = cls._previous_db = ZODBLayer.db
+        storage = DemoStorage(
+            base=previous.storage,
+            changes=BlobStorage(os.path.join(blob_dir, 'layer'), MappingStorage()),
+            close_base_on_close=False,
+        )
+        db = ZODBLayer.db = ZODB.DB(storage, database_name=previous.database_name)
+        component.getGlobalSiteManager().registerUtility(db, IDatabase)
+        cls._previous_blob_dir = ZODBLayer.blob_dir
+        ZODBLayer.blob_dir = blob_dir
+        ZODBLayer.blob_bytes_written = 0
+
+    @classmethod
+    def tearDownBlobs(cls):
+        """
+        Close the database, restore the previous
+        :attr:`~nti.testing.zodb.ZODBLayer.db`, remove the blob
+        directory and print the bytes written.
+        """
+        db = ZODBLayer.db
+        previous = ZODBLayer.db = cls._previous_db
+        cls._previous_db = None
+        gsm = component.getGlobalSiteManager()
+        if gsm.queryUtility(IDatabase) is db:
+            gsm.registerUtility(previous, IDatabase)
+        db.close()
+
+        blob_dir = ZODBLayer.blob_dir
+        ZODBLayer.blob_dir = cls._previous_blob_dir
+        cls._previous_blob_dir = None
+        shutil.rmtree(blob_dir)
+        print(f'(blobs: {ZODBLayer.blob_bytes_written} bytes) ', end='')
+        ZODBLayer.blob_bytes_written = 0
+
+
+class FileStorageFixtureLayerMixin(object):
+    """
+    Mix this in to a layer extending
+    :class:`~nti.testing.zodb.ZODBLayer` that spends a long time
+    populating the same objects in its database every run.
+
+    Define :meth:`populate_fixture` and :attr:`FIXTURE_VERSION`, and
+    call :meth:`setUpFixture` from your ``setUp`` method and
+    :meth:`tearDownFixture` from your ``tearDown`` method.
+
+    The first time, the fixture is populated in a
+    :class:`~ZODB.FileStorage.FileStorage` which is saved in
+    :attr:`FIXTURE_CACHE_DIR`. After that, that file is opened
+    read-only underneath a :class:`~ZODB.DemoStorage.DemoStorage` and
+    :meth:`populate_fixture` is not called at all. The file name
+    includes :meth:`fixture_hash`; when that changes, the fixture is
+    populated again and the stale file is removed.
+
+    While the layer is set up, this database replaces
+    :attr:`~nti.testing.zodb.ZODBLayer.db` (and the registered
+    utility), so tests are isolated from each other just as usual.
+
+    .. versionadded:: 4.5.0
+    """
+
+    #: Change this whenever :meth:`populate_fixture` (or anything it
+    #: uses) changes in a way that should invalidate the cache.
+    FIXTURE_VERSION = None
+
+    #: The directory in which to save fixtures. If not set, the
+    #: ``NTI_ZODB_FIXTURE_CACHE`` environment variable is used, and if
+    #: that's not set, a directory in the system temporary directory.
+    FIXTURE_CACHE_DIR = None
+
+    _previous_db = None
+
+    @classmethod
+    def setUp(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def tearDown(cls):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        pass
+
+    @classmethod
+    def testSetUp(cls):
+        pass
+
+    @classmethod
+    def testTearDown(cls):
+        pass
+
+    @classmethod
+    def populate_fixture(cls, db):
+        """
+        Populate the :class:`ZODB.DB` *db*. You must implement this,
+        probably by using :class:`~nti.testing.zodb.mock_db_trans` one
+        or more times.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def fixture_hash(cls):
+        """
+        Return a string identifying the current version of the
+        fixture. By default, this is derived from the
+        :attr:`FIXTURE_VERSION` and the source code of
+        :meth:`populate_fixture`.
+        """
+        parts = [cls.__module__, cls.__qualname__, repr(cls.FIXTURE_VERSION)]
+        try:
+            parts.append(inspect.getsource(cls.populate_fixture))
+        except (OSError, TypeError): # pragma: no cover
+            pass
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def _fixture_prefix(cls):
+        cache_dir = (
+            cls.FIXTURE_CACHE_DIR
+            or os.environ.get('NTI_ZODB_FIXTURE_CACHE')
+            or os.path.join(tempfile.gettempdir(), 'nti.testing.zodb-fixtures')
+        )
+        return os.path.join(cache_dir, f'{cls.__module__}.{cls.__qualname__}-')
+
+    @classmethod
+    def fixture_path(cls):
+        """
+        The path of the ``FileStorage`` file for the current version of
+        the fixture.
+        """
+        return cls._fixture_prefix() + cls.fixture_hash() + '.fs'
+
+    @classmethod
+    def setUpFixture(cls):
+        """
+        Open (populating, if needed) the fixture database, and install it
+        as the :attr:`~nti.testing.zodb.ZODBLayer.db`.
+        """
+        path = cls.fixture_path()
+        if not os.path.exists(path):
+            cls._build_fixture(path)
+
+        db = ZODB.DB(DemoStorage(base=FileStorage(path, read_only=True)))
+        cls._previous_db = ZODBLayer.db
+        ZODBLayer.db = db
+        component.getGlobalSiteManager().registerUtility(db, IDatabase)
+
+    @classmethod
+    def tearDownFixture(cls):
+        """
+        Close the fixture database, and restore the previous
+        :attr:`~nti.testing.zodb.ZODBLayer.db`.
+        """
+        db = ZODBLayer.db
+        previous = ZODBLayer.db = cls._previous_db
+        cls._previous_db = None
+        gsm = component.getGlobalSiteManager()
+        if gsm.queryUtility(IDatabase) is db:
+            if previous is not None:
+                gsm.registerUtility(previous, IDatabase)
+            else:
+                gsm.unregisterUtility(db, IDatabase)
+        db.close()
+
+    @classmethod
+    def _build_fixture(cls, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Build under a private name and then move it into place,
+        # in case of concurrent test processes.
+        tmp_path = f'{path}.{os.getpid()}'
+        try:
+            db = ZODB.DB(FileStorage(tmp_path))
+            try:
+                cls.populate_fixture(db)
+            finally:
+                db.close()
+        except:
+            # Don't leave a partial fixture (and its index, lock and
+            # temporary files) behind; nothing else would remove it.
+            _remove_fixture_files([tmp_path] + glob.glob(glob.escape(tmp_path) + '.*'))
+            raise
+        os.replace(tmp_path + '.index', path + '.index')
+        os.replace(tmp_path, path)
+
+        # Only now remove our leftovers and old versions. Anything
+        # for this version (including what other processes are
+        # building) is left alone.
+        stale = glob.glob(glob.escape(tmp_path) + '.*')
+        stale.extend(
+            name
+            for name in glob.glob(glob.escape(cls._fixture_prefix()) + '*')
+            if not name.startswith(path)
+        )
+        _remove_fixture_files(stale)
+
+
+def _remove_fixture_files(names):
+    for name in names:
+        try:
+            if os.path.isdir(name):
+                shutil.rmtree(name)
+            else:
+                os.remove(name)
+        except FileNotFoundError: # pragma: no cover
+            # Another process got it first.
+            pass
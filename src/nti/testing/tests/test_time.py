@@ -155,3 +155,465 @@ class TestTime(unittest.TestCase):
             self._check_across_funcs(before_all, f1, f2, f3)
         finally:
             layer.testTearDown()
+
+    @time_monotonically_increases
+    def test_other_clocks(self):
+        import time
+        for name in ('monotonic', 'perf_counter', 'time_ns',
+                     'monotonic_ns', 'perf_counter_ns'):
+            func = getattr(time, name)
+            before = func()
+            after = func()
+            scale = 1e9 if name.endswith('_ns') else 1
+            assert_that(after, is_(greater_than_or_equal_to(before + scale)), name)
+            self.assertIsInstance(after, int if scale != 1 else float)
+
+        # They advance together.
+        wall = time.time()
+        mono = time.monotonic()
+        perf = time.perf_counter()
+        assert_that(time.time() - wall, is_(3.0))
+        assert_that(time.monotonic() - mono, is_(3.0))
+        assert_that(time.perf_counter() - perf, is_(3.0))
+        assert_that(time.time_ns(), is_(greater_than(wall * 1e9)))
+
+        # The wall clock can go back; the monotonic one can't.
+        reset_monotonic_time(-50)
+        assert_that(time.time(), is_(less_than(wall)))
+        assert_that(time.monotonic(), is_(greater_than(mono)))
+
+        before = time.localtime()
+        assert_that(time.localtime(), is_(greater_than(before)))
+        assert_that(time.localtime(None), is_(greater_than(before)))
+        assert_that(time.localtime(0), is_(time.localtime(0)))
+
+    @time_monotonically_increases(fake_datetime=True)
+    def test_datetime(self):
+        import datetime
+        from nti.testing.time import _real_datetime
+        now = datetime.datetime.now()
+        self.assertIs(type(now), _real_datetime)
+        assert_that(datetime.datetime.now() - now,
+                    is_(datetime.timedelta(seconds=1)))
+        assert_that(datetime.datetime.now(datetime.timezone.utc).tzinfo,
+                    is_(datetime.timezone.utc))
+        assert_that(datetime.datetime.utcnow().tzinfo, is_(None))
+        assert_that(datetime.datetime.today(), is_(greater_than(now)))
+        assert_that(datetime.date.today(), is_(greater_than_or_equal_to(now.date())))
+
+        # The fake class works like the real one.
+        assert_that(datetime.datetime(2020, 1, 1), is_(_real_datetime(2020, 1, 1)))
+        self.assertIs(type(datetime.datetime(2020, 1, 1)), _real_datetime)
+        assert_that(isinstance(now, datetime.datetime), is_(True))
+        assert_that(issubclass(_real_datetime, datetime.datetime), is_(True))
+
+    def test_fakes_removed(self):
+        import datetime
+        import time
+        from nti.testing.time import _real_datetime
+        from nti.testing.time import _real_monotonic
+
+        @time_monotonically_increases(fake_datetime=True)
+        def f():
+            self.assertIsNot(time.monotonic, _real_monotonic)
+            self.assertIsNot(datetime.datetime, _real_datetime)
+
+        f()
+        self.assertIs(time.monotonic, _real_monotonic)
+        self.assertIs(datetime.datetime, _real_datetime)
+
+    @time_monotonically_increases
+    def test_datetime_pickles(self):
+        import datetime
+        import pickle
+        from nti.testing.time import _real_datetime
+        # The real class stays in place by default.
+        self.assertIs(datetime.datetime, _real_datetime)
+        now = datetime.datetime.now()
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            assert_that(pickle.loads(pickle.dumps(now, protocol)), is_(now))
+
+        try:
+            import ZODB
+            from ZODB.DemoStorage import DemoStorage
+            from persistent.mapping import PersistentMapping
+            from nti.testing.zodb import mock_db_trans
+        except ImportError: # pragma: no cover
+            return
+        db = ZODB.DB(DemoStorage())
+        try:
+            with mock_db_trans(db) as conn:
+                conn.root()['data'] = PersistentMapping({'now': now})
+            with mock_db_trans(db) as conn:
+                assert_that(conn.root()['data']['now'], is_(now))
+        finally:
+            db.close()
+
+    @time_monotonically_increases(fake_sleep=True)
+    def test_fake_sleep(self):
+        import time
+        from nti.testing.time import _real_monotonic
+        real_before = _real_monotonic()
+        before = time.monotonic()
+        wall_before = time.time()
+        time.sleep(3600)
+        time.sleep(0)
+        assert_that(time.monotonic(), is_(greater_than_or_equal_to(before + 3600)))
+        assert_that(time.time(), is_(greater_than_or_equal_to(wall_before + 3600)))
+        assert_that(_real_monotonic() - real_before, is_(less_than(60)))
+        with self.assertRaises(ValueError):
+            time.sleep(-1)
+
+    def test_sleep_not_faked_by_default(self):
+        import threading
+        import time
+        from nti.testing.time import _real_condition_wait
+        from nti.testing.time import _real_sleep
+
+        @time_monotonically_increases
+        def f():
+            self.assertIs(time.sleep, _real_sleep)
+            self.assertIs(threading.Condition.wait, _real_condition_wait)
+        f()
+
+    @time_monotonically_increases(0.1, fake_waits=True)
+    def test_fake_waits(self):
+        import threading
+        import time
+        event = threading.Event()
+        before = time.monotonic()
+        assert_that(event.wait(600), is_(False))
+        assert_that(time.monotonic(), is_(greater_than_or_equal_to(before + 600)))
+
+        event.set()
+        before = time.monotonic()
+        assert_that(event.wait(600), is_(True))
+        assert_that(time.monotonic(), is_(less_than(before + 600)))
+        assert_that(event.wait(), is_(True))
+
+        cond = threading.Condition()
+        before = time.monotonic()
+        with cond:
+            assert_that(cond.wait_for(lambda: False, 300), is_(False))
+            assert_that(cond.wait(-1), is_(False))
+        assert_that(time.monotonic(), is_(greater_than_or_equal_to(before + 300)))
+
+    @time_monotonically_increases(fake_waits=True)
+    def test_fake_queue_waits(self):
+        import queue
+        import time
+        from nti.testing.time import _real_monotonic
+        q = queue.Queue(1)
+        real_before = _real_monotonic()
+        before = time.monotonic()
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=30)
+        q.put(1)
+        with self.assertRaises(queue.Full):
+            q.put(2, timeout=30)
+        assert_that(time.monotonic(), is_(greater_than_or_equal_to(before + 60)))
+        assert_that(_real_monotonic() - real_before, is_(less_than(5)))
+
+    def test_layer_fake_sleep(self):
+        from nti.testing.time import MonotonicallyIncreasingTimeLayerMixin
+        from nti.testing.time import _real_sleep
+        import time
+
+        layer = MonotonicallyIncreasingTimeLayerMixin(fake_sleep=True)
+        layer.testSetUp()
+        try:
+            before = time.time()
+            time.sleep(100)
+            assert_that(time.time(), is_(greater_than_or_equal_to(before + 100)))
+        finally:
+            layer.testTearDown()
+        self.assertIs(time.sleep, _real_sleep)
+
+
+    def test_record_calls(self):
+        import time
+        from unittest.mock import Mock
+        from nti.testing.time import _TimeWrapper
+
+        fakes = _TimeWrapper()
+        self.assertNotIsInstance(fakes.fake_time, Mock)
+
+        @time_monotonically_increases(0.1, record_calls=True)
+        def f():
+            time.time()
+            time.monotonic()
+            time.gmtime(0)
+            return time.time
+
+        fake_time = f()
+        self.assertIsInstance(fake_time, Mock)
+        assert_that(fake_time.call_count, is_(1))
+
+
+class TestClocks(unittest.TestCase):
+
+    def test_clock(self):
+        import time
+        from nti.testing.time import Clock
+        from nti.testing.time import _default_clock
+
+        clock = Clock(locked=False)
+        shared = _default_clock.time
+
+        @time_monotonically_increases(clock=clock)
+        def f():
+            return time.time(), time.monotonic()
+
+        wall, mono = f()
+        assert_that(clock.time, is_(wall + 1))
+        assert_that(clock.monotonic, is_(mono))
+        assert_that(f()[0], is_(greater_than_or_equal_to(wall + 2)))
+        # The shared clock wasn't used.
+        assert_that(_default_clock.time, is_(shared))
+
+        reset_monotonic_time(-50, clock=clock)
+        assert_that(f()[0], is_(less_than(wall)))
+        assert_that(_default_clock.time, is_(shared))
+
+    def test_thread_local_clock(self):
+        import threading
+        import time
+        from nti.testing.time import ThreadLocalClock
+
+        clock = ThreadLocalClock()
+        barrier = threading.Barrier(2)
+        results = {}
+
+        def run(name, count):
+            barrier.wait()
+            start = time.monotonic()
+            for _ in range(count):
+                time.monotonic()
+            results[name] = time.monotonic() - start
+
+        @time_monotonically_increases(clock=clock)
+        def f():
+            threads = [threading.Thread(target=run, args=(name, count))
+                       for name, count in (('a', 10), ('b', 1000))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return time.time()
+
+        before = time.time()
+        f()
+        # Each thread only saw its own calls.
+        assert_that(results, is_({'a': 11.0, 'b': 1001.0}))
+        assert_that(clock.time, is_(greater_than_or_equal_to(before)))
+        assert_that(clock.monotonic, is_(greater_than(0)))
+        clock.reset()
+        assert_that(clock.time, is_(0.0))
+
+    def test_context_clock(self):
+        import contextvars
+        import time
+        from nti.testing.time import ContextClock
+
+        clock = ContextClock()
+
+        @time_monotonically_increases(clock=clock)
+        def f():
+            return time.time()
+
+        for _ in range(10):
+            shared = f()
+        assert_that(clock.time, is_(shared))
+        with clock.new_timeline() as timeline:
+            # Starts at the real time.
+            assert_that(f(), is_(less_than(shared)))
+            assert_that(clock.time, is_(timeline.time))
+            assert_that(contextvars.copy_context().run(f), is_(timeline.time))
+        assert_that(clock.time, is_(shared))
+        # In another context, it's still shared.
+        assert_that(contextvars.Context().run(f), is_(greater_than(shared)))
+
+        assert_that(clock.monotonic, is_(greater_than(0)))
+        clock.reset()
+        assert_that(clock.time, is_(0.0))
+
+    def test_layer_clock(self):
+        from nti.testing.time import Clock
+        from nti.testing.time import MonotonicallyIncreasingTimeLayerMixin
+        import time
+
+        clock = Clock()
+        layer = MonotonicallyIncreasingTimeLayerMixin(clock=clock)
+        layer.testSetUp()
+        try:
+            now = time.time()
+        finally:
+            layer.testTearDown()
+        self.assertIs(layer.time_manager.clock, clock)
+        assert_that(clock.time, is_(0.0))
+        assert_that(clock.monotonic, is_(greater_than(0)))
+        assert_that(now, is_(greater_than(0)))
+
+    def test_layer_per_layer(self):
+        from nti.testing.time import Clock
+        from nti.testing.time import MonotonicallyIncreasingTimeLayerMixin
+        from nti.testing.time import _real_time
+        import time
+
+        clock = Clock()
+        layer = MonotonicallyIncreasingTimeLayerMixin(
+            clock=clock, per_layer=True,
+            reset_between_tests=False, jump_ahead=3600)
+        layer.setUp()
+        try:
+            self.assertIsNot(time.time, _real_time)
+            ends = []
+            for _ in range(3):
+                layer.testSetUp()
+                start = time.time()
+                ends.append(time.time())
+                layer.testTearDown()
+                # Still installed.
+                self.assertIsNot(time.time, _real_time)
+                if len(ends) > 1:
+                    # Time kept going, and jumped ahead.
+                    assert_that(start, is_(greater_than_or_equal_to(ends[-2] + 3600)))
+        finally:
+            layer.tearDown()
+        self.assertIs(time.time, _real_time)
+        assert_that(clock.time, is_(0.0))
+
+    def test_layer_per_layer_decorated(self):
+        from nti.testing.time import MonotonicallyIncreasingTimeLayerMixin
+        from nti.testing.time import _real_time
+        import time
+
+        layer = MonotonicallyIncreasingTimeLayerMixin(per_layer=True, fake_sleep=True)
+        layer.setUp()
+        try:
+            layer_time = time.time
+
+            @time_monotonically_increases
+            def f():
+                self.assertIsNot(time.time, layer_time)
+
+            f()
+            # The layer's fakes are back, not the real clocks.
+            self.assertIs(time.time, layer_time)
+            self.assertIs(time.sleep, layer.time_manager.fake_sleep)
+        finally:
+            layer.tearDown()
+        self.assertIs(time.time, _real_time)
+        # Closing again does nothing.
+        layer.time_manager.close()
+        self.assertIs(time.time, _real_time)
+
+    def test_layer_self_contained(self):
+        from nti.testing.time import MonotonicallyIncreasingTimeLayerMixin
+
+        calls = []
+
+        class Other(object):
+            def setUp(self):
+                calls.append('setUp')
+            def tearDown(self):
+                calls.append('tearDown')
+            def testSetUp(self):
+                calls.append('testSetUp')
+            def testTearDown(self):
+                calls.append('testTearDown')
+
+        class Layer(MonotonicallyIncreasingTimeLayerMixin, Other):
+            pass
+
+        # zope.testrunner calls the methods of each base itself,
+        # so the mixin must not call them again.
+        layer = Layer(per_layer=True)
+        for name in 'setUp', 'testSetUp', 'testTearDown', 'tearDown':
+            getattr(layer, name)()
+        self.assertEqual(calls, [])
+
+    def test_layer_per_layer_resets(self):
+        from nti.testing.time import Clock
+        from nti.testing.time import MonotonicallyIncreasingTimeLayerMixin
+        import time
+
+        clock = Clock()
+        layer = MonotonicallyIncreasingTimeLayerMixin(clock=clock, per_layer=True)
+        layer.setUp()
+        try:
+            layer.testSetUp()
+            time.time()
+            layer.testTearDown()
+            assert_that(clock.time, is_(0.0))
+        finally:
+            layer.tearDown()
+
+class TestVirtualTimeEventLoop(unittest.TestCase):
+
+    def test_sleep_and_timers(self):
+        import asyncio
+        import time
+        from nti.testing.time import _real_monotonic
+        from nti.testing.time import _real_time
+        from nti.testing.time import Clock
+        from nti.testing.time import run_in_virtual_time
+
+        fired = []
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            loop.call_later(20, fired.append, 20)
+            loop.call_later(10, fired.append, 10)
+            await asyncio.sleep(3600)
+            elapsed = loop.time() - start
+            # The code sees the same time as the loop.
+            assert_that(time.monotonic(), is_(greater_than_or_equal_to(loop.time())))
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.Event().wait(), 60)
+
+            # Left running; it's cancelled.
+            asyncio.get_running_loop().create_task(asyncio.sleep(1000))
+            return elapsed
+
+        real_before = _real_monotonic()
+        elapsed = run_in_virtual_time(main(), debug=False, clock=Clock())
+        # The difference of two large floats may be a hair short.
+        assert_that(elapsed, is_(greater_than_or_equal_to(3600 - 1e-6)))
+        assert_that(elapsed, is_(less_than(3601)))
+        assert_that(fired, is_([10, 20]))
+        assert_that(_real_monotonic() - real_before, is_(less_than(60)))
+        self.assertIs(time.time, _real_time)
+
+    def test_io_from_thread(self):
+        import asyncio
+        import threading
+        from nti.testing.time import run_in_virtual_time
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            thread = threading.Thread(
+                target=loop.call_soon_threadsafe,
+                args=(future.set_result, 42))
+            thread.start()
+            # Nothing is scheduled, so this really waits.
+            result = await future
+            thread.join()
+            return result
+
+        assert_that(run_in_virtual_time(main()), is_(42))
+
+    def test_loop_without_fakes(self):
+        import asyncio
+        from nti.testing.time import VirtualTimeEventLoop
+
+        loop = VirtualTimeEventLoop()
+        try:
+            start = loop.time()
+            loop.run_until_complete(asyncio.sleep(100))
+            assert_that(loop.time(), is_(greater_than_or_equal_to(start + 100)))
+        finally:
+            loop.close()
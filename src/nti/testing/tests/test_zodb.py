@@ -10,6 +10,7 @@ from __future__ import print_function
 import io
 import gc
 import unittest
+from unittest import mock
 
 import transaction
 from transaction.interfaces import NoTransaction
@@ -28,6 +29,8 @@ NativeStringIO = io.BytesIO if str is bytes else io.StringIO
 
 class MockDB(object):
 
+    cache_size = 0
+
     def __init__(self):
         self.pool = []
 
@@ -36,6 +39,9 @@ class MockDB(object):
         self.pool.append(conn)
         return conn
 
+    def cacheSize(self):
+        return self.cache_size
+
 
 class MockConn(object):
     closed = False
@@ -49,10 +55,10 @@ class MockConn(object):
 
 class MockDBTrans(base_mock_db_trans):
 
-    def __init__(self, db=None):
+    def __init__(self, db=None, **kwargs):
         if db is None:
             db = MockDB()
-        super().__init__(db)
+        super().__init__(db, **kwargs)
         self.exc_file = NativeStringIO()
 
 class TestMockDBTrans(unittest.TestCase):
@@ -124,6 +130,43 @@ class TestMockDBTrans(unittest.TestCase):
         self.assertTrue(conn.closed)
         self.assertTrue(conn.minimized)
 
+    def test_reset_caches_policies(self):
+        def run(policy, count=4, db=None):
+            db = db or MockDB()
+            for _ in range(count):
+                with MockDBTrans(db, reset_caches_policy=policy):
+                    pass
+            return [conn.minimized for conn in db.pool]
+
+        policy = zodb.NeverResetCaches()
+        self.assertEqual(run(policy), [False] * 4)
+        self.assertEqual(policy.transactions, 4)
+        self.assertEqual(policy.skipped, 4)
+        self.assertIsNone(policy.estimated_time_saved)
+        self.assertIn('saved=?', repr(policy))
+
+        every = zodb.ResetCachesEvery(2)
+        # Each reset minimizes all the connections so far.
+        self.assertEqual(run(every), [True, True, True, True])
+        self.assertEqual(every.resets, 2)
+        self.assertEqual(every.skipped, 2)
+        self.assertGreaterEqual(every.estimated_time_saved, 0)
+        self.assertIn('resets=2', repr(every))
+
+        above = zodb.ResetCachesAboveSize(10)
+        db = MockDB()
+        self.assertEqual(run(above, 1, db), [False])
+        db.cache_size = 11
+        self.assertEqual(run(above, 1, db), [True, True])
+        self.assertEqual(above.resets, 1)
+
+    def test_reset_caches_policy_default(self):
+        default = zodb.ZODBLayer.reset_caches_policy
+        before = default.transactions
+        with MockDBTrans():
+            pass
+        self.assertEqual(default.transactions, before + 1)
+
     def test_aborts_doomed_tx(self):
         aborted = []
         with MockDBTrans():
@@ -279,6 +322,161 @@ class TestZODBLayer(unittest.TestCase):
         self.assertIsNotNone(reg_db)
         self.assertIs(reg_db, self.layer.db)
 
+    def test_isolation(self):
+        db = self.layer.db
+        self.assertIsNotNone(self.layer._base_db)
+        self.assertIsNot(db, self.layer._base_db)
+        self.assertIs(db.storage.base, self.layer._base_db.storage)
+
+        with zodb.mock_db_trans() as conn:
+            conn.root()['key'] = 42
+
+        # Finish this test and start the next one.
+        self.layer.testTearDown()
+        self.assertIsNone(self.layer._base_db)
+        self.layer.testSetUp(self)
+
+        self.assertIsNot(self.layer.db, db)
+        with zodb.mock_db_trans() as conn:
+            self.assertNotIn('key', conn.root())
+
+    def test_isolation_disabled(self):
+        self.layer.testTearDown()
+
+        class Layer(self.layer):
+            isolate_tests = False
+
+        class Test(object):
+            layer = Layer
+
+        self.layer.testSetUp(Test())
+        try:
+            self.assertIsNone(self.layer._base_db)
+        finally:
+            self.layer.testSetUp(self)
+        self.assertIsNotNone(self.layer._base_db)
+
+    def test_sub_layer_inherits_test_methods(self):
+        from ZODB.interfaces import IDatabase
+        from zope import component
+        from zope.testrunner.runner import gather_layers
+        from zope.testrunner.runner import order_by_bases
+        layer = self.layer
+        layer.testTearDown()
+
+        class SubLayer(layer):
+            pass
+
+        class Test(object):
+            layer = SubLayer
+
+            def id(self):
+                return 'Test'
+
+        test = Test()
+        base_db = layer.db
+        layers = []
+        gather_layers(SubLayer, layers)
+        layers = order_by_bases(layers)
+        self.assertEqual(layers[-2:], [layer, SubLayer])
+        try:
+            # What zope.testrunner does for each test.
+            for _ in range(2):
+                for l in layers:
+                    if l is layer:
+                        l.testSetUp(test)
+                    elif hasattr(l, 'testSetUp'):
+                        l.testSetUp()
+                self.assertNotIn('db', SubLayer.__dict__)
+                self.assertIs(layer._base_db, base_db)
+                self.assertIs(component.getUtility(IDatabase), layer.db)
+                with zodb.mock_db_trans() as conn:
+                    self.assertIs(conn.db(), layer.db)
+                    self.assertNotIn('key', conn.root())
+                    conn.root()['key'] = 42
+                for l in reversed(layers):
+                    if hasattr(l, 'testTearDown'):
+                        l.testTearDown()
+                self.assertIs(layer.db, base_db)
+                self.assertIsNone(layer._base_db)
+        finally:
+            layer.testSetUp(self)
+
+    def test_count_storage_io(self):
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        layer = self.layer
+        layer.testTearDown()
+        base_db = layer.db
+        layer.db = ZODB.DB(zodb.CountingStorage(DemoStorage()))
+        try:
+            layer.testSetUp(self)
+            self.assertIsInstance(layer.db.storage, zodb.CountingStorage)
+            self.assertIsInstance(layer.db.storage.wrapped_storage, DemoStorage)
+            with zodb.mock_db_trans() as conn:
+                conn.root()['key'] = 42
+            layer.testTearDown()
+            stats = layer.io_statistics.pop(self.id())
+            self.assertEqual(stats.stores, 1)
+            self.assertGreater(stats.store_bytes, 0)
+            # The root, when the DB was opened and by us.
+            self.assertEqual(stats.loads, 2)
+            # Nothing was written to the base except the root.
+            self.assertEqual(layer.db.storage.statistics.stores, 1)
+
+            layer.io_statistics['a test'] = stats
+            with mock.patch('builtins.print') as print_:
+                layer.print_io_statistics()
+            self.assertIn('a test', print_.call_args[0][0])
+            layer.io_statistics.clear()
+        finally:
+            layer.db.close()
+            layer.db = base_db
+            layer.testSetUp(self)
+
+    def test_max_object_loads_default_db(self):
+        with zodb.mock_db_trans() as conn:
+            conn.root()['key'] = 42
+        with zodb.max_object_loads(1, stores=1) as budget:
+            with zodb.mock_db_trans() as conn:
+                conn.root()['key'] = 43
+        self.assertIs(budget.db, self.layer.db)
+        self.assertEqual(budget.loads_made, 1)
+        self.assertEqual(budget.stores_made, 1)
+
+    def test_reuse_connections(self):
+        layer = self.layer
+        layer.testTearDown()
+
+        class Layer(layer):
+            reuse_connections = True
+
+        class Test(object):
+            layer = Layer
+
+        layer.testSetUp(Test())
+        try:
+            held = layer._held_connection.conn
+            with zodb.mock_db_trans() as conn:
+                self.assertIs(conn, held)
+                conn.root()['key'] = 42
+            self.assertFalse(held.opened is None)
+        finally:
+            layer.testTearDown()
+        self.assertIsNone(layer._held_connection)
+        self.assertIsNone(held.opened)
+        layer.testSetUp(self)
+        self.assertIsNone(layer._held_connection)
+
+        # If setting up fails, nothing is left behind.
+        layer.testTearDown()
+        with mock.patch.object(zodb.held_connection, 'open', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                layer.testSetUp(Test())
+        self.assertIsNone(layer._held_connection)
+        self.assertIsNone(layer._base_db)
+        layer.testSetUp(self)
+
     def test_premature_teardown(self):
         self.layer.tearDown()
         from ZODB.interfaces import IDatabase
@@ -336,9 +534,242 @@ class TestResetDbCaches(unittest.TestCase):
         zodb.reset_db_caches(db)
         IExtra.changed(None) # pylint:disable=no-value-for-parameter
 
+    def test_gc_strategies(self):
+        stats = zodb.gc_statistics
+        stats.clear()
+        db = MockDB()
+        db.open()
+        for strategy in zodb.GC_FULL, zodb.GC_YOUNG, zodb.GC_INCREMENTAL:
+            zodb.reset_db_caches(db, collect=True, gc_strategy=strategy)
+        self.assertEqual(stats.collections, {
+            zodb.GC_FULL: 1,
+            zodb.GC_YOUNG: 1,
+            zodb.GC_INCREMENTAL: 1,
+        })
+        self.assertGreaterEqual(stats.total_time, 0)
+        self.assertIn('young=1/', repr(stats))
+        self.assertTrue(db.pool[0].minimized)
+
+        self.assertEqual(
+            zodb.reset_db_caches(db, collect=True, gc_strategy=zodb.GC_DEFERRED),
+            -1
+        )
+        self.assertEqual(sum(stats.collections.values()), 3)
+        self.assertNotEqual(zodb.collect_deferred_garbage(), -1)
+        self.assertEqual(stats.collections[zodb.GC_FULL], 2)
+        # Only once
+        self.assertEqual(zodb.collect_deferred_garbage(), -1)
+
+        with self.assertRaises(ValueError):
+            zodb.collect_garbage('bad')
+
     def test_arguments(self):
         # Don't pass the DB, let it get the one from the layer.
         # But do ask for collect, so we get something non-negative on
         # all platforms.
         collected = zodb.reset_db_caches(collect=True)
         self.assertNotEqual(collected, -1)
+
+
+class TestHeldConnection(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        from persistent.mapping import PersistentMapping
+        self.db = ZODB.DB(DemoStorage())
+        with zodb.mock_db_trans(self.db) as conn:
+            conn.root()['data'] = PersistentMapping({'value': 1})
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_reuse(self):
+        policy = zodb.NeverResetCaches()
+        with zodb.held_connection(self.db) as held:
+            self.assertIs(zodb.held_connection.get(self.db), held)
+            with zodb.mock_db_trans(self.db, reset_caches_policy=policy) as conn:
+                self.assertIs(conn, held)
+                data = conn.root()['data']
+                self.assertEqual(data['value'], 1)
+
+            # Another connection changes it.
+            txm = transaction.TransactionManager()
+            other = self.db.open(txm)
+            txm.begin()
+            other.root()['data']['value'] = 2
+            txm.commit()
+            other.close()
+
+            with zodb.mock_db_trans(self.db) as conn:
+                self.assertIs(conn, held)
+                # The same object, still in the cache, but up to date.
+                self.assertIs(conn.root()['data'], data)
+                self.assertEqual(data['value'], 2)
+
+            # Nesting.
+            with zodb.held_connection(self.db) as inner:
+                self.assertIsNot(inner, held)
+                with zodb.mock_db_trans(self.db) as conn:
+                    self.assertIs(conn, inner)
+            self.assertIs(zodb.held_connection.get(self.db), held)
+            self.assertEqual(policy.transactions, 0)
+
+        self.assertIsNone(zodb.held_connection.get(self.db))
+        self.assertIsNone(held.opened)
+        with zodb.mock_db_trans(self.db) as conn:
+            self.assertIsNotNone(conn.opened)
+        # Closed this time.
+        self.assertIsNone(conn.opened)
+
+    def test_open_close(self):
+        held = zodb.held_connection(self.db)
+        conn = held.open()
+        self.assertIs(zodb.held_connection.get(self.db), conn)
+        held.close()
+        self.assertIsNone(zodb.held_connection.get(self.db))
+        self.assertIsNone(conn.opened)
+
+    def test_explicit_connection(self):
+        conn = self.db.open()
+        try:
+            with zodb.mock_db_trans(connection=conn) as c:
+                self.assertIs(c, conn)
+                c.root()['data']['value'] = 3
+            self.assertIsNotNone(conn.opened)
+        finally:
+            conn.close()
+        with zodb.mock_db_trans(self.db) as c:
+            self.assertEqual(c.root()['data']['value'], 3)
+
+    def test_explicit_connection_error(self):
+        conn = self.db.open()
+        trans = zodb.mock_db_trans(connection=conn)
+        trans.on_connection_opened = mock.Mock(side_effect=KeyError)
+        try:
+            with self.assertRaises(KeyError):
+                with trans:
+                    pass
+            self.assertIsNotNone(conn.opened)
+        finally:
+            conn.close()
+
+
+class TestAsyncDBTrans(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        from BTrees.OOBTree import OOBTree # pylint:disable=import-error,no-name-in-module
+        self.db = ZODB.DB(DemoStorage())
+        with zodb.mock_db_trans(self.db) as conn:
+            conn.root()['tree'] = OOBTree()
+            conn.root()['counter'] = 0
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_concurrent_tasks(self):
+        import asyncio
+        managers = set()
+
+        async def task(i):
+            async with zodb.async_db_trans(self.db) as conn:
+                txm = zodb.current_transaction_manager()
+                self.assertIs(conn.transaction_manager, txm)
+                self.assertIsNot(txm, transaction.manager)
+                managers.add(txm)
+                # Let the others run in the middle of the transaction.
+                await asyncio.sleep(0)
+                conn.root()['tree'][i] = i
+            self.assertIs(zodb.current_transaction_manager(), transaction.manager)
+
+        async def main():
+            await asyncio.gather(*[task(i) for i in range(5)])
+
+        asyncio.run(main())
+        self.assertEqual(len(managers), 5)
+        with zodb.mock_db_trans(self.db) as conn:
+            self.assertEqual(list(conn.root()['tree']), list(range(5)))
+
+    def test_conflict_and_abort(self):
+        import asyncio
+        from ZODB.POSException import ConflictError
+
+        async def increment(started, proceed):
+            async with zodb.async_db_trans(self.db) as conn:
+                value = conn.root()['counter']
+                started.set()
+                await proceed.wait()
+                conn.root()['counter'] = value + 1
+
+        async def main():
+            started = [asyncio.Event(), asyncio.Event()]
+            proceed = asyncio.Event()
+            tasks = [asyncio.create_task(increment(s, proceed)) for s in started]
+            for s in started:
+                await s.wait()
+            proceed.set()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(main())
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], ConflictError)
+
+        async def fail():
+            async with zodb.async_db_trans(self.db) as conn:
+                conn.root()['counter'] = -1
+                raise KeyError
+
+        async def doomed():
+            async with zodb.async_db_trans(self.db) as conn:
+                conn.root()['counter'] = -1
+                conn.transaction_manager.doom()
+
+        with self.assertRaises(KeyError):
+            asyncio.run(fail())
+        asyncio.run(doomed())
+        with zodb.mock_db_trans(self.db) as conn:
+            self.assertEqual(conn.root()['counter'], 1)
+
+    def test_open_fails(self):
+        import asyncio
+        trans = zodb.async_db_trans(mock.Mock(**{'open.side_effect': KeyError}))
+
+        async def main():
+            async with trans:
+                self.fail("Not reached")
+
+        with self.assertRaises(KeyError):
+            asyncio.run(main())
+        self.assertIsNone(trans.transaction_manager)
+
+    def test_body_changes_transaction(self):
+        import asyncio
+
+        async def commit():
+            async with zodb.async_db_trans(self.db) as conn:
+                conn.root()['counter'] = 5
+                conn.transaction_manager.commit()
+                # Not committed.
+                conn.root()['counter'] = 6
+
+        async def begin():
+            async with zodb.async_db_trans(self.db) as conn:
+                conn.transaction_manager.abort()
+                conn.transaction_manager.begin()
+                conn.root()['counter'] = 7
+
+        for body in commit, begin:
+            with self.assertRaises(zodb._TransactionChanged):
+                asyncio.run(body())
+        with zodb.mock_db_trans(self.db) as conn:
+            self.assertEqual(conn.root()['counter'], 5)
+
+    def test_database_name(self):
+        trans = zodb.async_db_trans(self.db, database_name=self.db.database_name)
+        self.assertIs(trans.db, self.db)
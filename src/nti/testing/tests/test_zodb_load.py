@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for zodb_load.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+try:
+    from nti.testing import zodb
+    from nti.testing import zodb_load
+except ModuleNotFoundError as ex:
+    assert ex.name == 'ZODB'
+    zodb = zodb_load = None
+
+
+class TestRunConcurrentTransactions(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        self.db = ZODB.DB(DemoStorage())
+        with zodb.mock_db_trans(self.db) as conn:
+            conn.root()['counter'] = 0
+
+    def tearDown(self):
+        self.db.close()
+
+    def _counter(self):
+        with zodb.mock_db_trans(self.db) as conn:
+            return conn.root()['counter']
+
+    def test_counter(self):
+        def increment(conn, worker, iteration): # pylint:disable=unused-argument
+            conn.root()['counter'] += 1
+
+        result = zodb_load.run_concurrent_transactions(increment, workers=3, transactions=5,
+                                                  db=self.db)
+        self.assertEqual(result.commits + result.failures, 15)
+        self.assertEqual(self._counter(), result.commits)
+        self.assertLessEqual(len(result.retry_latencies), result.conflicts)
+        self.assertGreater(result.commits_per_second, 0)
+        self.assertIn('commits=', repr(result))
+
+    def test_conflict(self):
+        import threading
+        barrier = threading.Barrier(2)
+        attempts = []
+
+        def increment(conn, worker, iteration): # pylint:disable=unused-argument
+            value = conn.root()['counter']
+            attempts.append(worker)
+            if len(attempts) <= 2:
+                # Make sure both have read the old value.
+                barrier.wait()
+            conn.root()['counter'] = value + 1
+
+        result = zodb_load.run_concurrent_transactions(increment, workers=2, transactions=1,
+                                                  db=self.db)
+        self.assertEqual(result.commits, 2)
+        self.assertEqual(result.conflicts, 1)
+        self.assertEqual(result.conflict_rate, 1 / 3)
+        self.assertEqual(len(result.retry_latencies), 1)
+        self.assertEqual(self._counter(), 2)
+
+    def test_too_many_conflicts(self):
+        from ZODB.POSException import ConflictError
+        def conflict(conn, worker, iteration):
+            raise ConflictError
+
+        result = zodb_load.run_concurrent_transactions(conflict, workers=2, transactions=2,
+                                                  db=self.db, max_retries=1)
+        self.assertEqual(result.failures, 4)
+        self.assertEqual(result.conflicts, 8)
+        self.assertEqual(result.commits, 0)
+
+    def test_error(self):
+        def fail(conn, worker, _iteration):
+            conn.root()['counter'] = -1
+            raise KeyError(worker)
+
+        with self.assertRaises(KeyError):
+            zodb_load.run_concurrent_transactions(fail, workers=2, db=self.db)
+        # Aborted
+        self.assertEqual(self._counter(), 0)
+
+    def test_open_error(self):
+        from unittest import mock
+
+        def workload(conn, worker, iteration): # pragma: no cover
+            raise AssertionError("Not called")
+
+        real_open = self.db.open
+        opened = []
+        def open_once(*args):
+            # The second worker can't open a connection; the first
+            # one must not wait for it forever.
+            if opened:
+                raise KeyError('open')
+            opened.append(1)
+            return real_open(*args)
+
+        with mock.patch.object(self.db, 'open', side_effect=open_once):
+            with self.assertRaises(KeyError):
+                zodb_load.run_concurrent_transactions(workload, workers=2, db=self.db)
+
+    def test_result(self):
+        result = zodb_load.ConcurrentTransactionResult()
+        self.assertEqual(result.commits_per_second, 0.0)
+        self.assertEqual(result.conflict_rate, 0.0)
+
+
+class TestBuildBulkFixture(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        from BTrees.OOBTree import OOBTree # pylint:disable=import-error,no-name-in-module
+        self.db = ZODB.DB(DemoStorage(), cache_size=100)
+        with zodb.mock_db_trans(self.db) as conn:
+            conn.root()['tree'] = OOBTree()
+
+    def tearDown(self):
+        self.db.close()
+
+    @staticmethod
+    def _add(conn, i):
+        from persistent.mapping import PersistentMapping
+        conn.root()['tree'][i] = PersistentMapping({'i': i})
+
+    def _check(self, result, count):
+        self.assertEqual(result.objects, count)
+        self.assertEqual(result.batches, 3)
+        self.assertGreater(result.objects_per_second, 0)
+        self.assertIn('objects=%d' % count, repr(result))
+        self.assertLessEqual(self.db.cacheSize(), 200)
+        with zodb.mock_db_trans(self.db) as conn:
+            tree = conn.root()['tree']
+            self.assertEqual(len(tree), count)
+            self.assertEqual(tree[count - 1]['i'], count - 1)
+
+    def test_commits(self):
+        result = zodb_load.build_bulk_fixture(range(2500), self._add, db=self.db,
+                                         batch_size=1000, max_cached_objects=1)
+        self._check(result, 2500)
+        self.assertEqual(result.minimizes, 3)
+
+    def test_savepoints(self):
+        result = zodb_load.build_bulk_fixture((i for i in range(3000)), self._add, db=self.db,
+                                         batch_size=1000, savepoints=True)
+        self._check(result, 3000)
+        # Garbage collection was enough.
+        self.assertEqual(result.minimizes, 0)
+
+    def test_result(self):
+        self.assertEqual(zodb_load.BulkFixtureResult().objects_per_second, 0.0)
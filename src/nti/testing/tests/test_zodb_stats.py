@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for zodb_stats.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+try:
+    from nti.testing import zodb
+    from nti.testing import zodb_stats
+except ModuleNotFoundError as ex:
+    assert ex.name == 'ZODB'
+    zodb = zodb_stats = None
+
+# pylint:disable=protected-access,no-value-for-parameter
+
+
+class TestProfileStorage(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+
+    def _make_db(self, storage=None):
+        import ZODB
+        # pylint:disable=import-error,no-name-in-module
+        from BTrees.OOBTree import OOBTree
+        from BTrees.OOBTree import OOTreeSet
+        db = ZODB.DB(storage)
+        self.addCleanup(db.close)
+        with zodb.mock_db_trans(db) as conn:
+            tree = conn.root()['tree'] = OOBTree()
+            tree_set = conn.root()['set'] = OOTreeSet()
+            for i in range(100):
+                tree[i] = i
+                tree_set.add(i)
+        return db
+
+    def test_profile(self):
+        db = self._make_db()
+        profile = zodb_stats.profile_storage(db, largest=3)
+        self.assertEqual(profile.records, 15)
+        self.assertEqual(profile.total_bytes,
+                         sum(c.total_bytes for c in profile.by_class.values()))
+        buckets = profile.by_class['BTrees.OOBTree.OOBucket']
+        self.assertEqual(buckets.count, 6)
+        self.assertGreater(buckets.mean_bytes, 0)
+        self.assertEqual(profile.by_class['BTrees.OOBTree.OOSet'].count, 6)
+        self.assertEqual(profile.by_class['BTrees.OOBTree.OOBTree'].count, 1)
+        self.assertIn('count=6', repr(buckets))
+
+        self.assertEqual(len(profile.largest), 3)
+        sizes = [size for size, _, _ in profile.largest]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(sizes[0], max(c.max_bytes for c in profile.by_class.values()))
+
+        # The buckets were split in half, and the later ones filled.
+        fill = profile.bucket_fill['BTrees.OOBTree.OOBucket']
+        self.assertGreater(fill, 0.5)
+        self.assertLess(fill, 1)
+        self.assertIn('BTrees.OOBTree.OOSet', profile.bucket_fill)
+        self.assertNotIn('BTrees.OOBTree.OOBTree', profile.bucket_fill)
+
+        report = profile.format()
+        self.assertIn('15 records', report)
+        self.assertIn('Largest records:', report)
+        self.assertIn('Bucket fill:', report)
+        self.assertIn('records=15', repr(profile))
+
+        with zodb.mock_db_trans(db) as conn:
+            from persistent.list import PersistentList
+            for i in range(100):
+                conn.root()['tree'][i] = 'x' * 100
+            conn.root()['new'] = PersistentList()
+        growth = zodb_stats.profile_storage(db, largest=0).growth_since(profile)
+        self.assertGreater(growth['BTrees.OOBTree.OOBucket'], 1.5)
+        self.assertEqual(growth['BTrees.OOBTree.OOSet'], 1.0)
+        self.assertIsNone(growth['persistent.list.PersistentList'])
+
+    def test_empty(self):
+        profile = zodb_stats.StorageProfile()
+        self.assertEqual(zodb_stats.ClassProfile().mean_bytes, 0.0)
+        self.assertEqual(profile.format(), '0 records, 0 bytes\n'
+                         '   Count      Bytes     Mean      Max Class')
+
+    def test_counting_storage(self):
+        from ZODB.MappingStorage import MappingStorage
+        storage = zodb_stats.CountingStorage(MappingStorage())
+        db = self._make_db(storage)
+        before = storage.statistics.copy()
+        self.assertEqual(zodb_stats.profile_storage(db).records, 15)
+        # The profile didn't count.
+        self.assertEqual(storage.statistics, before)
+
+    def test_mvcc_storage(self):
+        from ZODB.tests.MVCCMappingStorage import MVCCMappingStorage
+        db = self._make_db(MVCCMappingStorage())
+        self.assertEqual(zodb_stats.profile_storage(db).records, 15)
+
+    def test_registered_db(self):
+        from zope import component
+        from ZODB.interfaces import IDatabase
+        db = self._make_db()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(db, IDatabase)
+        self.addCleanup(gsm.unregisterUtility, db, IDatabase)
+        self.assertEqual(zodb_stats.profile_storage().records, 15)
+
+
+class TestCountingStorage(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+
+    def test_counts(self):
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        from ZODB.interfaces import IStorage
+        from ZODB.utils import z64
+        storage = zodb_stats.CountingStorage(DemoStorage())
+        self.assertTrue(IStorage.providedBy(storage))
+        db = ZODB.DB(storage)
+        self.assertEqual(len(storage), 1)
+
+        with zodb.mock_db_trans(db) as conn:
+            conn.root()['key'] = 42
+        trans = zodb.mock_db_trans(db)
+        with trans as conn:
+            # Not in the cache, so loaded to make a ghost, and then
+            # loaded again to activate it; then found in the cache.
+            self.assertEqual(conn.root()['key'], 42)
+            self.assertEqual(conn.get(z64)['key'], 42)
+        self.assertNotIn('get', conn.__dict__)
+        stats = trans.io_statistics
+        self.assertEqual(stats.loads, 2)
+        self.assertEqual(stats.cache_misses, 2)
+        self.assertEqual(stats.cache_hits, 1)
+        self.assertEqual(stats.cache_hit_ratio, 1 / 3)
+        self.assertEqual(stats.stores, 0)
+        self.assertGreater(stats.load_bytes, 0)
+        self.assertIn('loads=2', repr(stats))
+
+        self.assertEqual(storage.statistics - storage.statistics.copy(),
+                         zodb_stats.StorageStatistics())
+        self.assertNotEqual(storage.statistics, zodb_stats.StorageStatistics())
+        self.assertNotEqual(storage.statistics, self)
+        self.assertIsNone(zodb_stats.StorageStatistics().cache_hit_ratio)
+        with self.assertRaises(TypeError):
+            zodb_stats.StorageStatistics(bad=1)
+        with self.assertRaises(TypeError):
+            hash(zodb_stats.StorageStatistics())
+
+        before = storage.statistics.copy()
+        tid = storage.lastTransaction()
+        data = storage.loadSerial(z64, tid)
+        self.assertIsNone(storage.loadBefore(z64, z64))
+        self.assertEqual(storage.load(z64)[0], data)
+        after = storage.statistics - before
+        self.assertEqual(after.loads, 2)
+        self.assertEqual(after.load_bytes, len(data) * 2)
+        db.close()
+
+    def test_store_blob(self):
+        import ZODB
+        from ZODB.blob import Blob
+        from ZODB.DemoStorage import DemoStorage
+        db = ZODB.DB(zodb_stats.CountingStorage(DemoStorage()))
+        with zodb.mock_db_trans(db) as conn:
+            blob = conn.root()['blob'] = Blob()
+            with blob.open('w') as f:
+                f.write(b'data')
+        # Including the root when the DB was created.
+        self.assertEqual(db.storage.statistics.stores, 3)
+        db.close()
+
+    def test_new_instance(self):
+
+        class Storage(object):
+            def new_instance(self):
+                return Storage()
+
+        storage = zodb_stats.CountingStorage(Storage())
+        instance = storage.new_instance()
+        self.assertIsInstance(instance, zodb_stats.CountingStorage)
+        self.assertIs(instance.statistics, storage.statistics)
+        self.assertIsInstance(instance.wrapped_storage, Storage)
+
+
+class TestMaxObjectLoads(unittest.TestCase):
+
+    def setUp(self):
+        if zodb is None:
+            self.skipTest("ZODB not installed")
+        import ZODB
+        from ZODB.DemoStorage import DemoStorage
+        from persistent.mapping import PersistentMapping
+        self.db = ZODB.DB(DemoStorage())
+        with zodb.mock_db_trans(self.db) as conn:
+            for i in range(5):
+                conn.root()[i] = PersistentMapping()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _load(self, count):
+        with zodb.mock_db_trans(self.db) as conn:
+            for i in range(count):
+                conn.root()[i].keys()
+
+    def test_within_budget(self):
+        with zodb_stats.max_object_loads(6, self.db) as budget:
+            self._load(5)
+        # The root and each mapping
+        self.assertEqual(budget.loads_made, 6)
+        self.assertEqual(budget.stores_made, 0)
+        self.assertIsNone(budget.problem())
+
+    def test_over_budget(self):
+        with self.assertRaises(AssertionError) as exc:
+            with zodb_stats.max_object_loads(3, self.db):
+                self._load(5)
+        self.assertEqual(str(exc.exception), 'loaded 6 objects (budget 3)')
+
+        with self.assertRaises(AssertionError) as exc:
+            with zodb_stats.max_object_loads(db=self.db, stores=0):
+                with zodb.mock_db_trans(self.db) as conn:
+                    conn.root()['new'] = 1
+        self.assertEqual(str(exc.exception), 'stored 1 objects (budget 0)')
+
+    def test_body_raises(self):
+        with self.assertRaises(KeyError):
+            with zodb_stats.max_object_loads(0, self.db):
+                self._load(5)
+                raise KeyError
+
+    def test_counting_storage(self):
+        import ZODB
+        db = ZODB.DB(zodb_stats.CountingStorage(self.db.storage))
+        with zodb_stats.max_object_loads(6, db) as budget:
+            with zodb.mock_db_trans(db) as conn:
+                conn.root()[0].keys()
+        # The root is loaded twice, to create the ghost and activate it.
+        self.assertEqual(budget.loads_made, 3)
+
+    def test_matcher(self):
+        from hamcrest import assert_that
+        from hamcrest import is_not
+        assert_that(lambda: self._load(5), zodb_stats.loads_at_most(6, self.db))
+        assert_that(lambda: self._load(5), is_not(zodb_stats.loads_at_most(5, self.db)))
+
+        with self.assertRaises(AssertionError) as exc:
+            assert_that(lambda: self._load(5), zodb_stats.loads_at_most(1, self.db, stores=0))
+        self.assertIn(
+            'a callable loading at most 1 objects and storing at most 0 objects',
+            str(exc.exception))
+        self.assertIn('loaded 6 objects (budget 1)', str(exc.exception))
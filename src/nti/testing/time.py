@@ -9,11 +9,25 @@ from __future__ import division
 from __future__ import print_function
 
 # stdlib imports
+import asyncio
+import contextlib
+import contextvars
+import datetime
 import functools
+import queue
+import selectors
+import threading
 from threading import Lock
 import time
 from time import time as _real_time
 from time import gmtime as _real_gmtime
+from time import localtime as _real_localtime
+from time import monotonic as _real_monotonic
+from time import monotonic_ns as _real_monotonic_ns
+from time import perf_counter as _real_perf_counter
+from time import perf_counter_ns as _real_perf_counter_ns
+from time import sleep as _real_sleep
+from time import time_ns as _real_time_ns
 
 import six
 
@@ -21,44 +35,327 @@ from nti.testing.mock import Mock
 
 __docformat__ = "restructuredtext en"
 
-_current_time = _real_time()
+_real_datetime = datetime.datetime
+_real_condition_wait = threading.Condition.wait
 
+# The fake monotonic clocks are derived from the fake wall clock, so
+# that they all agree on how much time has passed. These are the
+# differences between them when we started.
+_MONOTONIC_OFFSET = _real_time() - _real_monotonic()
+_PERF_COUNTER_OFFSET = _real_monotonic() - _real_perf_counter()
 
-class _TimeWrapper(object):
 
-    def __init__(self, granularity=1.0):
+
+class Clock(object):
+    """
+    The state of a fake clock: the current wall clock and monotonic
+    clock times. Each fake call advances the clock it uses.
+
+    By default, `time_monotonically_increases` and friends share one
+    clock, so time increases across all of them, in all threads. That
+    clock is locked, so threads contend for it; tests that run threads
+    in parallel, or that want their own timeline, can instead pass a
+    clock of their own: an instance of this class, a
+    `ThreadLocalClock` or a `ContextClock`.
+
+    If *locked* is false, the clock must only be used by one thread.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self, locked=True):
+        #: The current wall clock time.
+        self.time = _real_time()
+        #: The current monotonic clock time.
+        self.monotonic = _real_monotonic()
+        self._lock = Lock() if locked else None
+
+    def _advance(self, seconds):
+        self.time = max(_real_time(), self.time + seconds)
+        # The wall clock can be reset to go backwards, but the
+        # monotonic clock can't.
+        self.monotonic = max(self.time - _MONOTONIC_OFFSET,
+                             self.monotonic + seconds)
+        return self.time, self.monotonic
+
+    def advance(self, seconds):
+        """
+        Advance the clock by *seconds*, but not to less than the real
+        time, and return the new wall clock and monotonic clock times.
+        """
+        if self._lock is None:
+            return self._advance(seconds)
+        with self._lock:
+            return self._advance(seconds)
+
+    def reset(self, value=0.0):
+        """
+        Set the wall clock time to *value*. The wall clock returns at
+        least the real time, so by default this makes it return the real
+        time on its next call. The monotonic clock is not changed.
+        """
+        self.time = value
+
+
+class ThreadLocalClock(threading.local):
+    """
+    A clock giving each thread its own, unlocked, `Clock`, so threads
+    have independent timelines and don't contend.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._clock = Clock(locked=False)
+
+    @property
+    def time(self):
+        return self._clock.time
+
+    @property
+    def monotonic(self):
+        return self._clock.monotonic
+
+    def advance(self, seconds):
+        return self._clock.advance(seconds)
+
+    def reset(self, value=0.0):
+        self._clock.reset(value)
+
+
+class ContextClock(object):
+    """
+    A clock kept in a :class:`contextvars.ContextVar`.
+
+    All contexts share a `Clock` until :meth:`new_timeline` gives
+    one its own. Contexts copied from that one (such as the
+    :mod:`asyncio` tasks it starts) use the same clock.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        self._clock = Clock()
+        self._var = contextvars.ContextVar('nti.testing.time.ContextClock',
+                                           default=self._clock)
+
+    @property
+    def time(self):
+        return self._var.get().time
+
+    @property
+    def monotonic(self):
+        return self._var.get().monotonic
+
+    def advance(self, seconds):
+        return self._var.get().advance(seconds)
+
+    def reset(self, value=0.0):
+        self._var.get().reset(value)
+
+    @contextlib.contextmanager
+    def new_timeline(self):
+        """
+        A context manager that gives the current context a new `Clock`,
+        starting at the real time, until it exits. Returns the clock.
+        """
+        clock = Clock()
+        token = self._var.set(clock)
+        try:
+            yield clock
+        finally:
+            self._var.reset(token)
+
+
+# Shared by everything that doesn't ask for a clock.
+_default_clock = Clock()
+
+
+class _FakeDatetimeType(type):
+    # Instances of the real class are instances of the fake class,
+    # and vice versa, so ``isinstance`` checks keep working.
+
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, _real_datetime)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, _real_datetime)
+
+
+class _FakeDatetime(_real_datetime, metaclass=_FakeDatetimeType):
+    # Installed as ``datetime.datetime``. The values it returns are
+    # real :class:`datetime.datetime` objects.
+
+    def __new__(cls, *args, **kwargs):
+        return _real_datetime(*args, **kwargs)
+
+    @classmethod
+    def now(cls, tz=None):
+        return _real_datetime.fromtimestamp(time.time(), tz)
+
+    @classmethod
+    def today(cls):
+        return _real_datetime.fromtimestamp(time.time())
+
+    @classmethod
+    def utcnow(cls):
+        return _real_datetime.fromtimestamp(
+            time.time(),
+            datetime.timezone.utc
+        ).replace(tzinfo=None)
+
+
+class _TimeWrapper(object): # pylint:disable=too-many-instance-attributes
+    # One attribute for each fake, so they can be recorded.
+
+    def __init__(self, granularity=1.0, fake_sleep=False, fake_waits=False,
+                 record_calls=False, clock=None, *, fake_datetime=False):
         self._granularity = granularity
-        self._lock = Lock()
-        self.fake_gmtime = Mock()
-        self.fake_time = Mock()
-        self._configure_fakes()
-
-    def _configure_fakes(self):
-        def incr():
-            global _current_time # pylint:disable=global-statement
-            with self._lock:
-                _current_time = max(_real_time(), _current_time + self._granularity)
-            return _current_time
-        self.fake_time.side_effect = incr
-
-        def incr_gmtime(*seconds):
-            if seconds:
-                assert len(seconds) == 1
-                now = seconds[0]
-            else:
-                now = incr()
-            return _real_gmtime(now)
-        self.fake_gmtime.side_effect = incr_gmtime
+        self._patch_sleep = fake_sleep
+        self._patch_waits = fake_waits
+        self._patch_datetime = fake_datetime
+        self.clock = clock if clock is not None else _default_clock
+        # For each time the fakes are installed, the
+        # ``(obj, name, previous value)`` they replaced.
+        self._replaced = []
+        # These are called a lot, so they are plain functions.
+        self._configure_clock_fakes()
+        self._configure_struct_time_fakes()
+        self._configure_sleep_fake()
+        if record_calls:
+            for name in self._FAKES:
+                setattr(self, name, Mock(side_effect=getattr(self, name)))
+
+    _FAKES = (
+        'fake_time',
+        'fake_time_ns',
+        'fake_monotonic',
+        'fake_monotonic_ns',
+        'fake_perf_counter',
+        'fake_perf_counter_ns',
+        'fake_gmtime',
+        'fake_localtime',
+        'fake_sleep',
+    )
+
+    def _advance(self, seconds=None):
+        # Advance the clock by *seconds* (by default, the granularity),
+        # returning the new wall clock and monotonic clock times.
+        if seconds is None:
+            seconds = self._granularity
+        return self.clock.advance(seconds)
+
+    def _configure_clock_fakes(self):
+        advance = self._advance
+
+        def fake_time():
+            return advance()[0]
+        self.fake_time = fake_time
+
+        def fake_time_ns():
+            return int(advance()[0] * 1e9)
+        self.fake_time_ns = fake_time_ns
+
+        def fake_monotonic():
+            return advance()[1]
+        self.fake_monotonic = fake_monotonic
+
+        def fake_monotonic_ns():
+            return int(advance()[1] * 1e9)
+        self.fake_monotonic_ns = fake_monotonic_ns
+
+        def fake_perf_counter():
+            return advance()[1] - _PERF_COUNTER_OFFSET
+        self.fake_perf_counter = fake_perf_counter
+
+        def fake_perf_counter_ns():
+            return int((advance()[1] - _PERF_COUNTER_OFFSET) * 1e9)
+        self.fake_perf_counter_ns = fake_perf_counter_ns
+
+    def _configure_struct_time_fakes(self):
+        advance = self._advance
+
+        def make_struct_time(convert):
+            def incr_struct_time(*seconds):
+                if seconds:
+                    assert len(seconds) == 1
+                    now = seconds[0]
+                    if now is None:
+                        now = advance()[0]
+                else:
+                    now = advance()[0]
+                return convert(now)
+            return incr_struct_time
+        self.fake_gmtime = make_struct_time(_real_gmtime)
+        self.fake_localtime = make_struct_time(_real_localtime)
+
+    def _configure_sleep_fake(self):
+        advance = self._advance
+
+        def fake_sleep(seconds):
+            if seconds < 0:
+                raise ValueError('sleep length must be non-negative')
+            advance(seconds)
+            # Still let other threads run.
+            _real_sleep(0)
+        self.fake_sleep = fake_sleep
+
+    def _condition_wait(self):
+        advance = self._advance
+        def wait(cond, timeout=None):
+            if timeout is None:
+                # Only another thread can end this.
+                return _real_condition_wait(cond)
+            result = _real_condition_wait(cond, 0)
+            if not result:
+                advance(max(timeout, 0))
+            return result
+        return wait
+
+    def _replace(self, obj, name, value):
+        self._replaced[-1].append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def _install_time(self):
+        self._replace(time, 'time', self.fake_time)
+        self._replace(time, 'time_ns', self.fake_time_ns)
+        self._replace(time, 'gmtime', self.fake_gmtime)
+        self._replace(time, 'localtime', self.fake_localtime)
+        self._replace(time, 'monotonic', self.fake_monotonic)
+        self._replace(time, 'monotonic_ns', self.fake_monotonic_ns)
+        self._replace(time, 'perf_counter', self.fake_perf_counter)
+        self._replace(time, 'perf_counter_ns', self.fake_perf_counter_ns)
+        if self._patch_sleep:
+            self._replace(time, 'sleep', self.fake_sleep)
+
+    def _install_datetime(self):
+        if self._patch_datetime:
+            self._replace(datetime, 'datetime', _FakeDatetime)
+
+    def _install_threading(self):
+        if self._patch_waits:
+            self._replace(threading.Condition, 'wait', self._condition_wait())
+            # These modules imported the clock they use for deadlines.
+            self._replace(threading, '_time', self.fake_monotonic)
+            self._replace(queue, 'time', self.fake_monotonic)
 
     def install_fakes(self):
-        time.time = self.fake_time
-        time.gmtime = self.fake_gmtime
+        self._replaced.append([])
+        self._install_time()
+        self._install_datetime()
+        self._install_threading()
 
     __enter__ = install_fakes
 
     def close(self, *_args):
-        time.time = _real_time
-        time.gmtime = _real_gmtime
+        # Put back what we replaced, which may be the fakes of an
+        # enclosing use (such as a layer that installed them for all
+        # its tests).
+        if not self._replaced:
+            return
+        for obj, name, value in reversed(self._replaced.pop()):
+            setattr(obj, name, value)
 
     __exit__ = close
 
@@ -71,7 +368,8 @@ class _TimeWrapper(object):
 
 
 
-def time_monotonically_increases(func_or_granularity):
+def time_monotonically_increases(func_or_granularity=None, fake_sleep=False, fake_waits=False,
+                                 record_calls=False, clock=None, *, fake_datetime=False):
     """
     Decorate a unittest method with this function to cause the value
     of :func:`time.time` (and :func:`time.gmtime`) to monotonically
@@ -115,8 +413,70 @@ def time_monotonically_increases(func_or_granularity):
             t2 = time.time()
             assrt t2 == t1 + 0.1
 
+    The other clocks in the :mod:`time` module are faked too, and
+    advance along with :func:`time.time`: :func:`time.time_ns`,
+    :func:`time.localtime`, :func:`time.monotonic`,
+    :func:`time.perf_counter` (and their ``_ns`` versions). The
+    monotonic clocks never go backwards, even if the time is reset with
+    :func:`reset_monotonic_time`. Only calls made through the modules
+    are faked; names imported from them before the fakes were installed
+    (``from time import monotonic``) still use the real clocks.
+
+    If *fake_datetime* is true, so are :meth:`datetime.datetime.now`,
+    :meth:`~datetime.datetime.utcnow` and
+    :meth:`~datetime.datetime.today`, by replacing
+    :class:`datetime.datetime` with a subclass (the objects they return
+    are real :class:`datetime.datetime` objects). While that is
+    installed, :mod:`pickle` refuses to pickle datetimes (the class
+    isn't the one found in the module), so this can't be used by
+    tests that store them, for example, in ZODB.
+
+    If *fake_sleep* is true, :func:`time.sleep` doesn't wait, but
+    instead advances the fake clocks by the time given, so code that
+    sleeps between retries finishes immediately while still seeing
+    the time pass::
+
+        @time_monotonically_increases(fake_sleep=True)
+        def test_retries(self):
+            before = time.monotonic()
+            time.sleep(60)
+            assert time.monotonic() >= before + 60
+
+    If *fake_waits* is true, the same is done for the timeouts of
+    :meth:`threading.Condition.wait` (which includes
+    :meth:`threading.Event.wait`): if the condition isn't already
+    notified or the event set, they return at once as if the timeout
+    expired, and the clocks are advanced by the timeout. Waits without
+    a timeout still block. The deadlines of :meth:`queue.Queue.get` and
+    :meth:`~queue.Queue.put` are faked too. Other code that waits in a
+    loop until a deadline taken from a clock it imported itself (``from
+    time import monotonic``) will instead spin, using the CPU, until
+    the real deadline passes; don't use *fake_waits* with it.
+
+    The fakes are plain functions, so calling them is cheap and uses
+    no memory. If *record_calls* is true, they are instead
+    :class:`unittest.mock.Mock` objects that record their calls (and so
+    use memory for each call); they are the ``fake_time``,
+    ``fake_monotonic``, etc, attributes of the returned object.
+
+    The guarantees are for the *clock* the fakes use, by default one
+    shared by all of them. To give threads or contexts their own
+    timelines, pass a `ThreadLocalClock`, a `ContextClock`, or a
+    `Clock` of your own.
+
     .. seealso:: `nti.testing.time.reset_monotonic_time`
 
+    .. versionchanged:: 4.5.0
+       Add the *clock* argument.
+    .. versionchanged:: 4.5.0
+       The fakes are no longer :class:`~unittest.mock.Mock` objects
+       unless the new *record_calls* argument is true.
+    .. versionchanged:: 4.5.0
+       Add the *fake_sleep*, *fake_waits* and *fake_datetime*
+       arguments. The granularity can be omitted when using them.
+    .. versionchanged:: 4.5.0
+       Fake the monotonic and performance counter clocks,
+       ``time.time_ns`` and ``time.localtime``.
     .. versionchanged:: 2.1
        Add support for ``time.gmtime``.
     .. versionchanged:: 2.1
@@ -136,9 +496,12 @@ def time_monotonically_increases(func_or_granularity):
        Allow specifying the granularity of clock increments. Keep at
        1.0 seconds for backwards compatibility by default.
     """
+    if func_or_granularity is None:
+        func_or_granularity = 1.0
     if isinstance(func_or_granularity, (six.integer_types, float)):
         # We're being used as a factory.
-        wrapper_factory = _TimeWrapper(func_or_granularity)
+        wrapper_factory = _TimeWrapper(func_or_granularity, fake_sleep, fake_waits,
+                                       record_calls, clock, fake_datetime=fake_datetime)
         return wrapper_factory
 
     # We're being used bare
@@ -146,16 +509,119 @@ def time_monotonically_increases(func_or_granularity):
     return wrapper_factory(func_or_granularity)
 
 
-def reset_monotonic_time(value=0.0):
+def reset_monotonic_time(value=0.0, clock=None):
     """
     Make the monotonic clock return the real time on its next
     call.
 
+    This resets the shared clock, unless a *clock* is given.
+
     .. versionadded:: 2.0
+    .. versionchanged:: 4.5.0
+       Add the *clock* argument.
+    """
+    (clock if clock is not None else _default_clock).reset(value)
+
+
+class _VirtualTimeSelector(object):
+    """
+    Wraps a selector so that, instead of waiting for a timeout, it
+    advances the fake clocks.
+    """
+
+    def __init__(self, selector, advance):
+        self._selector = selector
+        self._advance = advance
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            # Nothing is scheduled, so only I/O or another thread can
+            # wake us up.
+            return self._selector.select(timeout)
+        ready = self._selector.select(0)
+        if not ready and timeout > 0:
+            self._advance(timeout)
+        return ready
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
     """
+    An :mod:`asyncio` event loop whose :meth:`time` is the fake
+    monotonic clock used by `time_monotonically_increases`.
+
+    When the loop would wait for its next timer, it instead advances
+    the clock to the time the timer is due. :func:`asyncio.sleep`,
+    :meth:`call_later` and the timeouts of :func:`asyncio.wait_for`
+    thus happen at once, in the order they are scheduled. Ready I/O is
+    still handled first, but the loop doesn't wait for I/O that isn't
+    ready when a timer is pending, so code that needs to wait for a
+    real server or a thread should not have timeouts.
+
+    The clock only advances while the loop runs; use
+    :func:`run_in_virtual_time` to also install the fakes for
+    :func:`time.monotonic` and friends, so that the code being run
+    sees the same time as the loop. On Python 3.12 and above, this
+    class can also be passed as the ``loop_factory`` of
+    :func:`asyncio.run`.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self, time_manager=None, selector=None):
+        #: The ``_TimeWrapper`` that advances the clock.
+        self.time_manager = time_manager if time_manager is not None else _TimeWrapper()
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        # pylint:disable=protected-access
+        super().__init__(_VirtualTimeSelector(selector, self.time_manager._advance))
 
-    global _current_time # pylint:disable=global-statement
-    _current_time = value
+    def time(self):
+        return self.time_manager.clock.monotonic
+
+
+async def _cancel_all_tasks():
+    current = asyncio.current_task()
+    tasks = [t for t in asyncio.all_tasks() if t is not current]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_in_virtual_time(main, granularity=1.0, debug=None, clock=None):
+    """
+    Like :func:`asyncio.run`, run the coroutine *main* in a new
+    `VirtualTimeEventLoop` and return its result, with the fake clocks
+    of `time_monotonically_increases` (using *granularity* and
+    *clock*) installed.
+
+    ::
+
+        async def main():
+            await asyncio.wait_for(never_finishes(), 3600)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            run_in_virtual_time(main())
+
+    .. versionadded:: 4.5.0
+    """
+    loop = VirtualTimeEventLoop(_TimeWrapper(granularity, clock=clock))
+    try:
+        asyncio.set_event_loop(loop)
+        if debug is not None:
+            loop.set_debug(debug)
+        with loop.time_manager:
+            try:
+                return loop.run_until_complete(main)
+            finally:
+                loop.run_until_complete(_cancel_all_tasks())
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
 
 
 class MonotonicallyIncreasingTimeLayerMixin(object):
@@ -165,15 +631,60 @@ class MonotonicallyIncreasingTimeLayerMixin(object):
     You can either mix this in to a layer object, or instantiate it
     and call the methods directly.
 
+    The arguments are those of `time_monotonically_increases` (including
+    the keyword-only *fake_datetime*), plus these keyword-only arguments:
+
+    :keyword bool per_layer: If true, the fakes are installed in
+        :meth:`setUp` and removed in :meth:`tearDown`, instead of for
+        each test, so layers with many small tests don't pay to install
+        them each time.
+    :keyword bool reset_between_tests: If true (the default), the clock
+        is reset (see `reset_monotonic_time`) after each test. If
+        false, time keeps increasing from one test to the next.
+    :keyword float jump_ahead: If given, the clock is advanced this many
+        seconds before each test, so that each test starts at a distinct
+        time, later than anything the previous test saw.
+
     .. versionadded:: 2.2
+    .. versionchanged:: 4.5.0
+       Add the *fake_sleep*, *fake_waits*, *record_calls*, *clock*
+       and *fake_datetime* arguments.
+    .. versionchanged:: 4.5.0
+       Add the *per_layer*, *reset_between_tests* and *jump_ahead*
+       arguments, and the :meth:`setUp` and :meth:`tearDown` methods.
     """
 
-    def __init__(self, granularity=1.0):
-        self.time_manager = _TimeWrapper(granularity)
+    def __init__(self, granularity=1.0, fake_sleep=False, fake_waits=False,
+                 record_calls=False, clock=None,
+                 *, fake_datetime=False, per_layer=False, reset_between_tests=True, jump_ahead=0):
+        self.time_manager = _TimeWrapper(granularity, fake_sleep, fake_waits,
+                                         record_calls, clock,
+                                         fake_datetime=fake_datetime)
+        self.per_layer = per_layer
+        self.reset_between_tests = reset_between_tests
+        self.jump_ahead = jump_ahead
+
+    def setUp(self):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        if self.per_layer:
+            self.time_manager.install_fakes()
+
+    def tearDown(self):
+        # You MUST implement this, otherwise zope.testrunner
+        # will call the super-class again
+        if self.per_layer:
+            self.time_manager.close()
+            reset_monotonic_time(clock=self.time_manager.clock)
 
     def testSetUp(self):
-        self.time_manager.install_fakes()
+        if not self.per_layer:
+            self.time_manager.install_fakes()
+        if self.jump_ahead:
+            self.time_manager.clock.advance(self.jump_ahead)
 
     def testTearDown(self):
-        self.time_manager.close()
-        reset_monotonic_time()
+        if not self.per_layer:
+            self.time_manager.close()
+        if self.reset_between_tests:
+            reset_monotonic_time(clock=self.time_manager.clock)
@@ -9,8 +9,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextvars
 import gc
+import os
+import shutil
 import sys
+import tempfile
+import threading
+from time import perf_counter as _perf_counter
 
 
 import transaction
@@ -19,18 +25,49 @@ from transaction.interfaces import NoTransaction
 import ZODB
 from ZODB.interfaces import IDatabase
 from ZODB.DemoStorage import DemoStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.blob import BlobStorage
 from zope import component
 from zope.exceptions import print_exception
 from zope.exceptions import format_exception
 
 from .layers import ZopeComponentLayer
+from .layers import find_test
+from .zodb_stats import CountingStorage
+from .zodb_stats import StorageStatistics
+from .zodb_stats import max_object_loads
+from .zodb_stats import loads_at_most
+from .zodb_stats import profile_storage
+from .zodb_stats import StorageProfile
+from .zodb_stats import ClassProfile
 
 PYPY = hasattr(sys, 'pypy_version_info')
 
 __all__ = [
     'mock_db_trans',
+    'held_connection',
+    'async_db_trans',
+    'current_transaction_manager',
     'ZODBLayer',
+    'CountingStorage',
+    'StorageStatistics',
+    'max_object_loads',
+    'loads_at_most',
     'reset_db_caches',
+    'profile_storage',
+    'StorageProfile',
+    'ClassProfile',
+    'collect_garbage',
+    'collect_deferred_garbage',
+    'gc_statistics',
+    'GC_FULL',
+    'GC_YOUNG',
+    'GC_INCREMENTAL',
+    'GC_DEFERRED',
+    'ResetCachesPolicy',
+    'NeverResetCaches',
+    'ResetCachesEvery',
+    'ResetCachesAboveSize',
 ]
 
 # The exceptions are not expected to be caught. They indicate errors
@@ -64,6 +101,14 @@ class mock_db_trans(object):
     context manager commits the transaction (or aborts it if it is
     doomed).
 
+    Normally, a new connection is opened, and closed on exit, after
+    which the caches are reset (see :attr:`reset_caches_policy`). If
+    a *connection* is given, or one is being held for the database
+    (see :class:`held_connection`), that connection is used instead,
+    and it, and its cache, are left alone on exit; beginning the
+    transaction brings it up to date with changes committed by other
+    connections.
+
     It is an error to enter this context manager with a transaction
     already in progress. The global transaction may be committed or aborted
     before exiting this transaction, but no new transaction may be opened. During
@@ -78,14 +123,49 @@ class mock_db_trans(object):
     #: If `None`, exceptions will be written to `sys.stderr`
     exc_file = None
 
-    def __init__(self, db=None):
+    #: The `ResetCachesPolicy` deciding whether to call
+    #: :func:`reset_db_caches` on exit. If `None`, the
+    #: :attr:`ZODBLayer.reset_caches_policy` is used.
+    #:
+    #: .. versionadded:: 4.5.0
+    reset_caches_policy = None
+
+    #: If the storage of the database is a `CountingStorage`, then
+    #: after exiting, this is the `StorageStatistics` for the
+    #: transaction.
+    #:
+    #: .. versionadded:: 4.5.0
+    io_statistics = None
+
+    def __init__(self, db=None, reset_caches_policy=None, database_name=None,
+                 connection=None):
         """
         :param db: The :class:`ZODB.DB` to open. If none is given,
             then the :attr:`ZODBLayer.db` will be used.
+        :keyword reset_caches_policy: If given, overrides
+            :attr:`reset_caches_policy`.
+        :keyword str database_name: If given, open the database of this
+            name from the multi-database that *db* is part of (see
+            :class:`~nti.testing.layers.zodb.MultiDatabaseLayerMixin`).
+        :keyword connection: If given, an open connection, using the
+            global transaction manager, to reuse instead of opening one.
+
+        .. versionchanged:: 4.5.0
+           Add the *reset_caches_policy*, *database_name* and
+           *connection* arguments.
         """
+        if connection is not None and db is None:
+            db = connection.db()
         self.db = db if db is not None else ZODBLayer.db
+        if database_name is not None:
+            self.db = self.db.databases[database_name]
+        self.__connection = connection
+        if reset_caches_policy is not None:
+            self.reset_caches_policy = reset_caches_policy
         self.__txm_was_explicit = None
         self.__current_transaction = None
+        self.__io_before = None
+        self.__reusing = False
 
     def on_connection_opened(self, conn):
         """
@@ -102,7 +182,19 @@ class mock_db_trans(object):
         txm.explicit = True
         try:
             self.__current_transaction = txm.begin()
-            self.conn = conn = self.db.open()
+            conn = self.__connection
+            if conn is None:
+                conn = held_connection.get(self.db)
+            # If we have a connection, beginning the transaction
+            # synchronized it.
+            self.__reusing = conn is not None
+            if not self.__reusing:
+                conn = self.db.open()
+            self.conn = conn
+            storage = getattr(self.db, 'storage', None)
+            if isinstance(storage, CountingStorage):
+                self.__io_before = storage.statistics.copy()
+                storage.count_cache_hits(conn)
             self.on_connection_opened(conn)
         except:
             # Could be several things:
@@ -114,7 +206,7 @@ class mock_db_trans(object):
             if self.__current_transaction:
                 self._clean_up_one_transaction(self.__current_transaction, True)
 
-            if self.conn is not None:
+            if self.conn is not None and not self.__reusing:
                 self.conn.close()
             self.conn = None
             self.__current_transaction = None
@@ -180,24 +272,314 @@ class mock_db_trans(object):
             # So let the body exception propagate
         finally:
             txm.explicit = self.__txm_was_explicit
-            self._close_connection(self.conn, ignore_errors=body_raised)
+            if not self.__reusing:
+                self._close_connection(self.conn, ignore_errors=body_raised)
+            if self.__io_before is not None:
+                storage = self.db.storage
+                storage.stop_counting_cache_hits(self.conn)
+                self.io_statistics = storage.statistics - self.__io_before
+                self.__io_before = None
             self.conn = self.__current_transaction = None
-        reset_db_caches(self.db)
+        if not self.__reusing:
+            policy = self.reset_caches_policy or ZODBLayer.reset_caches_policy
+            policy.after_transaction(self.db)
         if error_in_body:
             raise error_in_body # pylint:disable=raising-bad-type
 
 
 
-def reset_db_caches(db=None, collect=False):
+class held_connection(object):
+    """
+    A context manager that opens a connection to the *db* (by default,
+    the one from :class:`ZODBLayer`), and holds it open.
+
+    While it is held, each :class:`mock_db_trans` for that database in
+    the same thread reuses it, instead of opening a new connection and
+    resetting the caches when it's done, so the objects loaded by one
+    transaction are still in memory for the next, as in a long-lived
+    application connection.
+
+    When exiting, the connection is closed and the caches are reset
+    according to the :attr:`ZODBLayer.reset_caches_policy`. Holding a
+    connection for a database that already has one nests.
+
+    See also :attr:`ZODBLayer.reuse_connections`.
+
+    .. versionadded:: 4.5.0
+    """
+
+    _local = threading.local()
+
+    #: The connection. Valid after entering and before exiting.
+    conn = None
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else ZODBLayer.db
+
+    @classmethod
+    def _stacks(cls):
+        try:
+            return cls._local.stacks
+        except AttributeError:
+            stacks = cls._local.stacks = {}
+            return stacks
+
+    @classmethod
+    def get(cls, db):
+        """
+        Return the connection held for *db* in this thread, or None.
+        """
+        stack = cls._stacks().get(db)
+        return stack[-1] if stack else None
+
+    def open(self):
+        """
+        Open and hold the connection, and return it. This is what
+        entering does.
+        """
+        self.conn = self.db.open()
+        self._stacks().setdefault(self.db, []).append(self.conn)
+        return self.conn
+
+    __enter__ = open
+
+    def close(self, *_args):
+        """
+        Release and close the connection. This is what exiting does.
+        """
+        stacks = self._stacks()
+        stack = stacks[self.db]
+        stack.remove(self.conn)
+        if not stack:
+            del stacks[self.db]
+        self.conn.close()
+        self.conn = None
+        ZODBLayer.reset_caches_policy.after_transaction(self.db)
+
+    __exit__ = close
+
+
+_transaction_manager = contextvars.ContextVar(
+    'nti.testing.zodb.transaction_manager',
+    default=None
+)
+
+def current_transaction_manager():
+    """
+    Return the transaction manager of the innermost
+    :class:`async_db_trans` of the current context (for example, the
+    current :class:`asyncio.Task`), or the global
+    :data:`transaction.manager` if there is none.
+
+    .. versionadded:: 4.5.0
+    """
+    txm = _transaction_manager.get()
+    return txm if txm is not None else transaction.manager
+
+
+class async_db_trans(object):
+    """
+    An asynchronous context manager that begins and commits a
+    database transaction, for code using :mod:`asyncio`.
+
+    ::
+
+        async with async_db_trans() as conn:
+            conn.root()['key'] = await compute()
+
+    :class:`mock_db_trans` uses the thread-local global transaction
+    manager, which all the tasks running in a thread share. Instead,
+    entering this creates a new (explicit)
+    :class:`transaction.TransactionManager`, makes it the
+    :func:`current_transaction_manager` of the current context, begins
+    a transaction with it and returns a new connection to the *db*
+    (by default, the one from :class:`ZODBLayer`) that uses it. So
+    any number of tasks may have transactions open at once. Exiting
+    commits the transaction (or aborts it, if the body raised an
+    exception or it is doomed) and closes the connection.
+
+    Committing is done synchronously, blocking the event loop. The
+    caches are not reset, because other tasks may be using them. As
+    with :class:`mock_db_trans`, the body must not commit, abort or
+    begin the transaction itself.
+
+    .. versionadded:: 4.5.0
+    """
+
+    #: The connection that was opened. Valid after entering and before exiting.
+    conn = None
+
+    #: The transaction manager. Valid after entering and before exiting.
+    transaction_manager = None
+
+    def __init__(self, db=None, database_name=None):
+        self.db = db if db is not None else ZODBLayer.db
+        if database_name is not None:
+            self.db = self.db.databases[database_name]
+        self._token = None
+        self._transaction = None
+
+    async def __aenter__(self):
+        txm = self.transaction_manager = transaction.TransactionManager(explicit=True)
+        self._transaction = txm.begin()
+        try:
+            self.conn = self.db.open(txm)
+        except:
+            txm.abort()
+            self.transaction_manager = self._transaction = None
+            raise
+        self._token = _transaction_manager.set(txm)
+        return self.conn
+
+    async def __aexit__(self, t, v, tb):
+        txm = self.transaction_manager
+        tx = self._transaction
+        try:
+            try:
+                current = txm.get()
+            except NoTransaction:
+                current = None
+            if current is not tx:
+                # Don't commit what the body began, or what it already
+                # finished.
+                if current is not None:
+                    current.abort()
+                tx.abort()
+                raise _TransactionChanged(t, v, tb)
+            if t is not None or tx.isDoomed():
+                tx.abort()
+            else:
+                try:
+                    tx.commit()
+                except:
+                    tx.abort()
+                    raise
+        finally:
+            _transaction_manager.reset(self._token)
+            self._token = None
+            self.conn.close()
+            self.conn = self.transaction_manager = self._transaction = None
+
+
+#: Garbage collection strategy: a full :func:`gc.collect`.
+GC_FULL = 'full'
+#: Garbage collection strategy: collect only the youngest generation.
+GC_YOUNG = 'young'
+#: Garbage collection strategy: on PyPy, take one step of the
+#: incremental collector (``gc.collect_step()``); elsewhere, this is
+#: the same as `GC_YOUNG`.
+GC_INCREMENTAL = 'incremental'
+#: Garbage collection strategy: don't collect now, but remember to do
+#: a full collection in :func:`collect_deferred_garbage`, which
+#: :class:`ZODBLayer` calls when it is torn down.
+GC_DEFERRED = 'deferred'
+
+
+class GCStatistics(object):
+    """
+    Records the number of collections done by :func:`collect_garbage`,
+    and the time they took, for each strategy.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        #: ``{strategy: number of collections}``
+        self.collections = {}
+        #: ``{strategy: total seconds}``
+        self.times = {}
+
+    def record(self, strategy, duration):
+        self.collections[strategy] = self.collections.get(strategy, 0) + 1
+        self.times[strategy] = self.times.get(strategy, 0.0) + duration
+
+    @property
+    def total_time(self):
+        """The total time, in seconds, spent in all collections."""
+        return sum(self.times.values())
+
+    def clear(self):
+        self.collections.clear()
+        self.times.clear()
+
+    def __repr__(self):
+        return '<%s %s>' % (
+            type(self).__name__,
+            ' '.join(
+                '%s=%d/%.3fs' % (k, self.collections[k], self.times[k])
+                for k in sorted(self.collections)
+            )
+        )
+
+#: The `GCStatistics` for all calls to :func:`collect_garbage`.
+#:
+#: .. versionadded:: 4.5.0
+gc_statistics = GCStatistics()
+
+_deferred_collection = False
+
+def collect_garbage(strategy=GC_FULL):
+    """
+    Collect garbage according to the *strategy*, one of the ``GC_``
+    constants, and record its time in `gc_statistics`.
+
+    Returns the number of unreachable objects found, or -1 if that's
+    not known (including when the collection is deferred).
+
+    .. versionadded:: 4.5.0
+    """
+    global _deferred_collection # pylint:disable=global-statement
+    if strategy == GC_DEFERRED:
+        _deferred_collection = True
+        return -1
+
+    begin = _perf_counter()
+    if strategy == GC_FULL:
+        result = gc.collect()
+    elif strategy == GC_YOUNG:
+        result = gc.collect(0)
+    elif strategy == GC_INCREMENTAL:
+        if hasattr(gc, 'collect_step'): # pragma: no cover
+            gc.collect_step() # pylint:disable=no-member
+            result = -1
+        else:
+            result = gc.collect(0)
+    else:
+        raise ValueError('Unknown garbage collection strategy', strategy)
+    gc_statistics.record(strategy, _perf_counter() - begin)
+    return result
+
+def collect_deferred_garbage():
+    """
+    If a collection was deferred by the `GC_DEFERRED` strategy, do a
+    full collection now.
+
+    Returns the result of :func:`collect_garbage`, or -1 if there was nothing
+    deferred.
+
+    .. versionadded:: 4.5.0
+    """
+    global _deferred_collection # pylint:disable=global-statement
+    if not _deferred_collection:
+        return -1
+    _deferred_collection = False
+    return collect_garbage(GC_FULL)
+
+def reset_db_caches(db=None, collect=False, gc_strategy=None):
     """
     Minimize the caches of all connections found in the *db*.
 
     If the *db* is not given, then the one from the :class:`ZODBLayer`
     is used.
 
-    On PyPy, or if *collect* is true, this will invoke
-    :func:`gc.collect` to help remove any weak references to objects
-    that were ejected from the cache.
+    On PyPy, or if *collect* is true, this will collect garbage to
+    help remove any weak references to objects that were ejected from
+    the cache. The *gc_strategy* is passed to :func:`collect_garbage`;
+    if not given, :attr:`ZODBLayer.gc_strategy` is used, which by default
+    invokes :func:`gc.collect`.
+
+    .. versionchanged:: 4.5.0
+       Add the *gc_strategy* argument.
     """
     result = -1
     if db is None:
@@ -206,9 +588,125 @@ def reset_db_caches(db=None, collect=False):
         for conn in db.pool:
             conn.cacheMinimize()
         if PYPY or collect:
-            result = gc.collect()
+            result = collect_garbage(gc_strategy or ZODBLayer.gc_strategy)
     return result
 
+
+class ResetCachesPolicy(object):
+    """
+    Decides whether :class:`mock_db_trans` calls
+    :func:`reset_db_caches` when it exits, and keeps statistics about
+    that.
+
+    Resetting the caches makes sure that each transaction begins by
+    loading objects from the storage, which catches errors like
+    unpicklable state, but it is expensive for tests that run many
+    small transactions.
+
+    This class always resets the caches; the subclasses are more
+    selective. One instance may be shared by many transactions.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        #: The number of transactions that have finished.
+        self.transactions = 0
+        #: The number of those that reset the caches.
+        self.resets = 0
+        #: The total time, in seconds, spent resetting caches.
+        self.reset_time = 0.0
+
+    def should_reset(self, db): # pylint:disable=unused-argument
+        """
+        Return whether to reset the caches of *db* now.
+        """
+        return True
+
+    def after_transaction(self, db):
+        """
+        Called by :class:`mock_db_trans` when it exits. Resets the
+        caches of *db* if :meth:`should_reset` says to, and returns
+        whether it did.
+        """
+        self.transactions += 1
+        if not self.should_reset(db):
+            return False
+        begin = _perf_counter()
+        reset_db_caches(db)
+        self.reset_time += _perf_counter() - begin
+        self.resets += 1
+        return True
+
+    @property
+    def skipped(self):
+        """The number of transactions that didn't reset the caches."""
+        return self.transactions - self.resets
+
+    @property
+    def estimated_time_saved(self):
+        """
+        An estimate of the time, in seconds, saved by skipped resets,
+        based on the average time of the resets that did happen. If
+        no reset has happened, this is `None`.
+        """
+        if not self.resets:
+            return None
+        return self.skipped * (self.reset_time / self.resets)
+
+    def __repr__(self):
+        saved = self.estimated_time_saved
+        return '<%s transactions=%d resets=%d reset_time=%.3fs saved=%s>' % (
+            type(self).__name__,
+            self.transactions,
+            self.resets,
+            self.reset_time,
+            '%.3fs' % saved if saved is not None else '?',
+        )
+
+
+class NeverResetCaches(ResetCachesPolicy):
+    """
+    Never reset the caches.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def should_reset(self, db):
+        return False
+
+
+class ResetCachesEvery(ResetCachesPolicy):
+    """
+    Reset the caches after every *n* transactions.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    def should_reset(self, db):
+        return self.transactions % self.n == 0
+
+
+class ResetCachesAboveSize(ResetCachesPolicy):
+    """
+    Reset the caches when the connections of the database are
+    holding more than *max_objects* non-ghost objects in total.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self, max_objects):
+        super().__init__()
+        self.max_objects = max_objects
+
+    def should_reset(self, db):
+        return db.cacheSize() > self.max_objects
+
+
 class ZODBLayer(ZopeComponentLayer):
     """
     Test layer that creates a ZODB database using
@@ -216,18 +714,108 @@ class ZODBLayer(ZopeComponentLayer):
     no-name :class:`ZODB.interfaces.IDatabase` in the global component
     registry. It is also available in the :attr:`db` attribute of this
     object.
+
+    Each test gets its own database, using a new
+    :class:`~ZODB.DemoStorage.DemoStorage` pushed on top of the
+    layer's storage (see :meth:`ZODB.DemoStorage.DemoStorage.push`;
+    if a sub-layer replaced the storage with some other kind, a
+    ``DemoStorage`` is created using it as the base);
+    while the test runs, that database is the registered utility and
+    the value of :attr:`db`. Data committed by a test is thus thrown
+    away when it finishes, while data committed outside of a test (for
+    example, in the ``setUp`` of a sub-layer) is visible to all of them.
+
+    If :attr:`count_storage_io` is true, the storages are wrapped in a
+    `CountingStorage`; the :attr:`io_statistics` of each test are
+    recorded, and the tests that loaded the most objects are printed
+    when the layer is torn down.
+
+    .. versionchanged:: 4.5.0
+       Isolate the data committed by each test.
+    .. versionchanged:: 4.5.0
+       Add :attr:`count_storage_io`.
     """
 
-    #: The DB that was created.
+    #: The DB that was created. While a test is running, this is the
+    #: DB for that test.
     db = None
 
+    #: Whether each test should get its own database. Sub-layers
+    #: whose tests depend on data committed by earlier tests can set
+    #: this to false.
+    #:
+    #: .. versionadded:: 4.5.0
+    isolate_tests = True
+
+    #: The default `ResetCachesPolicy` for :class:`mock_db_trans`.
+    #: This always resets the caches; its statistics cover all
+    #: transactions that use it.
+    #:
+    #: .. versionadded:: 4.5.0
+    reset_caches_policy = ResetCachesPolicy()
+
+    #: The default garbage collection strategy for
+    #: :func:`reset_db_caches`, one of the ``GC_`` constants. This can
+    #: be set with the ``NTI_ZODB_GC_STRATEGY`` environment variable.
+    #:
+    #: .. versionadded:: 4.5.0
+    gc_strategy = os.environ.get('NTI_ZODB_GC_STRATEGY', GC_FULL)
+
+    #: Whether to count the I/O of each test. This can be set to true
+    #: with the ``NTI_ZODB_COUNT_IO`` environment variable.
+    #:
+    #: .. versionadded:: 4.5.0
+    count_storage_io = os.environ.get(
+        'NTI_ZODB_COUNT_IO', ''
+    ).lower() in {'1', 'on', 'true', 'yes'}
+
+    #: ``{test id: StorageStatistics}`` for the tests that have run.
+    #:
+    #: .. versionadded:: 4.5.0
+    io_statistics = {}
+
+    #: How many tests to print when the layer is torn down.
+    #:
+    #: .. versionadded:: 4.5.0
+    io_report_limit = 10
+
+    #: Whether each test should hold a connection to the database
+    #: (see :class:`held_connection`) for :class:`mock_db_trans` to
+    #: reuse. This is read from the layer of the running test.
+    #:
+    #: .. versionadded:: 4.5.0
+    reuse_connections = False
+
+    #: If set, the directory in which each test's
+    #: :class:`~ZODB.DemoStorage.DemoStorage` keeps its blobs. See
+    #: :class:`~nti.testing.layers.zodb.BlobLayerMixin`.
+    #:
+    #: .. versionadded:: 4.5.0
+    blob_dir = None
+
+    #: The bytes of blobs committed by tests using :attr:`blob_dir`.
+    #:
+    #: .. versionadded:: 4.5.0
+    blob_bytes_written = 0
+
+    # The DB underneath the DB of the current test.
+    _base_db = None
+    # The statistics when the current test started.
+    _io_before = None
+    # The held_connection of the current test.
+    _held_connection = None
+
     @classmethod
     def setUp(cls):
-        db = cls.db = ZODB.DB(DemoStorage())
+        storage = DemoStorage()
+        db = cls.db = ZODB.DB(
+            CountingStorage(storage) if cls.count_storage_io else storage
+        )
         component.getGlobalSiteManager().registerUtility(db, IDatabase)
 
     @classmethod
     def tearDown(cls):
+        cls._pop_test_db()
         db = cls.db
         cls.db = None
         if db is not None:
@@ -235,11 +823,158 @@ class ZODBLayer(ZopeComponentLayer):
             reg_db = component.getGlobalSiteManager().queryUtility(IDatabase)
             if reg_db is db:
                 component.getGlobalSiteManager().unregisterUtility(db, IDatabase)
+        collect_deferred_garbage()
+        cls.print_io_statistics()
+        cls.io_statistics = {}
 
     @classmethod
-    def testSetUp(cls):
-        pass
+    def testSetUp(cls, test=None):
+        # zope.testrunner also calls this for each sub-layer that
+        # doesn't define its own; only do it once, and always for
+        # this class.
+        if cls is not ZODBLayer:
+            return
+        test = test or find_test()
+        # Sub-layers don't call this, so we have to ask the test which
+        # layer it is using.
+        layer = getattr(test, 'layer', cls)
+        try:
+            if cls.db is not None and getattr(layer, 'isolate_tests', cls.isolate_tests):
+                cls._push_test_db()
+            if (cls.db is not None
+                    and cls._held_connection is None
+                    and getattr(layer, 'reuse_connections', cls.reuse_connections)):
+                connection = held_connection(cls.db)
+                connection.open()
+                cls._held_connection = connection
+            storage = getattr(cls.db, 'storage', None)
+            if isinstance(storage, CountingStorage) and cls._io_before is None:
+                cls._io_before = storage.statistics.copy()
+        except:
+            # Don't leave the connection open or the database pushed;
+            # testTearDown may not be called.
+            cls.testTearDown()
+            raise
 
     @classmethod
     def testTearDown(cls):
-        pass
+        if cls is not ZODBLayer:
+            return
+        connection = cls._held_connection
+        if connection is not None:
+            cls._held_connection = None
+            connection.close()
+        if cls._io_before is not None:
+            test = find_test()
+            cls.io_statistics[test.id() if test is not None else None] = (
+                cls.db.storage.statistics - cls._io_before
+            )
+            cls._io_before = None
+        cls._pop_test_db()
+
+    @classmethod
+    def print_io_statistics(cls):
+        """
+        Print the tests in :attr:`io_statistics` that loaded the most
+        objects.
+
+        .. versionadded:: 4.5.0
+        """
+        busiest = sorted(cls.io_statistics.items(),
+                         key=lambda i: (i[1].loads, i[1].stores),
+                         reverse=True)[:cls.io_report_limit]
+        if not busiest:
+            return
+        print()
+        print(f'{"Loads":>8} {"Bytes":>10} {"Stores":>8} {"Bytes":>10} {"Hits":>5} Test')
+        for test_id, stat in busiest:
+            ratio = stat.cache_hit_ratio
+            ratio = f'{ratio:5.0%}' if ratio is not None else f'{"-":>5}'
+            print(f'{stat.loads:8d} {stat.load_bytes:10d} '
+                  f'{stat.stores:8d} {stat.store_bytes:10d} {ratio} {test_id}')
+
+    # These always use the attributes of this class, not of a
+    # sub-layer they were called for.
+
+    @staticmethod
+    def _push_test_db():
+        if ZODBLayer._base_db is not None:
+            # Already pushed.
+            return
+        base_db = ZODBLayer._base_db = ZODBLayer.db
+        # Push every database of a multi-database, keeping them
+        # connected to each other.
+        databases = {}
+        for name, db in base_db.databases.items():
+            ZODB.DB(ZODBLayer._push_storage(db.storage),
+                    database_name=name, databases=databases)
+        ZODBLayer.db = databases[base_db.database_name]
+        _replace_registrations(base_db.databases, databases)
+
+    @staticmethod
+    def _push_storage(storage):
+        counting = isinstance(storage, CountingStorage)
+        if counting:
+            # Keep counting what the test does, but don't count
+            # it twice.
+            storage = storage.wrapped_storage
+        changes = None
+        if ZODBLayer.blob_dir:
+            changes = BlobStorage(tempfile.mkdtemp(dir=ZODBLayer.blob_dir), MappingStorage())
+        if isinstance(storage, DemoStorage):
+            storage = storage.push(changes)
+        else:
+            # Some other kind of storage, such as RelStorage; leave it
+            # open when this is closed.
+            storage = DemoStorage(base=storage, changes=changes,
+                                  close_base_on_close=False)
+        return CountingStorage(storage) if counting else storage
+
+    @staticmethod
+    def _pop_test_db():
+        base_db = ZODBLayer._base_db
+        if base_db is None:
+            return
+        db = ZODBLayer.db
+        ZODBLayer.db = base_db
+        ZODBLayer._base_db = None
+
+        _replace_registrations(db.databases, base_db.databases)
+        for test_db in list(db.databases.values()):
+            storage = test_db.storage
+            changes = storage.changes
+            # This doesn't close the base storage.
+            test_db.close()
+            storage.pop()
+            # BlobStorage is a proxy, so isinstance() doesn't work.
+            fshelper = getattr(changes, 'fshelper', None)
+            if fshelper is not None and ZODBLayer.blob_dir:
+                blob_dir = os.path.normpath(fshelper.base_dir)
+                if os.path.dirname(blob_dir) == ZODBLayer.blob_dir:
+                    ZODBLayer.blob_bytes_written += _committed_blob_bytes(blob_dir)
+                    shutil.rmtree(blob_dir)
+
+
+def _committed_blob_bytes(blob_dir):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(blob_dir):
+        if 'tmp' in dirnames:
+            # Uncommitted.
+            dirnames.remove('tmp')
+        total += sum(
+            os.path.getsize(os.path.join(dirpath, name))
+            for name in filenames
+            if name.endswith('.blob')
+        )
+    return total
+
+
+def _replace_registrations(old_databases, new_databases):
+    # Where a database in *old_databases* is registered, as the
+    # unnamed utility or by its name, register the database
+    # of the same name from *new_databases*.
+    gsm = component.getGlobalSiteManager()
+    for name, old in old_databases.items():
+        for utility_name in ('', name):
+            if gsm.queryUtility(IDatabase, name=utility_name) is old:
+                gsm.registerUtility(new_databases[name], IDatabase, name=utility_name)
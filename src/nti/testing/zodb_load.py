@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Putting a ZODB database under load: committing from many threads at
+once, and populating it with many objects.
+
+.. versionadded:: 4.5.0
+"""
+
+import functools
+import itertools
+import threading
+from time import perf_counter as _perf_counter
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from .zodb import NeverResetCaches
+from .zodb import ZODBLayer
+from .zodb import mock_db_trans
+
+__all__ = [
+    'run_concurrent_transactions',
+    'ConcurrentTransactionResult',
+    'build_bulk_fixture',
+    'BulkFixtureResult',
+]
+
+
+class ConcurrentTransactionResult(object):
+    """
+    The outcome of :func:`run_concurrent_transactions`.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        #: The number of transactions committed.
+        self.commits = 0
+        #: The number of :exc:`~ZODB.POSException.ConflictError` raised.
+        self.conflicts = 0
+        #: The number of transactions that gave up after too many conflicts.
+        self.failures = 0
+        #: For each transaction that had to be retried, the seconds
+        #: from its first attempt until it committed.
+        self.retry_latencies = []
+        #: The total time, in seconds.
+        self.elapsed = 0.0
+
+    @property
+    def commits_per_second(self):
+        return self.commits / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def conflict_rate(self):
+        """
+        The fraction of attempts to commit that conflicted.
+        """
+        attempts = self.commits + self.conflicts
+        return self.conflicts / attempts if attempts else 0.0
+
+    def __repr__(self):
+        return '<%s commits=%d conflicts=%d failures=%d %.1f/s conflict_rate=%.2f>' % (
+            type(self).__name__,
+            self.commits, self.conflicts, self.failures,
+            self.commits_per_second, self.conflict_rate,
+        )
+
+
+def _retry_transaction(txm, func, max_retries):
+    # Call *func* and commit, retrying on conflicts. Return the number
+    # of conflicts, and whether it committed.
+    conflicts = 0
+    for _ in range(max_retries + 1):
+        txm.begin()
+        try:
+            func()
+            txm.commit()
+        except ConflictError:
+            txm.abort()
+            conflicts += 1
+            continue
+        except:
+            txm.abort()
+            raise
+        return conflicts, True
+    return conflicts, False
+
+
+def run_concurrent_transactions(workload, workers=4, transactions=10,
+                                db=None, max_retries=10):
+    """
+    Run *transactions* transactions in each of *workers* threads at
+    the same time, and return a `ConcurrentTransactionResult`.
+
+    Unlike :class:`~nti.testing.zodb.mock_db_trans`, each thread has
+    its own :class:`transaction.TransactionManager` and its own
+    connection to the *db* (by default, the one from
+    :class:`~nti.testing.zodb.ZODBLayer`). For each transaction,
+    ``workload(conn, worker, iteration)`` is called and then the
+    transaction is committed. If that raises a
+    :exc:`~ZODB.POSException.ConflictError`, the transaction is
+    aborted and the workload is called again, up to *max_retries*
+    times.
+
+    Any other exception stops that thread, and the first one is
+    raised once all the threads have finished.
+
+    Only threads are supported: the default in-memory storages can't be
+    shared with other processes.
+
+    .. versionadded:: 4.5.0
+    """
+    db = db if db is not None else ZODBLayer.db
+    result = ConcurrentTransactionResult()
+    lock = threading.Lock()
+    errors = []
+    # Start everyone at the same time, to contend.
+    barrier = threading.Barrier(workers)
+
+    def work(worker):
+        txm = transaction.TransactionManager(explicit=True)
+        conn = None
+        try:
+            conn = db.open(txm)
+            barrier.wait()
+            for iteration in range(transactions):
+                started = _perf_counter()
+                conflicts, committed = _retry_transaction(
+                    txm,
+                    functools.partial(workload, conn, worker, iteration),
+                    max_retries
+                )
+                with lock:
+                    result.conflicts += conflicts
+                    if not committed:
+                        result.failures += 1
+                        continue
+                    result.commits += 1
+                    if conflicts:
+                        result.retry_latencies.append(_perf_counter() - started)
+        except BaseException as ex: # pylint:disable=broad-exception-caught
+            errors.append(ex)
+            barrier.abort()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    threads = [
+        threading.Thread(target=work, args=(i,), name=f'ZODB worker {i}')
+        for i in range(workers)
+    ]
+    begin = _perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = _perf_counter() - begin
+
+    errors = [e for e in errors if not isinstance(e, threading.BrokenBarrierError)] or errors
+    if errors:
+        raise errors[0]
+    return result
+
+
+class BulkFixtureResult(object):
+    """
+    The outcome of :func:`build_bulk_fixture`.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        #: The number of objects added.
+        self.objects = 0
+        #: The number of commits or savepoints.
+        self.batches = 0
+        #: The number of times the caches were minimized because they
+        #: were too big after garbage collection.
+        self.minimizes = 0
+        #: The total time, in seconds.
+        self.elapsed = 0.0
+
+    @property
+    def objects_per_second(self):
+        return self.objects / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<%s objects=%d batches=%d minimizes=%d %.1f/s>' % (
+            type(self).__name__,
+            self.objects, self.batches, self.minimizes, self.objects_per_second
+        )
+
+
+def build_bulk_fixture(items, add, db=None, batch_size=1000, # pylint:disable=too-many-positional-arguments
+                       savepoints=False, max_cached_objects=None):
+    """
+    Populate the *db* (by default, the one from
+    :class:`~nti.testing.zodb.ZODBLayer`) from the iterable *items*,
+    which may be a generator, by calling ``add(conn, item)`` for each
+    of them, and return a `BulkFixtureResult`.
+
+    Every *batch_size* items, the transaction is committed using
+    :class:`~nti.testing.zodb.mock_db_trans`, or, if *savepoints* is
+    true, a savepoint is taken in the single transaction. Either way, the objects added
+    no longer need to stay in the connection caches, so
+    :meth:`ZODB.Connection.Connection.cacheGC` is called for each
+    connection; if the caches still hold more
+    than *max_cached_objects* objects (by default, twice the cache size
+    of the *db*), they are minimized.
+
+    This keeps the memory used to build large fixtures bounded, which
+    isn't the case when everything is added in one transaction.
+
+    .. versionadded:: 4.5.0
+    """
+    db = db if db is not None else ZODBLayer.db
+    if max_cached_objects is None:
+        max_cached_objects = db.getCacheSize() * 2
+    result = BulkFixtureResult()
+    items = iter(items)
+    # We manage the caches.
+    policy = NeverResetCaches()
+
+    def fill(conn):
+        count = 0
+        for item in itertools.islice(items, batch_size):
+            add(conn, item)
+            count += 1
+        result.objects += count
+        return count
+
+    def shrink():
+        result.batches += 1
+        db._connectionMap( # pylint:disable=protected-access
+            lambda conn: conn.cacheGC()
+        )
+        if db.cacheSize() > max_cached_objects:
+            db.cacheMinimize()
+            result.minimizes += 1
+
+    begin = _perf_counter()
+    if savepoints:
+        with mock_db_trans(db, reset_caches_policy=policy) as conn:
+            while fill(conn):
+                conn.transaction_manager.savepoint(optimistic=True)
+                shrink()
+    else:
+        while True:
+            with mock_db_trans(db, reset_caches_policy=policy) as conn:
+                count = fill(conn)
+            if not count:
+                break
+            shrink()
+    result.elapsed = _perf_counter() - begin
+    return result
@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+"""
+Counting and profiling what ZODB applications load and store.
+
+Everything here is also available from :mod:`nti.testing.zodb`.
+
+.. versionadded:: 4.5.0
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import heapq
+import importlib
+import io
+import threading
+
+from ZODB.interfaces import IDatabase
+from ZODB.interfaces import IMVCCStorage
+from ZODB._compat import PersistentUnpickler
+from ZODB.serialize import referencesf
+from ZODB.utils import get_pickle_metadata
+from ZODB.utils import load_current
+from ZODB.utils import oid_repr
+from ZODB.utils import z64
+from zope import component
+from zope import interface
+from hamcrest.core.base_matcher import BaseMatcher
+
+__all__ = [
+    'CountingStorage',
+    'StorageStatistics',
+    'max_object_loads',
+    'loads_at_most',
+    'profile_storage',
+    'StorageProfile',
+    'ClassProfile',
+]
+
+
+def _default_db():
+    # ZODBLayer, and the layers that change its database, keep it
+    # registered.
+    return component.getUtility(IDatabase)
+
+
+class StorageStatistics(object):
+    """
+    Counts of the activity of a `CountingStorage`.
+
+    Instances can be subtracted to find the activity between two
+    points in time.
+
+    .. versionadded:: 4.5.0
+    """
+
+    FIELDS = (
+        'loads',
+        'load_bytes',
+        'stores',
+        'store_bytes',
+        'cache_hits',
+    )
+
+    def __init__(self, **kwargs):
+        #: The number of records loaded.
+        self.loads = 0
+        #: The size of the pickles loaded.
+        self.load_bytes = 0
+        #: The number of records stored.
+        self.stores = 0
+        #: The size of the pickles stored.
+        self.store_bytes = 0
+        #: The number of times a connection found an object it was asked
+        #: for (see :meth:`ZODB.Connection.Connection.get`) in its cache.
+        #: This is only counted for connections opened by
+        #: :class:`~nti.testing.zodb.mock_db_trans`,
+        #: and doesn't include objects reached through references.
+        self.cache_hits = 0
+        for k, v in kwargs.items():
+            if k not in self.FIELDS:
+                raise TypeError('Unknown statistic', k)
+            setattr(self, k, v)
+
+    @property
+    def cache_misses(self):
+        """
+        Every load is a miss of a connection cache.
+        """
+        return self.loads
+
+    @property
+    def cache_hit_ratio(self):
+        """
+        The fraction of objects found in a cache, or `None`
+        if nothing was looked for.
+        """
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total else None
+
+    def copy(self):
+        return type(self)(**self.as_dict())
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    def __sub__(self, other):
+        return type(self)(**{
+            k: getattr(self, k) - getattr(other, k)
+            for k in self.FIELDS
+        })
+
+    def __eq__(self, other):
+        if not isinstance(other, StorageStatistics):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    # The counts change, so these can't be hashed.
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %s>' % (
+            type(self).__name__,
+            ' '.join('%s=%s' % i for i in self.as_dict().items())
+        )
+
+
+class CountingStorage(object):
+    """
+    A proxy for a storage that counts the records it loads and
+    stores, and their sizes, in :attr:`statistics`.
+
+    Any attribute not defined here is taken from the *storage*, and
+    the proxy provides the same interfaces. For a
+    :class:`~ZODB.interfaces.IMVCCStorage`, the instances are also
+    counted.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self, storage, statistics=None):
+        #: The storage being counted.
+        self.wrapped_storage = storage
+        #: The `StorageStatistics`.
+        self.statistics = statistics if statistics is not None else StorageStatistics()
+        self._lock = threading.Lock()
+        interface.directlyProvides(self, interface.providedBy(storage))
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped_storage, name)
+
+    def __len__(self):
+        return len(self.wrapped_storage)
+
+    def _loaded(self, data):
+        with self._lock:
+            self.statistics.loads += 1
+            self.statistics.load_bytes += len(data)
+
+    def _stored(self, data):
+        with self._lock:
+            self.statistics.stores += 1
+            self.statistics.store_bytes += len(data)
+
+    def load(self, oid, version=''):
+        result = self.wrapped_storage.load(oid, version)
+        self._loaded(result[0])
+        return result
+
+    def loadBefore(self, oid, tid):
+        result = self.wrapped_storage.loadBefore(oid, tid)
+        if result is not None:
+            self._loaded(result[0])
+        return result
+
+    def loadSerial(self, oid, serial):
+        result = self.wrapped_storage.loadSerial(oid, serial)
+        self._loaded(result)
+        return result
+
+    def store(self, oid, serial, data, version, transaction):
+        # pylint:disable=redefined-outer-name
+        result = self.wrapped_storage.store(oid, serial, data, version, transaction)
+        self._stored(data)
+        return result
+
+    def storeBlob(self, oid, oldserial, data, blobfilename, version, transaction):
+        # pylint:disable=redefined-outer-name,too-many-positional-arguments
+        result = self.wrapped_storage.storeBlob(oid, oldserial, data, blobfilename,
+                                                version, transaction)
+        self._stored(data)
+        return result
+
+    def new_instance(self):
+        counting = type(self)(self.wrapped_storage.new_instance(), self.statistics)
+        counting._lock = self._lock # pylint:disable=protected-access
+        return counting
+
+    def count_cache_hits(self, conn):
+        """
+        Make *conn* count the objects it gets from its cache.
+        """
+        get = functools.partial(type(conn).get, conn)
+        cache = conn._cache # pylint:disable=protected-access
+        def counting_get(oid):
+            if cache.get(oid) is not None:
+                with self._lock:
+                    self.statistics.cache_hits += 1
+            return get(oid)
+        conn.get = counting_get
+
+    @staticmethod
+    def stop_counting_cache_hits(conn):
+        conn.__dict__.pop('get', None)
+
+
+def _transfer_counts(db, clear=False):
+    # The (loads, stores) of all the connections of the *db*, or of
+    # its storage if that's counted. Clearing only applies to the
+    # connections.
+    storage = getattr(db, 'storage', None)
+    if isinstance(storage, CountingStorage) and not clear:
+        return storage.statistics.loads, storage.statistics.stores
+    counts = []
+    db._connectionMap( # pylint:disable=protected-access
+        lambda conn: counts.append(conn.getTransferCounts(clear))
+    )
+    return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+
+class max_object_loads(object):
+    """
+    A context manager that fails (raises :exc:`AssertionError`) if the
+    body loads more than *loads* persistent objects, or stores more
+    than *stores* objects, using any connection to the *db*.
+
+    ::
+
+        with max_object_loads(50):
+            traverse(container, 'some/path')
+
+    If the *db* is not given, the registered
+    :class:`~ZODB.interfaces.IDatabase` utility (such as the one from
+    :class:`~nti.testing.zodb.ZODBLayer`) is used. If its storage is a
+    `CountingStorage`, every record loaded from it is counted;
+    otherwise, the objects loaded and stored by the connections are
+    counted (see :meth:`ZODB.Connection.Connection.getTransferCounts`).
+
+    After exiting, the counts are in :attr:`loads_made` and
+    :attr:`stores_made`. Nothing is checked if the body raised an
+    exception.
+
+    .. versionadded:: 4.5.0
+    """
+
+    #: The number of objects the body loaded. Valid after exiting.
+    loads_made = None
+    #: The number of objects the body stored. Valid after exiting.
+    stores_made = None
+
+    def __init__(self, loads=None, db=None, stores=None):
+        self.loads = loads
+        self.stores = stores
+        self.db = db
+        self._before = None
+
+    def __enter__(self):
+        if self.db is None:
+            self.db = _default_db()
+        self._before = _transfer_counts(self.db)
+        return self
+
+    def __exit__(self, t, v, tb):
+        loads, stores = _transfer_counts(self.db)
+        self.loads_made = loads - self._before[0]
+        self.stores_made = stores - self._before[1]
+        if t is None:
+            problem = self.problem()
+            if problem:
+                raise AssertionError(problem)
+
+    def problem(self):
+        """
+        Return a description of how the budget was exceeded, or None.
+        """
+        problems = []
+        if self.loads is not None and self.loads_made > self.loads:
+            problems.append(f'loaded {self.loads_made} objects (budget {self.loads})')
+        if self.stores is not None and self.stores_made > self.stores:
+            problems.append(f'stored {self.stores_made} objects (budget {self.stores})')
+        return '; '.join(problems) or None
+
+
+class _LoadsAtMost(BaseMatcher):
+
+    def __init__(self, loads, db, stores):
+        super().__init__()
+        self.loads = loads
+        self.db = db
+        self.stores = stores
+        # Calling the item again to describe the mismatch could
+        # give a different answer.
+        self._last_problem = None
+
+    def _matches(self, item):
+        budget = max_object_loads(self.loads, self.db, self.stores)
+        try:
+            with budget:
+                item()
+        except AssertionError as ex:
+            self._last_problem = str(ex)
+            return False
+        return True
+
+    def describe_to(self, description):
+        description.append_text(f'a callable loading at most {self.loads} objects')
+        if self.stores is not None:
+            description.append_text(f' and storing at most {self.stores} objects')
+
+    def describe_mismatch(self, item, mismatch_description):
+        mismatch_description.append_text(self._last_problem)
+
+
+def loads_at_most(loads, db=None, stores=None):
+    """
+    A hamcrest matcher for a callable (taking no arguments) that loads
+    no more than *loads* objects (and stores no more than *stores*
+    objects, if given) when called. See `max_object_loads`.
+
+    ::
+
+        assert_that(lambda: traverse(container, 'some/path'),
+                    loads_at_most(50))
+
+    .. versionadded:: 4.5.0
+    """
+    return _LoadsAtMost(loads, db, stores)
+
+
+class ClassProfile(object):
+    """
+    The records of one class in a `StorageProfile`.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        #: The number of records.
+        self.count = 0
+        #: The total size of their pickles.
+        self.total_bytes = 0
+        #: The size of the largest pickle.
+        self.max_bytes = 0
+
+    @property
+    def mean_bytes(self):
+        return self.total_bytes / self.count if self.count else 0.0
+
+    def add(self, size):
+        self.count += 1
+        self.total_bytes += size
+        self.max_bytes = max(self.max_bytes, size)
+
+    def __repr__(self):
+        return '<%s count=%d total_bytes=%d max_bytes=%d>' % (
+            type(self).__name__, self.count, self.total_bytes, self.max_bytes
+        )
+
+
+class StorageProfile(object):
+    """
+    The sizes of the records reachable from the root of a database,
+    as found by :func:`profile_storage`.
+
+    .. versionadded:: 4.5.0
+    """
+
+    def __init__(self):
+        #: The number of records.
+        self.records = 0
+        #: The total size of their pickles.
+        self.total_bytes = 0
+        #: ``{'module.Class': ClassProfile}``
+        self.by_class = {}
+        #: A list of ``(size, oid, 'module.Class')`` for the largest
+        #: records, largest first. The oids are strings.
+        self.largest = []
+        #: ``{'module.Class': mean fill}`` for BTree buckets and sets:
+        #: how full they are, on average, as a fraction of the largest
+        #: size the BTree allows them.
+        self.bucket_fill = {}
+
+    def growth_since(self, earlier):
+        """
+        Compare to the *earlier* profile, returning ``{'module.Class':
+        ratio}``, where the ratio is the total size of the records of
+        the class now compared to then (so 1.1 means they grew by
+        10%). Classes that didn't have records before have a ratio of
+        `None`.
+        """
+        result = {}
+        for name, now in self.by_class.items():
+            then = earlier.by_class.get(name)
+            result[name] = now.total_bytes / then.total_bytes if then else None
+        return result
+
+    def format(self, limit=10):
+        """
+        Return a printable report, showing the *limit* classes using the
+        most space.
+        """
+        lines = [f'{self.records} records, {self.total_bytes} bytes']
+        lines.append(f'{"Count":>8} {"Bytes":>10} {"Mean":>8} {"Max":>8} Class')
+        classes = sorted(self.by_class.items(),
+                         key=lambda i: i[1].total_bytes,
+                         reverse=True)[:limit]
+        for name, stats in classes:
+            lines.append(f'{stats.count:8d} {stats.total_bytes:10d} '
+                         f'{stats.mean_bytes:8.0f} {stats.max_bytes:8d} {name}')
+        if self.largest:
+            lines.append('Largest records:')
+            for size, oid, name in self.largest:
+                lines.append(f'{size:10d} {oid} {name}')
+        if self.bucket_fill:
+            lines.append('Bucket fill:')
+            for name, fill in sorted(self.bucket_fill.items()):
+                lines.append(f'{fill:8.0%} {name}')
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<%s records=%d total_bytes=%d classes=%d>' % (
+            type(self).__name__, self.records, self.total_bytes, len(self.by_class)
+        )
+
+
+def _max_bucket_size(module_name, class_name):
+    # The largest size of a BTree bucket or set, and how many entries
+    # of its state make up an item; or None if it's not one of those.
+    if not module_name.startswith('BTrees.'):
+        return None
+    if class_name.endswith('Bucket'):
+        tree_name = class_name[:-len('Bucket')] + 'BTree'
+        width = 2
+    elif class_name.endswith('Set') and not class_name.endswith('TreeSet'):
+        tree_name = class_name[:-len('Set')] + 'TreeSet'
+        width = 1
+    else:
+        return None
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError: # pragma: no cover
+        return None
+    max_size = getattr(getattr(module, tree_name, None), 'max_leaf_size', None)
+    return (max_size, width) if max_size else None
+
+
+def _bucket_len(data, width):
+    # The number of items in the pickled bucket or set *data*, without
+    # going through a connection (and its storage). The state is
+    # ``((k1, v1, ...), next)``, or ``((k1, ...), next)`` for sets.
+    unpickler = PersistentUnpickler(None, lambda ref: None, io.BytesIO(data))
+    unpickler.load() # The class
+    state = unpickler.load()
+    return len(state[0]) // width
+
+
+def _profile_record(profile, fills, oid, data, largest):
+    # Add the record to the *profile*, and the fill of a bucket
+    # to the lists in *fills*.
+    module_name, class_name = get_pickle_metadata(data)
+    name = f'{module_name}.{class_name}'
+    size = len(data)
+
+    profile.records += 1
+    profile.total_bytes += size
+    if name not in profile.by_class:
+        profile.by_class[name] = ClassProfile()
+    profile.by_class[name].add(size)
+    if largest:
+        item = (size, oid_repr(oid), name)
+        if len(profile.largest) < largest:
+            heapq.heappush(profile.largest, item)
+        else:
+            heapq.heappushpop(profile.largest, item)
+
+    bucket = _max_bucket_size(module_name, class_name)
+    if bucket:
+        max_size, width = bucket
+        fills.setdefault(name, []).append(_bucket_len(data, width) / max_size)
+
+
+def profile_storage(db=None, largest=10):
+    """
+    Walk all the records reachable from the root of the *db* (by
+    default, the registered :class:`~ZODB.interfaces.IDatabase`
+    utility, such as the one from :class:`~nti.testing.zodb.ZODBLayer`),
+    and return a `StorageProfile` of their sizes.
+
+    This loads every record, so it is best used on test-sized
+    databases. Comparing the profiles before and after some code runs,
+    with :meth:`StorageProfile.growth_since`, lets tests check that it
+    doesn't make records bigger than it should.
+
+    :keyword int largest: How many of the largest records to report.
+
+    .. versionadded:: 4.5.0
+    """
+    db = db if db is not None else _default_db()
+    storage = db.storage
+    if isinstance(storage, CountingStorage):
+        # Don't count this.
+        storage = storage.wrapped_storage
+    # pylint:disable-next=no-value-for-parameter
+    instance = storage.new_instance() if IMVCCStorage.providedBy(storage) else None
+    if instance is not None:
+        storage = instance
+
+    profile = StorageProfile()
+    fills = {}
+    try:
+        seen = {z64}
+        todo = [z64]
+        while todo:
+            oid = todo.pop()
+            data = load_current(storage, oid)[0]
+            _profile_record(profile, fills, oid, data, largest)
+            for ref in referencesf(data):
+                if ref not in seen:
+                    seen.add(ref)
+                    todo.append(ref)
+    finally:
+        if instance is not None:
+            instance.release()
+
+    profile.largest.sort(reverse=True)
+    profile.bucket_fill = {
+        name: sum(values) / len(values)
+        for name, values in fills.items()
+    }
+    return profile